@@ -7,20 +7,29 @@ lpm is a lightweight production management system
 """
 
 from flask.ext.pymongo import PyMongo
-from . import login, utils, items, stock, components, ext, debug
+from . import login, utils, items, stock, components, ext, debug, jobs, indexes, profiling, metrics
 
 
 def init(app):
 
+    profiling.init(app)  # before the database client is created
     app.mongo = PyMongo(app)
     app.jinja_env.add_extension('jinja2.ext.do')
 
     login.init(app)
     utils.init(app)
+    components.init(app)
+    stock.init(app)
+    items.init(app)
+    jobs.init(app)
+    indexes.init(app)
+    metrics.init(app)
 
     app.register_blueprint(login.bp, url_prefix='')
     app.register_blueprint(items.bp, url_prefix='/items')
     app.register_blueprint(stock.bp, url_prefix='/stock')
     app.register_blueprint(components.bp, url_prefix='/components')
     app.register_blueprint(ext.bp, url_prefix='/ext')
-    app.register_blueprint(debug.bp, url_prefix='/debug')
\ No newline at end of file
+    app.register_blueprint(debug.bp, url_prefix='/debug')
+    app.register_blueprint(jobs.bp, url_prefix='/jobs')
+    app.register_blueprint(metrics.bp, url_prefix='')
\ No newline at end of file
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for lpm
+
+The benchmarks run against a separate database (lpm_benchmark by default) that is filled with
+synthetic data (see dataset.py). Use run-benchmarks.py to run them.
+
+The results are written as JSON:
+{
+    "created": ISO8601 timestamp,
+    "python": Python version,
+    "parameters": the dataset parameters,
+    "results": {benchmark name: {"runs", "min", "median", "mean", "max"} (seconds), ...}
+}
+A previous result file can be used as baseline. A benchmark regresses if its median is more than the given
+tolerance (a fraction) slower than the baseline median.
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+import json
+import time
+import platform
+import statistics
+from datetime import datetime
+from flask import Flask
+import lpm
+
+
+def create_app(dbname='lpm_benchmark', **config):
+    """
+    Returns a fully initialized lpm app for the given benchmark database
+    """
+    if not dbname.startswith('lpm_benchmark'):
+        raise EnvironmentError('Cannot run benchmarks on a non-benchmark database.')
+    app = Flask('lpm_benchmark')
+    app.config.update(
+            SECRET_KEY=b'\x8d\x1f\x92\xb0\x1c\x9a\xe1l\xd3\x0b\xa4\x11\x86\x1eNq\x93\xf2\x05\x0c\xc1\xa8\x7f\x1d',
+            MONGO_DBNAME=dbname,
+            WTF_CSRF_ENABLED=False,
+            LPM_AUTH_SRC='simple',
+            LPM_AUTH_USERS={
+                'admin': dict(
+                        name='Admin',
+                        password='1234',
+                        roles={
+                            'login', 'request_login',
+                            'component_edit', 'component_admin',
+                            'stock_admin', 'item_admin', 'db_debug',
+                        },
+                        active=True,
+                ),
+            },
+            LPM_PARTNO_PREFIX='BA',
+            LPM_COMPONENT_CATEGORIES={'category%d' % idx for idx in range(5)},
+            LPM_COMPONENT_FILES_DIR='/tmp',
+            LPM_ITEM_VIEW_MAP=dict(),
+            LPM_ITEM_IMPORT_MAP=dict(),
+            LPM_ITEM_STATUS_MAP={
+                'default': {
+                    'tested': dict(origins=[''], unavailable=False),
+                    'reserved': dict(origins=['', 'tested'], unavailable=False),
+                    'shipped': dict(origins=['reserved'], unavailable=True),
+                },
+            },
+            LPM_EXT_UPDATE_FIELDS={'default': set()},
+            LPM_JOB_WORKERS=0,
+    )
+    app.config.update(config)
+    lpm.init(app)
+    return app
+
+
+def measure(func, repeat=5, setup=None, warmup=1):
+    """
+    Runs func() repeat times after warmup runs and returns the timing statistics in seconds.
+    If given, setup() is called before every run and its return value is passed to func (not timed).
+    """
+    durations = list()
+    for run in range(warmup + repeat):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        duration = time.perf_counter() - start
+        if run >= warmup:
+            durations.append(duration)
+    return dict(runs=len(durations),
+                min=min(durations),
+                median=statistics.median(durations),
+                mean=statistics.mean(durations),
+                max=max(durations))
+
+
+def write_results(filepath, parameters, results):
+    with open(filepath, 'w') as f:
+        json.dump(dict(created=datetime.now().isoformat(),
+                       python=platform.python_version(),
+                       parameters=parameters,
+                       results=results), f, indent=2, sort_keys=True)
+
+
+def load_results(filepath):
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance, key='median', higher_is_better=False):
+    """
+    Compares the results with the baseline results (both dicts of benchmark name -> statistics).
+    Returns a list of (name, baseline value, value, ratio, regressed) tuples for the benchmarks present in both.
+    The ratio is value / baseline value, a benchmark regressed if it is worse than the tolerance allows.
+    """
+    comparison = list()
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            continue
+        reference = baseline[name][key]
+        value = results[name][key]
+        ratio = value / reference if reference else float('inf')
+        if higher_is_better:
+            regressed = ratio < 1.0 - tolerance
+        else:
+            regressed = ratio > 1.0 + tolerance
+        comparison.append((name, reference, value, ratio, regressed))
+    return comparison
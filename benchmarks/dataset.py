@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Deterministic generator for synthetic production-scale data
+
+The same parameters and seed always produce the same dataset:
+- components, spread over several part number prefixes (each prefix has 10000 numbers)
+- a multi-level BOM: the components are split into depth+1 levels, each component of a level has fanout
+  children of the next level. Children are shared between assemblies, i.e. the BOM is a DAG.
+- the stock with a long history and a few batches per component
+- items with custom fields
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+import random
+import string
+from datetime import datetime, timedelta
+from openpyxl import Workbook
+from lpm import indexes
+from lpm.stock import invalidate_bom_graph, rebuild_bom_closure
+
+_INSERT_CHUNK_SIZE = 5000
+_START_DATE = datetime(2016, 1, 1)
+_STATUSES = ['', '', '', 'tested', 'reserved', 'shipped']
+
+
+class Parameters:
+    """
+    The dataset parameters
+    """
+
+    def __init__(self, components=1000, items=10000, depth=3, fanout=4, history=50, fields=5, seed=0):
+        self.components = components
+        self.items = items
+        self.depth = depth
+        self.fanout = fanout
+        self.history = history
+        self.fields = fields
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def base_number(idx):
+    """
+    Returns the base number of the component with the given index (at most 260000 components)
+    """
+    prefix = 'B' + string.ascii_uppercase[idx // 10000]
+    return '%s%04d' % (prefix, idx % 10000)
+
+
+def serial(idx):
+    return 'SN%08d' % idx
+
+
+def bom_levels(params):
+    """
+    Returns the list of BOM levels, each being a list of base numbers. The first level contains the top assemblies
+    """
+    partnos = [base_number(idx) for idx in range(params.components)]
+    size = max(len(partnos) // (params.depth + 1), 1)
+    levels = [partnos[idx:idx+size] for idx in range(0, len(partnos), size)]
+    # the remainder belongs to the last level
+    while len(levels) > params.depth + 1:
+        levels[-2].extend(levels.pop())
+    return levels
+
+
+def generate(db, params):
+    """
+    Replaces the content of the given database with the generated dataset and creates the indexes
+    """
+    for collection in ('components', 'stock', 'stock_batches', 'stock_history', 'items', 'item_comments',
+                       'bom_closure'):
+        db[collection].drop()
+    rnd = random.Random(params.seed)
+    levels = bom_levels(params)
+
+    components = list()
+    for idx in range(params.components):
+        components.append({
+            '_id': base_number(idx),
+            'name': 'Component %d' % idx,
+            'description': 'Synthetic component number %d' % idx,
+            'category': 'category%d' % (idx % 5),
+            'suppliers': [{'name': 'Supplier %d' % (idx % 7), 'partno': 'S-%06d' % idx}],
+            'manufacturers': [{'name': 'Manufacturer %d' % (idx % 11), 'partno': 'M-%06d' % idx}],
+            'revisions': [{'date': _START_DATE, 'comment': 'initial revision'}],
+            'released': True,
+            'obsolete': idx % 20 == 19,
+            'history': [{'date': _START_DATE, 'user': 'admin', 'message': 'created'}],
+        })
+    _insert(db.components, components)
+
+    stock = list()
+    for level, children in zip(levels, levels[1:] + [list()]):
+        for partno in level:
+            entry = {'_id': partno, 'quantity': rnd.randint(0, 1000)}
+            if children:
+                entry['bom'] = [dict(partno=child, quantity=rnd.randint(1, 4))
+                                for child in rnd.sample(children, min(params.fanout, len(children)))]
+            stock.append(entry)
+    _insert(db.stock, stock)
+    invalidate_bom_graph(db)
+    rebuild_bom_closure(db)
+
+    batches = list()
+    history = list()
+    for idx in range(params.components):
+        for batch in range(idx % 3):
+            batches.append({'partno': base_number(idx), 'name': 'batch%d' % batch, 'quantity': rnd.randint(1, 100)})
+        for entry in range(params.history):
+            history.append({
+                'date': _START_DATE + timedelta(hours=entry, minutes=idx % 60),
+                'partno': base_number(idx),
+                'delta': rnd.randint(-50, 100),
+                'message': 'synthetic entry %d' % entry,
+            })
+            if len(history) >= _INSERT_CHUNK_SIZE:
+                _insert(db.stock_history, history)
+                history = list()
+    _insert(db.stock_batches, batches)
+    _insert(db.stock_history, history)
+
+    items = list()
+    for idx in range(params.items):
+        status = rnd.choice(_STATUSES)
+        item = {
+            '_id': serial(idx),
+            'partno': base_number(rnd.randrange(params.components)) + 'a',
+            'project': 'project%d' % (idx % 13),
+            'status': status,
+            'available': status != 'shipped',
+        }
+        for field in range(params.fields):
+            item['param%d' % field] = rnd.randint(0, 1000000)
+        items.append(item)
+        if len(items) >= _INSERT_CHUNK_SIZE:
+            _insert(db.items, items)
+            items = list()
+    _insert(db.items, items)
+    indexes.apply(db)
+
+
+def write_items_file(filepath, params, first_serial, count):
+    """
+    Writes an item import file with count items, starting at the given serial number index
+    """
+    rnd = random.Random(params.seed + first_serial)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    fields = ['param%d' % field for field in range(params.fields)]
+    ws.append(['serial', 'partno', 'comment'] + fields)
+    for idx in range(first_serial, first_serial + count):
+        ws.append([serial(idx), base_number(rnd.randrange(params.components)) + 'a', 'imported']
+                  + [rnd.randint(0, 1000000) for _ in fields])
+    wb.save(filepath)
+
+
+def _insert(collection, documents):
+    for idx in range(0, len(documents), _INSERT_CHUNK_SIZE):
+        collection.insert_many(documents[idx:idx+_INSERT_CHUNK_SIZE])
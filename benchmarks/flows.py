@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmarks of the key user flows
+
+Each flow is executed through the Flask test client (i.e. including routing, login handling, database access and
+template rendering), except the BOM explosion, which is called directly within a request context.
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from lpm import stock
+from benchmarks import measure, dataset
+
+
+def run(app, params, repeat=5, import_rows=1000):
+    """
+    Runs all flows against the generated dataset of the given app and returns the results by benchmark name
+    """
+    client = app.test_client()
+    _check(client.post('/login', data=dict(username='admin', password='1234')))
+    top_assembly = dataset.bom_levels(params)[0][0]
+    results = OrderedDict()
+
+    results['items.overview'] = measure(lambda: _check(client.get('/items/')), repeat)
+    results['items.overview_data'] = measure(lambda: _check(client.get(
+            '/items/data?draw=1&start=0&length=100&order[0][column]=2&order[0][dir]=asc')), repeat)
+    results['items.overview_data.search'] = measure(lambda: _check(client.get(
+            '/items/data?draw=1&start=0&length=100&search[value]=SN0000')), repeat)
+    results['stock.overview'] = measure(lambda: _check(client.get('/stock/')), repeat)
+    results['stock.details'] = measure(lambda: _check(client.get('/stock/' + top_assembly)), repeat)
+    results['ext.item_filter'] = measure(lambda: _check(client.post(
+            '/ext/items', data=dict(filter='{"available": true}'))), repeat)
+    results['ext.stock_buildable'] = measure(lambda: _check(client.get('/ext/stock/buildable')), repeat)
+
+    # every import run needs new serial numbers, also if the dataset of a previous run is reused
+    next_serial = [_next_serial(app)]
+
+    def write_import_file():
+        filepath = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False).name
+        dataset.write_items_file(filepath, params, next_serial[0], import_rows)
+        next_serial[0] += import_rows
+        return filepath
+
+    def import_items(filepath):
+        with open(filepath, 'rb') as f:
+            rv = _check(client.post('/items/import', data=dict(file=(f, 'items.xlsx'))))
+        os.remove(filepath)
+        start = rv.data.find(b'lpm_tmp_')
+        tmpname = rv.data[start:rv.data.find(b'"', start)].decode('utf-8')
+        rv = _check(client.post('/items/import', data=dict(tmpname=tmpname)))
+        # the import redirects to the job details (jobs.details)
+        if rv.status_code != 302 or '/jobs/' not in rv.location:
+            raise RuntimeError('the item import did not start a job')
+        _wait_job(client, rv.location[rv.location.rfind('/jobs/') + len('/jobs/'):])
+
+    results['items.import'] = measure(import_items, repeat, setup=write_import_file)
+
+    def explode_bom():
+        with app.test_request_context():
+            stock.update_counts(top_assembly, 1, None, 'benchmark')
+
+    results['stock.update_counts'] = measure(explode_bom, repeat)
+    return results
+
+
+def _next_serial(app):
+    """
+    Returns the serial number index after the highest serial number of the dataset
+    """
+    with app.app_context():
+        obj = app.mongo.db.items.find_one({'_id': {'$regex': r'^SN\d{8}$'}}, sort=[('_id', -1)])
+    return int(obj['_id'][2:]) + 1 if obj is not None else 0
+
+
+def _wait_job(client, job_id, timeout=600):
+    """
+    Waits until the given job is finished, raises RuntimeError if the job failed, reported an error or did not
+    finish in time
+    """
+    deadline = time.time() + timeout
+    while True:
+        data = json.loads(_check(client.get('/jobs/%s/status' % job_id)).data.decode('utf-8'))
+        errors = [message['message'] for message in data['messages'] if message['category'] == 'error']
+        if data['state'] == 'failed' or errors:
+            raise RuntimeError('job %s failed: %s' % (job_id, '; '.join(errors)))
+        if data['state'] == 'finished':
+            return
+        if time.time() > deadline:
+            raise RuntimeError('job %s did not finish in time' % job_id)
+        time.sleep(0.05)
+
+
+def _check(rv):
+    if rv.status_code >= 400:
+        raise RuntimeError('request failed with status %d' % rv.status_code)
+    return rv
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of the per-row helper functions
+
+Each benchmark reports the number of calls per second ('ops_per_sec', best of several runs) and the peak memory
+allocated during a single call ('alloc_peak_bytes', measured with tracemalloc).
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+import os
+import time
+import tempfile
+import tracemalloc
+from datetime import datetime
+from collections import OrderedDict
+from bson import ObjectId
+from bson.json_util import dumps
+from flask.ext.login import login_user
+from lpm import auth, components, items, xls_files, ext
+from benchmarks import dataset
+
+_REQUIREMENTS = dict(
+        required_fields=['param0', 'param1'],
+        date_fields=['param1'],
+        integer_fields=['param2'],
+        floating_point_fields=['param3'],
+        boolean_fields=['param4'],
+)
+_ROW = dict(serial='SN00000001', partno='BA0001a', comment='imported', param0='value', param1=datetime(2016, 1, 1),
+            param2='42', param3='4.2', param4='yes', param5=12345)
+
+
+def measure_ops(func, repeat=3, min_time=0.2):
+    """
+    Returns the statistics of func(): the best calls per second of repeat runs of at least min_time seconds each,
+    and the peak memory allocated during a single call
+    """
+    number = 1
+    while True:
+        elapsed = _time(func, number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.2))
+    best = min([elapsed] + [_time(func, number) for _ in range(repeat - 1)])
+
+    tracemalloc.start()
+    try:
+        tracemalloc.clear_traces()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(calls=number, ops_per_sec=number / best, alloc_peak_bytes=peak)
+
+
+def run(app, repeat=3, min_time=0.2, xls_rows=(1000, 10000, 100000), names=None):
+    """
+    Runs the micro-benchmarks (all or the given names) within a request context of the given app.
+    Returns the results by benchmark name
+    """
+    results = OrderedDict()
+    filepaths = list()
+    with app.test_request_context():
+        login_user(auth.get_user('admin'))
+        benchmarks = OrderedDict()
+        benchmarks['PartNumber.cached'] = lambda: components.PartNumber('BA0001a')
+        benchmarks['PartNumber.parse'] = lambda: components._parse_partno.__wrapped__('BA0001a')
+        benchmarks['items.process_requirements'] = lambda: items.process_requirements(dict(_ROW), _REQUIREMENTS)
+        benchmarks['items._check_status'] = lambda: items._check_status('BA0001a', '', 'tested')
+        documents = [dict(_id='SN%08d' % idx, partno='BA0001a', status='', available=True, created=datetime.now(),
+                          ref=ObjectId(), values=list(range(10))) for idx in range(1000)]
+        benchmarks['bson.json_util.dumps'] = lambda: dumps(documents)
+        benchmarks['ext._jsonify'] = lambda: ext._jsonify(dict(ok=True, items=documents))
+        params = dataset.Parameters(components=1000)
+        try:
+            for rows in xls_rows:
+                filepath = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False).name
+                filepaths.append(filepath)
+                if names is None or 'xls_files.read_xls.%d' % rows in names:
+                    dataset.write_items_file(filepath, params, 0, rows)
+                benchmarks['xls_files.read_xls.%d' % rows] = lambda filepath=filepath: xls_files.read_xls(filepath)
+
+            for name, func in benchmarks.items():
+                if names is None or name in names:
+                    results[name] = measure_ops(func, repeat, min_time)
+        finally:
+            for filepath in filepaths:
+                os.remove(filepath)
+    return results
+
+
+def _time(func, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return time.perf_counter() - start
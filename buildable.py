@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Buildable quantity calculation for lpm
+
+Calculates how many units of every assembly (i.e. every part number with BOM rules) can be built from the
+current stock. Building n units of an assembly requires its BOM children in the given quantities. These
+requirements are netted top-down in topological order: sub-assemblies in stock are used first, only the
+missing units are built from their own BOM children. Thus parts shared by several sub-assemblies are counted
+once for the total requirement. n units can be built if the net requirement of no plain part exceeds its stock.
+Negative stock counts are treated as zero and BOM entries with a non-positive quantity are ignored.
+
+Shared parts couple the sub-assemblies, thus the buildable quantity of an assembly cannot be derived from the
+quantities of its children. Instead, a single level-ordered pass from the leaf parts upwards calculates an upper
+bound for all assemblies at once, assuming that shared parts are available to every sub-assembly:
+    bound(a) = min over all BOM children c of (stock(c) + bound(c)) // quantity(c)
+The bound is exact unless the requirements of the assembly meet in a shared part. It is verified by netting the
+requirements of bound(a) units, and only if that fails, the buildable quantity is searched (see _Plan._buildable()).
+The netting only follows the parts whose stock does not cover their requirement, thus most checks only visit a
+small part of the BOM graph.
+
+The BOM graph is compiled once per BOM version. The results of the last calculation are kept together with the
+stock counts they are based on: only the assemblies that contain a part whose stock count changed are
+calculated again.
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+import heapq
+import threading
+import weakref
+
+_plans = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def buildable_quantities(graph, quantities):
+    """
+    Returns a dict that maps every assembly of the given BOM graph (see stock.BomGraph) to its buildable quantity.
+    The quantities dict maps part numbers to their stock count, missing part numbers are not in stock.
+    Raises RuntimeError if the BOM graph contains a loop
+    """
+    with _lock:
+        plan = _plans.get(graph)
+    if plan is None:
+        plan = _Plan(graph)
+        with _lock:
+            _plans[graph] = plan
+    return plan.evaluate(quantities)
+
+
+class _Plan:
+    """
+    The compiled BOM graph: the part numbers in topological order (as indexes into this list), the BOM children
+    and parents of every part number, the assemblies grouped by level (all children of a level's assemblies
+    belong to lower levels) and the results of the last evaluation
+    """
+
+    def __init__(self, graph):
+        self.partnos = graph.order
+        index = dict((partno, idx) for idx, partno in enumerate(self.partnos))
+        self.boms = [[(index[child], quantity) for child, quantity in graph.bom(partno) if quantity > 0]
+                     for partno in self.partnos]
+        self.parents = [list() for partno in self.partnos]
+        for idx, bom in enumerate(self.boms):
+            for child, quantity in bom:
+                self.parents[child].append(idx)
+        height = [0] * len(self.partnos)
+        levels = list()
+        for idx in reversed(range(len(self.partnos))):
+            bom = self.boms[idx]
+            if not bom:
+                continue
+            height[idx] = 1 + max(height[child] for child, quantity in bom)
+            while len(levels) < height[idx]:
+                levels.append(list())
+            levels[height[idx] - 1].append(idx)
+        self.levels = levels
+        self.assemblies = [idx for level in levels for idx in level]
+        self._last = None  # (stock, results) of the last evaluation
+
+    def evaluate(self, quantities):
+        stock = [max(quantities.get(partno) or 0, 0) for partno in self.partnos]
+        last = self._last
+        if last is None:
+            results = dict()
+            pending = set(self.assemblies)
+        else:
+            previous, results = last
+            if previous == stock:
+                return dict((self.partnos[idx], count) for idx, count in results.items())
+            results = dict(results)
+            pending = self._ancestors(idx for idx, count in enumerate(stock) if count != previous[idx])
+
+        available = list(stock)
+        for level in self.levels:
+            for idx in level:
+                bound = min(available[child] // quantity for child, quantity in self.boms[idx])
+                available[idx] += bound
+                if idx in pending:
+                    results[idx] = self._buildable(stock, idx, bound)
+        self._last = (stock, results)
+        return dict((self.partnos[idx], count) for idx, count in results.items())
+
+    def _ancestors(self, indexes):
+        """
+        Returns the assemblies that contain any of the given part numbers (indexes), including themselves
+        """
+        result = set()
+        queue = list(indexes)
+        seen = set(queue)
+        while queue:
+            idx = queue.pop()
+            if self.boms[idx]:
+                result.add(idx)
+            for parent in self.parents[idx]:
+                if parent not in seen:
+                    seen.add(parent)
+                    queue.append(parent)
+        return result
+
+    def _buildable(self, stock, root, upper):
+        """
+        Returns the buildable quantity of the given assembly, which is at most upper.
+        The net requirement of every plain part is a convex, piecewise linear function of the number of units:
+        each part adds a kink where its stock runs out. Thus the straight line between a feasible count and an
+        infeasible count lies above every requirement in between, and the count where the line reaches the stock
+        is feasible. The search interval is shrunk with these counts, and halved if the line makes little progress
+        """
+        high_required = self._requirements(stock, root, upper)
+        if self._covered(stock, high_required):
+            return upper
+        lower, low_required, high = 0, dict(), upper
+        while high - lower > 1:
+            width = high - lower
+            count = min(lower + (stock[idx] - low_required.get(idx, 0)) * (high - lower) //
+                        (required - low_required.get(idx, 0))
+                        for idx, required in high_required.items() if required > stock[idx])
+            if count + 1 == high:
+                return count
+            required = self._requirements(stock, root, count + 1)
+            if not self._covered(stock, required):
+                return count
+            lower, low_required = count + 1, required
+            if 2 * (high - lower) > width:
+                count = (lower + high) // 2
+                required = self._requirements(stock, root, count)
+                if self._covered(stock, required):
+                    lower, low_required = count, required
+                else:
+                    high, high_required = count, required
+        return lower
+
+    def _requirements(self, stock, root, count):
+        """
+        Returns a dict that maps the plain parts to their net requirement for building count units of the given
+        assembly. The part numbers are processed in topological order (as given by the indexes), such that the
+        requirement of a part is complete before it is netted. Parts in stock are not followed any further.
+        """
+        result = dict()
+        required = {root: count}
+        heap = [root]
+        while heap:
+            idx = heapq.heappop(heap)
+            if not self.boms[idx]:
+                result[idx] = required[idx]
+                continue
+            missing = required[idx] if idx == root else required[idx] - stock[idx]
+            if missing <= 0:
+                continue
+            for child, quantity in self.boms[idx]:
+                if child not in required:
+                    required[child] = 0
+                    heapq.heappush(heap, child)
+                required[child] += missing * quantity
+        return result
+
+    @staticmethod
+    def _covered(stock, required):
+        return all(count <= stock[idx] for idx, count in required.items())
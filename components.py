@@ -41,9 +41,13 @@ Note: There is no lock mechanism available, i.e. multiple users may edit the sam
 
 import re
 import os
+import threading
+from functools import lru_cache
+from collections import OrderedDict
 from datetime import datetime
 from werkzeug import secure_filename
-from flask import Blueprint, current_app, render_template, flash, abort, redirect, url_for, request, send_from_directory
+from flask import Blueprint, current_app, render_template, flash, abort, redirect, url_for, request, \
+    send_from_directory, make_response
 from flask.ext.login import login_required, current_user
 from pymongo import ReturnDocument
 from pymongo.errors import DuplicateKeyError
@@ -51,10 +55,23 @@ from flask_wtf import Form
 from wtforms import TextAreaField, StringField, SubmitField, FileField, SelectField
 from wtforms.validators import InputRequired
 from lpm.login import role_required
-from lpm.utils import extract_errors
+from lpm.utils import extract_errors, versioned, new_version, document_etag, is_conditional, not_modified, \
+    cache_headers
 
 bp = Blueprint('components', __name__)
 
+# maximum number of values per $in query
+IN_QUERY_CHUNK_SIZE = 5000
+# maximum number of parsed part numbers kept in memory
+PARTNO_CACHE_SIZE = 65536
+
+
+def init(app):
+    """
+    Creates the process-wide component name cache for the given app
+    """
+    app.component_names = NameCache(app.config.get('LPM_COMPONENT_NAME_CACHE_SIZE', 10000))
+
 
 class ComponentForm(Form):
     name = StringField(label='Name', validators=[InputRequired()])
@@ -122,6 +139,13 @@ def details(partno):
     if pn.revision is not None and not current_user.has_role('component_edit'):
         return redirect(url_for('components.details', partno=pn.base_number))
 
+    # the page depends on the user (roles) and the requested revision
+    if is_conditional():
+        stamp = current_app.mongo.db.components.find_one_or_404(pn.base_number, projection=['_version'])
+        response = not_modified(document_etag(stamp, current_user.id, pn.id))
+        if response is not None:
+            return response
+
     # ensure the object exists and the revision is valid
     obj = current_app.mongo.db.components.find_one_or_404(pn.base_number)
 
@@ -129,7 +153,7 @@ def details(partno):
     num_revisions = len(obj.get('revisions', list()))
     if pn.revision_number is not None and pn.revision_number >= num_revisions:
         abort(404)
-    pn.set_num_revisions(num_revisions)
+    pn = pn.with_num_revisions(num_revisions)
 
     files = _get_files(pn.id)
 
@@ -139,8 +163,9 @@ def details(partno):
             preview_file = file
             break
 
-    return render_template('components/details.html', data=obj,
+    page = render_template('components/details.html', data=obj,
                            partno=pn, files=files, preview_file=preview_file)
+    return cache_headers(make_response(page), document_etag(obj, current_user.id, pn.id))
 
 
 @bp.route('/<partno>/<file>')
@@ -168,7 +193,7 @@ def file(partno, file):
     assert pn.revision_number is not None
     if pn.revision_number >= num_revisions:
         abort(404)
-    pn.set_num_revisions(num_revisions)
+    pn = pn.with_num_revisions(num_revisions)
 
     if pn.is_outdated() and not current_user.has_role('component_edit'):
         abort(403)
@@ -203,7 +228,8 @@ def add():
                    obsolete=False,
                    history=[{'date': now, 'user': current_user.id, 'message': 'created'}])
         try:
-            current_app.mongo.db.components.insert(obj)
+            current_app.mongo.db.components.insert(new_version(obj))
+            current_app.component_names.invalidate(id)
             flash('component successfully created', 'success')
             return redirect(url_for('components.details', partno=id))
         except DuplicateKeyError as e:
@@ -260,7 +286,7 @@ def edit(partno):
         set_data['revisions.'+str(revidx)+'.comment'] = form.comment.data
         result = current_app.mongo.db.components.update_one(
                 filter={'_id': partno},
-                update={
+                update=versioned({
                     '$set': set_data,
                     '$push': {
                         'history': {
@@ -269,8 +295,9 @@ def edit(partno):
                             'message': 'updated',
                         }
                     }
-                }
+                })
         )
+        current_app.component_names.invalidate(partno)
         if result.modified_count == 1:
             flash('data successfully updated', 'success')
         else:
@@ -305,7 +332,7 @@ def fileupload(partno):
     num_revisions = len(obj.get('revisions', list()))
     if pn.revision_number >= num_revisions:
         abort(404)
-    pn.set_num_revisions(num_revisions)
+    pn = pn.with_num_revisions(num_revisions)
 
     if pn.is_outdated():
         flash('cannot upload files to outdated revisions', 'error')
@@ -322,6 +349,8 @@ def fileupload(partno):
                 os.makedirs(dir)
             path = os.path.join(dir, filename)
             file.save(path)
+            # the files are shown on the details page
+            current_app.mongo.db.components.update_one({'_id': pn.base_number}, versioned({}))
             flash('file successfully uploaded', 'success')
             return redirect(url_for('components.details', partno=partno))
         except Exception as e:
@@ -342,7 +371,7 @@ def new_revision(partno):
         now = datetime.now()
         result = current_app.mongo.db.components.update_one(
                 filter={'_id': partno},
-                update={
+                update=versioned({
                     '$set': {
                         'released': False  # a new revision is not already released
                     },
@@ -357,7 +386,7 @@ def new_revision(partno):
                             'message': 'new revision created'
                         }
                     }
-                }
+                })
         )
         if result.modified_count == 1:
             flash('new revision created', 'success')
@@ -381,7 +410,7 @@ def release(partno):
     if request.method == 'POST' and form.validate_on_submit():
         result = current_app.mongo.db.components.update_one(
                 filter={'_id': partno},
-                update={
+                update=versioned({
                     '$set': {
                         'released': True
                     },
@@ -392,7 +421,7 @@ def release(partno):
                             'message': 'released'
                         }
                     }
-                }
+                })
         )
         if result.modified_count == 1:
             flash('component released', 'success')
@@ -415,7 +444,7 @@ def unrelease(partno):
     if request.method == 'POST' and form.validate_on_submit():
         result = current_app.mongo.db.components.update_one(
                 filter={'_id': partno},
-                update={
+                update=versioned({
                     '$set': {
                         'released': False
                     },
@@ -426,7 +455,7 @@ def unrelease(partno):
                             'message': 'un-released'
                         }
                     }
-                }
+                })
         )
         if result.modified_count == 1:
             flash('component un-released', 'success')
@@ -450,7 +479,7 @@ def make_obsolete(partno):
     if request.method == 'POST' and form.validate_on_submit():
         result = current_app.mongo.db.components.update_one(
                 filter={'_id': partno},
-                update={
+                update=versioned({
                     '$set': {
                         'obsolete': True
                     },
@@ -461,7 +490,7 @@ def make_obsolete(partno):
                             'message': 'component obsoleted'
                         }
                     }
-                }
+                })
         )
         if result.modified_count == 1:
             flash('component obsoleted', 'success')
@@ -483,6 +512,37 @@ def ensure_exists(partno):
         raise ValueError('unknown part number %s' % partno)
 
 
+def find_existing(partnos):
+    """
+    Returns the subset of the given part numbers that exist in the database.
+    The lookup is done with as few queries as possible, use this instead of ensure_exists() in loops.
+    """
+    partnos = list(set(partnos))
+    existing = set()
+    for idx in range(0, len(partnos), IN_QUERY_CHUNK_SIZE):
+        records = current_app.mongo.db.components.find(
+                {'_id': {'$in': partnos[idx:idx+IN_QUERY_CHUNK_SIZE]}},
+                projection=['_id']
+        )
+        existing.update(record['_id'] for record in records)
+    return existing
+
+
+def get_names(partnos):
+    """
+    Returns a dict mapping the given part numbers to the component names.
+    Unknown part numbers are not contained in the result.
+    """
+    return current_app.component_names.get_names(partnos)
+
+
+def get_name(partno):
+    """
+    Returns the name of the given component, or None if the component does not exist
+    """
+    return get_names([partno]).get(partno)
+
+
 def _create_new_partno():
     """
     Creates and returns a new part number (component ID).
@@ -577,41 +637,160 @@ def _get_categories():
     return [(c, c) for c in current_app.config.get('LPM_COMPONENT_CATEGORIES', set())]
 
 
+class NameCache:
+    """
+    Bounded, thread-safe cache for component names with least-recently-used eviction.
+    Missing entries are loaded with a single query per lookup, unknown part numbers are not cached.
+    Every invalidation increments a generation counter. Loaded names are only stored if the generation did not
+    change during the query, such that a concurrent rename is not overwritten with the previous name.
+
+    Note: The cache lives in the current process. Names changed by other processes are visible
+    only after the entry has been evicted.
+    """
+
+    def __init__(self, maxsize):
+        assert maxsize > 0
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get_names(self, partnos):
+        result = dict()
+        missing = list()
+        with self._lock:
+            generation = self._generation
+            for partno in set(partnos):
+                if partno in self._data:
+                    self._data.move_to_end(partno)
+                    result[partno] = self._data[partno]
+                else:
+                    missing.append(partno)
+        if not missing:
+            return result
+
+        records = current_app.mongo.db.components.find({'_id': {'$in': missing}}, projection=['name'])
+        loaded = dict((record['_id'], record.get('name')) for record in records)
+        result.update(loaded)
+        with self._lock:
+            if self._generation != generation:
+                return result  # the loaded names may be outdated already
+            self._data.update(loaded)
+            for partno in loaded:
+                self._data.move_to_end(partno)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+        return result
+
+    def invalidate(self, partno):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(partno, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+
 class PartNumber:
     """
-    Class that encapsulates parsing and revision handling of part numbers
+    Class that encapsulates parsing and revision handling of part numbers.
+    Instances are immutable and shared: PartNumber(partno) returns the cached instance for recently parsed
+    part numbers. Use with_num_revisions() to get a view that considers the number of existing revisions.
     """
 
+    __slots__ = ('_id', '_baseno', '_rev')
+
     pattern = re.compile('^([A-Z]+\d{4})([a-z])?$')
 
-    def __init__(self, partno):
-        match = PartNumber.pattern.match(partno)
-        if not match:
-            raise ValueError("string '%s' is not a valid part number" % str)
-        self._baseno = match.group(1)
-        self._rev = match.group(2)
-        self._num_revisions = None
+    def __new__(cls, partno):
+        return _parse_partno(partno)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('part numbers are immutable')
+
+    def __reduce__(self):
+        return PartNumber, (self._id,)
 
-    def set_num_revisions(self, num_revisions):
+    def with_num_revisions(self, num_revisions):
         """
-        Sets the number of revisions and assigns the latest revision if the revision has not been already set.
-        The number of revisions must be > 0
+        Returns a view that uses the given number of revisions, which assigns the latest revision if the revision
+        has not been set. The number of revisions must be > 0
         """
+        return RevisionedPartNumber(self, num_revisions)
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def base_number(self):
+        return self._baseno
+
+    @property
+    def revision(self):
+        return self._rev
+
+    @property
+    def revision_number(self):
+        return None if self._rev is None else ord(self._rev) - ord('a')
+
+    @classmethod
+    def revision_repr(cls, revision):
+        return chr(revision + ord('a'))
+
+    def revision_id(self, revision):
+        return self._baseno + PartNumber.revision_repr(revision)
+
+    def __eq__(self, other):
+        return isinstance(other, PartNumber) and self._id == other._id
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(self._id)
+
+    def __repr__(self):
+        return self._id
+
+
+@lru_cache(maxsize=PARTNO_CACHE_SIZE)
+def _parse_partno(partno):
+    match = PartNumber.pattern.match(partno)
+    if not match:
+        raise ValueError("string '%s' is not a valid part number" % partno)
+    obj = object.__new__(PartNumber)
+    object.__setattr__(obj, '_id', partno)
+    object.__setattr__(obj, '_baseno', match.group(1))
+    object.__setattr__(obj, '_rev', match.group(2))
+    return obj
+
+
+class RevisionedPartNumber:
+    """
+    View on a part number that considers the number of existing revisions.
+    The latest revision is assigned if the part number does not specify a revision.
+    """
+
+    __slots__ = ('_partno', '_num_revisions', '_rev')
+
+    def __init__(self, partno, num_revisions):
         assert num_revisions > 0
+        self._partno = partno
         self._num_revisions = num_revisions
+        self._rev = partno.revision
         if self._rev is None:
             self._rev = PartNumber.revision_repr(num_revisions-1)
 
     @property
     def id(self):
-        v = self._baseno
-        if self._rev is not None:
-            v += self._rev
-        return v
+        return self._partno.base_number + self._rev
 
     @property
     def base_number(self):
-        return self._baseno
+        return self._partno.base_number
 
     @property
     def revision(self):
@@ -619,22 +798,24 @@ class PartNumber:
 
     @property
     def revision_number(self):
-        return None if self._rev is None else ord(self._rev) - ord('a')
+        return ord(self._rev) - ord('a')
+
+    @property
+    def num_revisions(self):
+        return self._num_revisions
 
     def is_outdated(self):
         """
-        Returns whether the given revision is outdated. The number of revisions must have been set previously
+        Returns whether the given revision is outdated
         """
-        assert self._num_revisions is not None
-        assert self._rev is not None
         return self._num_revisions > self.revision_number+1
 
     @classmethod
     def revision_repr(cls, revision):
-        return chr(revision + ord('a'))
+        return PartNumber.revision_repr(revision)
 
     def revision_id(self, revision):
-        return self._baseno + PartNumber.revision_repr(revision)
+        return self._partno.revision_id(revision)
 
     def __repr__(self):
         return self.id
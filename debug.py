@@ -3,28 +3,59 @@
 Debug module for lpm
 
 This module allows to modify the raw database document in JSON format.
+It also lists the endpoints that issue the most database commands (see the profiling module).
 
 :copyright: (c) 2016 Hannes Friederich.
 :license: BSD, see LICENSE for more details.
 """
 
+from datetime import datetime
 from flask import Blueprint, current_app, request, flash, render_template, abort
 from flask.ext.pymongo import ObjectId
 from flask_wtf import Form
 from wtforms import TextAreaField, SubmitField
 from wtforms.validators import InputRequired
-from bson.json_util import dumps, loads
+from bson.json_util import loads
 from lpm.login import role_required
+from lpm.serialization import dumps
 from lpm.utils import extract_errors
+from lpm.stock import invalidate_bom_graph, update_bom_closure
 
 bp = Blueprint('debug', __name__)
 
+_PROFILE_KEYS = ('duration', 'count', 'max_duration', 'max_count', 'avg_duration', 'avg_count')
+
+
+class ResetForm(Form):
+    pass
+
 
 class DebugForm(Form):
     # TODO: JSON validator?
     document = TextAreaField(label='Document', validators=[InputRequired()])
 
 
+@bp.route('/profile', methods=['GET', 'POST'])
+@role_required('db_debug')
+def profile():
+    """
+    Lists the endpoints with the most MongoDB commands or the longest database time.
+    The sort order is selected with the 'sort' parameter, a POST request resets the statistics.
+    """
+    form = ResetForm(request.form)
+    stats = getattr(current_app, 'db_profile', None)
+    if stats is None:
+        flash('database profiling is disabled', 'error')
+        return render_template('debug/profile.html', form=form, entries=list(), sort=None)
+    if request.method == 'POST' and form.validate_on_submit():
+        stats.clear()
+        flash('statistics reset', 'success')
+    sort = request.args.get('sort', 'duration')
+    if sort not in _PROFILE_KEYS:
+        sort = 'duration'
+    return render_template('debug/profile.html', form=form, entries=stats.top(sort), sort=sort)
+
+
 @bp.route('/<collection>/<id>', methods=['GET', 'POST'])
 @role_required('db_debug')
 def debug(collection, id):
@@ -36,15 +67,32 @@ def debug(collection, id):
                 obj = current_app.mongo.db[collection].find_one_or_404(id)
             except:
                 abort(404)
+        version = obj.get('_version')
         obj = dumps(obj, indent=2)  # transform to pretty JSON
         form = DebugForm(request.form, data=dict(document=obj))
         if request.method == 'POST' and form.validate_on_submit():
             try:
                 new_obj = loads(form.document.data)
+                filter = {'_id': id}
+                if collection in ('items', 'components', 'stock'):
+                    # the edit is based on the stored version, a stale form must not move the version backwards
+                    if new_obj.get('_version') != version:
+                        raise ValueError('the document was modified in the meantime, please reload it')
+                    filter['_version'] = version
+                    new_obj['_version'] = (version or 0) + 1
+                    new_obj['_modified'] = datetime.utcnow()
+                if collection == 'stock':
+                    # raises RuntimeError if the edited BOM closes a loop
+                    current_app.bom_cache.get().with_bom(id, new_obj.get('bom') or list()).check_acyclic()
                 result = current_app.mongo.db[collection].find_one_and_replace(
-                        filter={'_id': id},
+                        filter=filter,
                         replacement=new_obj
                 )
+                if collection == 'components':
+                    current_app.component_names.invalidate(id)
+                elif collection == 'stock':
+                    invalidate_bom_graph(current_app.mongo.db)
+                    update_bom_closure(current_app.mongo.db, id, current_app.bom_cache.get())
                 if result:
                     flash('data successfully updated', 'success')
                     obj = current_app.mongo.db[collection].find_one_or_404(id)
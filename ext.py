@@ -4,57 +4,296 @@ External Tools API for lpm
 
 External tools (e.g. scripts) may access the database through this interface.
 It is possible to run a filter on the items collection, get item data in JSON format, and modify items.
+The buildable quantities of all assemblies can be retrieved as well.
 
 :copyright: (c) 2016 Hannes Friederich.
 :license: BSD, see LICENSE for more details.
 """
 
 from datetime import datetime
-from flask import Blueprint, request, current_app
+from collections import OrderedDict, Counter
+from flask import Blueprint, request, current_app, stream_with_context
 from flask.ext.login import login_required, current_user
-from bson.json_util import loads, dumps
-from lpm.components import PartNumber
-from lpm.items import create_comment, do_update_status
+from werkzeug.exceptions import HTTPException
+from flask.ext.pymongo import ObjectId
+from bson.json_util import loads
+from lpm.serialization import dumps, response, negotiate
+from lpm.utils import versioned, document_etag, is_conditional, not_modified, cache_headers
+from lpm.components import PartNumber, IN_QUERY_CHUNK_SIZE
+from lpm.buildable import buildable_quantities
+from lpm.items import create_comment, prepare_status_update, do_bulk_update_status, \
+    add_comments, add_bulk_comments, get_comments, select_serials, apply_updates
 
 bp = Blueprint('ext', __name__)
 
+_COMMENTS_LIMIT = 100
+_MAX_COMMENTS_LIMIT = 1000
+_MAX_MULTI_GET = 50000
+_MAX_BULK_UPDATES = 10000
+
 
 @bp.route('/items', methods=['POST'])
 @login_required
 def item_filter():
     """
-    Returns a list of serial numbers that fit the given filter
+    Returns a sorted list of serial numbers that fit the given filter
     Mandatory fields:
     'filter': SON object representing the filter expression
+    Optional fields:
+    'limit': the maximum number of returned serial numbers
+    'after': only return serial numbers sorted after the given one (i.e. the last one of the previous page)
+    'format': if 'ndjson', the serial numbers are streamed as newline-delimited JSON strings instead
     The returned JSON object contains the following fields:
     'ok': a boolean flag denoting the success of the operation
     'message': An error message if the operation was not successful
     'serials': a list of item serial numbers matching the filter
+    'next': the value for the 'after' field to get the next page, null if there are no more serial numbers
     """
     ok = False
     message = ''
     serials = list()
+    next = None
     try:
         filter = request.form.get('filter')
         if not filter:
             raise ValueError('missing filter')
         filter = loads(filter)
-        items = list(current_app.mongo.db.items.find(filter, projection=['_id']))
-        serials = sorted([item.get('_id') for item in items])  # return a sorted list of serial numbers
+        after = request.form.get('after')
+        if after:
+            filter = {'$and': [filter, {'_id': {'$gt': after}}]}
+        limit = int(request.form.get('limit', 0))
+        if limit < 0:
+            raise ValueError('limit must not be negative')
+        # the _id index provides the sort order
+        cursor = current_app.mongo.db.items.find(filter, projection=['_id'], sort=[('_id', 1)],
+                                                 limit=limit+1 if limit else 0)
+        if request.form.get('format') == 'ndjson':
+            return _stream_serials(cursor, limit)
+        serials = [item.get('_id') for item in cursor]
+        if limit and len(serials) > limit:
+            serials.pop()
+            next = serials[-1]
         ok = True
     except Exception as e:
         message = str(e)
-    return _jsonify(dict(ok=ok, message=message, serials=serials))
+    return _jsonify(dict(ok=ok, message=message, serials=serials, next=next))
 
 
 @bp.route('/items/<serial>')
 @login_required
 def item_info(serial):
     """
-    Returns the JSON formatted object with the given serial number
+    Returns the JSON formatted object with the given serial number.
+    Supports conditional requests (If-None-Match and If-Modified-Since).
+    """
+    if is_conditional():
+        stamp = current_app.mongo.db.items.find_one_or_404(serial, projection=['_version', '_modified'])
+        rv = not_modified(document_etag(stamp, negotiate()), stamp.get('_modified'))
+        if rv is not None:
+            return rv
+    obj = current_app.mongo.db.items.find_one_or_404(serial, projection={'comments': False})
+    return cache_headers(_jsonify(obj), document_etag(obj, negotiate()), obj.get('_modified'))
+
+
+@bp.route('/items/get', methods=['POST'])
+@login_required
+def item_multi_info():
+    """
+    Returns the JSON formatted objects with the given serial numbers
+    Mandatory fields:
+    'serials': JSON list of serial numbers
+    Optional fields:
+    'fields': JSON list of the keys to return (the '_id' key is always returned)
+    'format': if 'ndjson', the objects are streamed as newline-delimited JSON instead
+    The returned JSON object contains the following fields:
+    'ok': a boolean flag denoting the success of the operation
+    'message': An error message if the operation was not successful
+    'items': the list of found objects, in the order of the given serial numbers
+    'missing': the list of serial numbers that do not exist
+    """
+    ok = False
+    message = ''
+    items = list()
+    missing = list()
+    try:
+        serials = request.form.get('serials')
+        if not serials:
+            raise ValueError('missing serials')
+        serials = loads(serials)
+        if not isinstance(serials, list):
+            raise ValueError('serials must be a list')
+        if len(serials) > _MAX_MULTI_GET:
+            raise ValueError('at most %d serial numbers can be requested at once' % _MAX_MULTI_GET)
+        fields = request.form.get('fields')
+        if fields:
+            projection = loads(fields)
+            if not isinstance(projection, list):
+                raise ValueError('fields must be a list')
+        else:
+            projection = {'comments': False}
+        chunks = _find_items(serials, projection)
+        if request.form.get('format') == 'ndjson':
+            def generate():
+                for chunk in chunks:
+                    for item in chunk:
+                        yield dumps(item) + '\n'
+            return current_app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+        found = dict()
+        for chunk in chunks:
+            found.update((item.get('_id'), item) for item in chunk)
+        for serial in serials:
+            if serial in found:
+                items.append(found[serial])
+            else:
+                missing.append(serial)
+        ok = True
+    except Exception as e:
+        message = str(e)
+    return _jsonify(dict(ok=ok, message=message, items=items, missing=missing))
+
+
+@bp.route('/items/<serial>/comments')
+@login_required
+def item_comments(serial):
+    """
+    Returns the comments of the item with the given serial number in the order they were added
+    Optional parameters:
+    'limit': the maximum number of returned comments (default: 100)
+    'after': the ID of the last comment of the previous page
+    The returned JSON object contains the following fields:
+    'ok': a boolean flag denoting the success of the operation
+    'message': An error message if the operation was not successful
+    'comments': a list of comments, including the comment ID
+    """
+    current_app.mongo.db.items.find_one_or_404(serial, projection=['_id'])
+    ok = False
+    message = ''
+    comments = list()
+    try:
+        limit = int(request.args.get('limit', _COMMENTS_LIMIT))
+        if limit <= 0 or limit > _MAX_COMMENTS_LIMIT:
+            raise ValueError('limit must be between 1 and %d' % _MAX_COMMENTS_LIMIT)
+        after = request.args.get('after')
+        after = ObjectId(after) if after else None
+        comments = get_comments(serial, limit=limit, after=after)
+        ok = True
+    except Exception as e:
+        message = str(e)
+    return _jsonify(dict(ok=ok, message=message, comments=comments))
+
+
+@bp.route('/items/update-status', methods=['POST'])
+@login_required
+def update_status():
+    """
+    Changes the status of multiple items at once.
+    Mandatory fields:
+    'status': the new status
+    'serials' or 'filter': JSON list of serial numbers, or SON object representing a filter expression on the items
+    (the filter may select at most MAX_FILTER_SERIALS items, see the items module)
+    Optional fields:
+    'project': if present, sets the project association
+    'comment': if present, adds a comment to the items
+    The returned JSON object contains the following fields:
+    'ok': a boolean flag denoting the success of the operation for all items
+    'message': An error message if the operation was not successful
+    'results': an object mapping each serial number to null if successful or to an error message otherwise
+    """
+    ok = False
+    message = ''
+    results = dict()
+    try:
+        status = request.form.get('status')
+        if not status:
+            raise ValueError('missing status')
+        serials = request.form.get('serials')
+        filter = request.form.get('filter')
+        if serials:
+            serials = loads(serials)
+            if not isinstance(serials, list):
+                raise ValueError('serials must be a list')
+        elif filter:
+            serials = select_serials(loads(filter))
+        else:
+            raise ValueError('missing serials or filter')
+        results = do_bulk_update_status(serials, status, request.form.get('project'), request.form.get('comment'))
+        ok = all(result is None for result in results.values())
+        if not ok:
+            message = 'not all items were updated'
+    except Exception as e:
+        message = str(e)
+    return _jsonify(dict(ok=ok, message=message, results=results))
+
+
+@bp.route('/items/bulk-update', methods=['POST'])
+@login_required
+def bulk_update():
+    """
+    Updates multiple items in the database with a single bulk operation.
+    Mandatory fields:
+    'updates': JSON list of update descriptors. Each descriptor contains the 'serial' key and the
+    optional 'set', 'update', 'push', 'status' and 'comment' keys (see update_item())
+    All descriptors are validated first, the valid updates are then applied independently of each other.
+    An update fails if the item was modified concurrently (see _prepare_update()) or does not exist anymore.
+    The returned JSON object contains the following fields:
+    'ok': a boolean flag denoting the success of the operation for all items
+    'message': An error message if the operation was not successful
+    'results': an object mapping each serial number to null if successful or to an error message otherwise
     """
-    obj = current_app.mongo.db.items.find_one_or_404(serial)
-    return _jsonify(obj)
+    ok = False
+    message = ''
+    results = OrderedDict()
+    try:
+        updates = request.form.get('updates')
+        if not updates:
+            raise ValueError('missing updates')
+        updates = loads(updates)
+        if not isinstance(updates, list) or not all(isinstance(u, dict) and 'serial' in u for u in updates):
+            raise ValueError('updates must be a list of objects with a serial number')
+        if len(updates) > _MAX_BULK_UPDATES:
+            raise ValueError('at most %d items can be updated at once' % _MAX_BULK_UPDATES)
+
+        # load the keys required for the validation of all items at once
+        projection = {'partno', 'status'}
+        for descriptor in updates:
+            projection.update((descriptor.get('set') or dict()).keys())
+        serials = [descriptor['serial'] for descriptor in updates]
+        items = dict()
+        for chunk in _find_items(serials, list(projection)):
+            items.update((item.get('_id'), item) for item in chunk)
+
+        now = datetime.now()
+        requests = list()
+        comments = dict()
+        counts = Counter(serials)
+        for descriptor in updates:
+            serial = descriptor['serial']
+            if serial in results:
+                continue  # duplicate
+            try:
+                if counts[serial] > 1:
+                    raise ValueError('multiple updates for the same serial number')
+                item = items.get(serial)
+                if item is None:
+                    raise ValueError("unknown serial number '%s'" % serial)
+                filter, document, comments[serial] = _prepare_update(item, descriptor, now)
+                if document or comments[serial]:
+                    requests.append((filter, versioned(document)))
+                results[serial] = None
+            except Exception as e:
+                results[serial] = str(e)
+
+        # the results are exact per item, items deleted in the meantime are not re-created (see apply_updates())
+        for (filter, document), result in zip(requests, apply_updates(requests)):
+            results[filter['_id']] = result
+
+        add_bulk_comments((serial, comments[serial]) for serial, result in results.items() if result is None)
+        ok = all(result is None for result in results.values())
+        if not ok:
+            message = 'not all items were updated'
+    except Exception as e:
+        message = str(e)
+    return _jsonify(dict(ok=ok, message=message, results=results))
 
 
 @bp.route('/items/update/<serial>', methods=['POST'])
@@ -67,11 +306,12 @@ def update_item(serial):
     'update': JSON object with data to modify. The keys must be in the
     'push': JSON object with data to push to arrays
     'status': if present, changes the status to the given string.
-    'comment': if present, pushes to the comments array
+    'comment': if present, adds a comment to the item
+    The status, set and push data are applied with a single conditional update, i.e. either all or none
+    of the changes are made.
     Returns the success of the operation in the JSON reply ('ok' field)
     """
 
-    item = current_app.mongo.db.items.find_one_or_404(serial)
     ok = False
     message = ''
     now = datetime.now()
@@ -80,23 +320,107 @@ def update_item(serial):
         setdata = request.form.get('set')
         updatedata = request.form.get('update')
         pushdata = request.form.get('push')
-        status = request.form.get('status')
-        comment = request.form.get('comment')
+        descriptor = dict(
+            set=loads(setdata) if setdata else dict(),
+            update=loads(updatedata) if updatedata else dict(),
+            push=loads(pushdata) if pushdata else dict(),
+            status=request.form.get('status'),
+            comment=request.form.get('comment')
+        )
+
+        # The part number and the current status are only required to validate updated keys and
+        # status transitions. The keys to set are checked within the update filter.
+        if descriptor['update'] or descriptor['status']:
+            item = current_app.mongo.db.items.find_one_or_404(serial, projection=['partno', 'status'])
+        else:
+            item = {'_id': serial}
+        filter, document, comments = _prepare_update(item, descriptor, now)
+
+        # a single conditional update for the status, set and push data, which also increments the version
+        if document or comments:
+            result = current_app.mongo.db.items.update_one(filter, versioned(document))
+            if result.matched_count != 1:
+                _raise_update_conflict(filter)
+        elif 'partno' not in item:
+            current_app.mongo.db.items.find_one_or_404(serial, projection=['_id'])
+        add_comments(serial, comments)
+        ok = True
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        message = str(e)
+    return _jsonify(dict(ok=ok, message=message))
+
+
+@bp.route('/stock/buildable')
+@login_required
+def stock_buildable():
+    """
+    Returns the number of units of every assembly that can be built from the current stock (see the buildable module)
+    Optional fields:
+    'partno': only return the given part numbers (may be given several times), null for unknown part numbers
+    The returned JSON object contains the following fields:
+    'ok': a boolean flag denoting the success of the operation
+    'message': An error message if the operation was not successful
+    'buildable': an object that maps the assembly part numbers to their buildable quantity
+    """
+    ok = False
+    message = ''
+    result = dict()
+    try:
+        quantities = dict((obj['_id'], obj.get('quantity'))
+                          for obj in current_app.mongo.db.stock.find(projection=['quantity']))
+        result = buildable_quantities(current_app.bom_cache.get(), quantities)
+        partnos = request.args.getlist('partno')
+        if partnos:
+            result = dict((partno, result.get(partno)) for partno in partnos)
+        ok = True
+    except Exception as e:
+        message = str(e)
+    return _jsonify(dict(ok=ok, message=message, buildable=result))
 
-        partno = PartNumber(item.get('partno'))
 
-        # data transformations
-        setdata = loads(setdata) if setdata else dict()
-        updatedata = loads(updatedata) if updatedata else dict()
-        pushdata = loads(pushdata) if pushdata else dict()
-        comments = [create_comment(comment, now)] if comment else []
+def _raise_update_conflict(filter):
+    """
+    Determines why the conditional update with the given filter did not match the item and raises
+    the corresponding exception. Aborts with 404 if the item does not exist.
+    """
+    keys = [key for key in filter.keys() if key != '_id']
+    item = current_app.mongo.db.items.find_one_or_404(filter['_id'], projection=keys or ['_id'])
+    if 'status' in filter and item.get('status') != filter['status']:
+        raise ValueError('the status was modified concurrently')
+    for key in keys:
+        if key != 'status' and item.get(key) is not None:
+            raise ValueError("operation would overwrite existing entry '%s'" % str(key))
+    raise RuntimeError('item update failed, please contact the administrator')
+
+
+def _prepare_update(item, descriptor, now):
+    """
+    Validates the update descriptor (see update_item()) for the given item.
+    The item must contain the 'partno' key if keys are updated and the 'status' key if the status changes.
+    Keys to set that are present in the item are rejected right away, the others are checked by the filter.
+    Returns the tuple (filter, document, comments), where the filter ensures that the item is only modified
+    if the status did not change in the meantime and the keys to set are still absent.
+    Raises ValueError if the update is not permitted
+    """
+    setdata = dict(descriptor.get('set') or dict())
+    updatedata = descriptor.get('update') or dict()
+    pushdata = dict(descriptor.get('push') or dict())
+    status = descriptor.get('status')
+    comment = descriptor.get('comment')
+    filter = {'_id': item.get('_id')}
 
-        # ensure setdata does not overwrite any existing entries
-        for key in setdata.keys():
-            if item.get(key) is not None:
-                raise ValueError("operation would overwrite existing entry '%s'" % str(key))
+    # ensure setdata does not overwrite any existing entries
+    for key in setdata.keys():
+        if item.get(key) is not None:
+            raise ValueError("operation would overwrite existing entry '%s'" % str(key))
+        filter[key] = None
 
-        # ensure updatedata contains only accepted keys
+    # ensure updatedata contains only accepted keys
+    if updatedata:
+        partno = PartNumber(item.get('partno'))
         updatemap = current_app.config['LPM_EXT_UPDATE_FIELDS']
         updatefields = updatemap.get(partno.id) or updatemap.get(partno.base_number) or \
                        updatemap.get('default') or set()
@@ -104,31 +428,47 @@ def update_item(serial):
             if not key in updatefields:
                 raise ValueError("No permission to update key '%s'" % key)
         setdata.update(updatedata)
+    if 'comments' in setdata or 'comments' in pushdata:
+        raise ValueError("reserved key 'comments'")
 
-        # status handling
-        if status:
-            do_update_status(item, status, now=now)
-
-        # prepare the update document
-        document = {}
-        if len(comments) > 0:
-            pushdata['comments'] = {'$each': comments}
-        if len(setdata) > 0:
-            document['$set'] = setdata
-        if pushdata:
-            document['$push'] = pushdata
-
-        # only perform a DB transaction if the document is not empty.
-        if len(document) > 0:
-            result = current_app.mongo.db.items.update_one({'_id': serial}, document)
-            if result.modified_count != 1:
-                raise RuntimeError('status update failed, please contact the administrator')
-        ok = True
+    comments = [create_comment(comment, now)] if comment else []
+    if status:
+        statusdata, statuscomments = prepare_status_update(item, status, now=now)
+        setdata.update(statusdata)
+        comments = statuscomments + comments
+        filter['status'] = item.get('status')
 
-    except Exception as e:
-        message = str(e)
-    return _jsonify(dict(ok=ok, message=message))
+    document = {}
+    if len(setdata) > 0:
+        document['$set'] = setdata
+    if pushdata:
+        document['$push'] = pushdata
+    return filter, document, comments
+
+
+def _find_items(serials, projection):
+    """
+    Generator that looks up the given serial numbers in chunks and yields the list of found objects per chunk
+    """
+    for idx in range(0, len(serials), IN_QUERY_CHUNK_SIZE):
+        yield list(current_app.mongo.db.items.find(
+                {'_id': {'$in': serials[idx:idx+IN_QUERY_CHUNK_SIZE]}},
+                projection=projection
+        ))
+
+
+def _stream_serials(cursor, limit):
+    """
+    Returns a response which streams the serial numbers from the given cursor as newline-delimited JSON.
+    Only the first limit serials are sent if limit is not 0.
+    """
+    def generate():
+        for idx, item in enumerate(cursor):
+            if limit and idx >= limit:
+                break
+            yield dumps(item.get('_id')) + '\n'
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 def _jsonify(obj):
-    return current_app.response_class(dumps(obj), mimetype='application/json')
+    return response(obj)
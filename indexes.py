@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Index registry for lpm
+
+All database indexes are declared in the INDEXES dict below, which maps each collection to its list of
+pymongo IndexModel objects. The indexes are created idempotently by apply(), either upon lpm.init
+(unless the LPM_CREATE_INDEXES configuration entry is False) or with the manage-indexes.py script.
+
+check() reports the drift between the declared and the actual indexes:
+- 'missing': a declared index does not exist
+- 'different': an index with the declared name exists, but with different keys or options
+- 'undeclared': an existing index is not declared (the default _id index is ignored)
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+from pymongo import IndexModel, ASCENDING
+from pymongo.errors import OperationFailure
+
+INDEXES = {
+    'items': [
+        # overview page and status filters only consider available items
+        IndexModel([('available', ASCENDING), ('partno', ASCENDING)]),
+        IndexModel([('available', ASCENDING), ('_id', ASCENDING)]),
+        # prefix search of the overview table ($or clauses on serial, partno, status and project)
+        IndexModel([('available', ASCENDING), ('status', ASCENDING)]),
+        IndexModel([('available', ASCENDING), ('project', ASCENDING)]),
+        # the same search including the unavailable items (show_all): every $or clause needs its own index
+        IndexModel([('partno', ASCENDING)]),
+        IndexModel([('status', ASCENDING)]),
+        IndexModel([('project', ASCENDING)]),
+        IndexModel([('partno', ASCENDING), ('status', ASCENDING)],
+                   name='partno_1_status_1_available', partialFilterExpression={'available': True}),
+    ],
+    'item_comments': [
+        IndexModel([('serial', ASCENDING), ('_id', ASCENDING)]),
+    ],
+    'components': [
+        # only the active components are listed by default
+        IndexModel([('obsolete', ASCENDING)]),
+    ],
+    'stock_history': [
+        IndexModel([('partno', ASCENDING), ('date', ASCENDING)]),
+    ],
+    'stock_batches': [
+        # batch upserts must not create duplicates
+        IndexModel([('partno', ASCENDING), ('name', ASCENDING)], unique=True),
+    ],
+    'bom_closure': [
+        # explosion and where-used lookups
+        IndexModel([('ancestor', ASCENDING), ('descendant', ASCENDING)], unique=True),
+        IndexModel([('descendant', ASCENDING), ('ancestor', ASCENDING)]),
+    ],
+    'jobs': [
+        # orphaned job detection
+        IndexModel([('state', ASCENDING), ('heartbeat', ASCENDING)]),
+    ],
+    'job_rows': [
+        IndexModel([('job', ASCENDING), ('row', ASCENDING)]),
+    ],
+    'metrics': [
+        # snapshots of terminated processes
+        IndexModel([('updated', ASCENDING)], expireAfterSeconds=3600),
+    ],
+}
+
+# index options that are compared by check()
+_OPTIONS = ('unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds')
+
+
+def init(app):
+    """
+    Creates the declared indexes in the database of the given app and logs any drift
+    """
+    if not app.config.get('LPM_CREATE_INDEXES', True):
+        return
+    with app.app_context():
+        for collection, name, problem in apply(app.mongo.db):
+            app.logger.warning("index drift in collection '%s': %s index '%s'" % (collection, problem, name))
+
+
+def apply(db, collections=None):
+    """
+    Creates the declared indexes that do not exist yet in the given database.
+    Only the given collections are considered, or all collections if None.
+    Indexes that exist with different keys or options are not modified.
+    Returns the remaining drift (see check())
+    """
+    for collection, name, problem in check(db, collections):
+        if problem != 'missing':
+            continue
+        try:
+            db[collection].create_indexes([_declared(collection)[name]])
+        except OperationFailure:
+            pass  # e.g. duplicate keys for unique indexes, remains reported as missing
+    return check(db, collections)
+
+
+def check(db, collections=None):
+    """
+    Compares the declared with the actual indexes in the given database.
+    Only the given collections are considered, or all collections if None.
+    Returns a list of (collection, index name, problem) tuples, where problem is
+    'missing', 'different' or 'undeclared'
+    """
+    drift = list()
+    for collection in sorted(collections or INDEXES.keys()):
+        declared = _declared(collection)
+        actual = db[collection].index_information()
+        for name, model in declared.items():
+            if name not in actual:
+                drift.append((collection, name, 'missing'))
+            elif _normalize(model.document) != _normalize(actual[name]):
+                drift.append((collection, name, 'different'))
+        for name in sorted(actual.keys()):
+            if name != '_id_' and name not in declared:
+                drift.append((collection, name, 'undeclared'))
+    return drift
+
+
+def _declared(collection):
+    return dict((model.document['name'], model) for model in INDEXES.get(collection, list()))
+
+
+def _normalize(spec):
+    """
+    Returns a comparable representation of the given index specification.
+    The keys are either a SON document (declaration) or a list of tuples (index_information())
+    """
+    keys = spec['key']
+    if hasattr(keys, 'items'):
+        keys = keys.items()
+    keys = [(key, int(direction) if isinstance(direction, (int, float)) else direction) for key, direction in keys]
+    options = dict((option, spec[option]) for option in _OPTIONS if spec.get(option))
+    return keys, options
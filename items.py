@@ -9,7 +9,9 @@ An item consists of
 - a project association (optional)
 - a status
 - a 'available' flag (true/false)
-- a list of comments
+
+The comments of an item are stored in the separate item_comments collection, since their number is unbounded.
+Each comment consists of the serial number of the item, the user, the date and the message.
 
 For each part number, a custom view may be defined through the LPM_ITEM_VIEW_MAP config entry.
 Additional required fields for a part number may be defined through the LPM_ITEM_IMPORT_MAP config entry.
@@ -27,21 +29,48 @@ The rules of access are as follows:
 :license: BSD, see LICENSE for more details.
 """
 
+import re
 from datetime import datetime
-from collections import defaultdict
-from flask import Blueprint, request, current_app, flash, url_for, redirect, render_template
+from collections import defaultdict, OrderedDict
+from flask import Blueprint, request, current_app, flash, url_for, redirect, render_template, jsonify, \
+    make_response
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from bson import ObjectId
 from flask.ext.login import login_required, current_user
 from flask_wtf import Form
 from wtforms import TextAreaField, StringField, SubmitField
 from wtforms.validators import InputRequired
 from lpm.login import role_required
-from lpm.utils import extract_errors
-from lpm.components import ensure_exists, PartNumber
-from lpm.stock import update_batch, update_counts
-from lpm.xls_files import FileForm, read_xls, save_to_tmp, extract_filepath
+from lpm.jobs import submit as submit_job, report_progress, report_row
+from lpm.indexes import apply as apply_indexes
+from lpm.utils import extract_errors, versioned, new_version, document_etag, is_conditional, not_modified, \
+    cache_headers
+from lpm.components import find_existing, get_names, get_name, PartNumber, IN_QUERY_CHUNK_SIZE
+from lpm.stock import update_batches, update_counts
+from lpm.xls_files import FileForm, read_xls, save_to_tmp, import_cached
 
 bp = Blueprint('items', __name__)
 
+# database keys of the overview table columns, None for columns that cannot be sorted
+_OVERVIEW_COLUMNS = ['_id', None, 'partno', 'status', 'available']
+_MAX_PAGE_LENGTH = 1000
+# maximum number of items a bulk status change filter may select
+MAX_FILTER_SERIALS = 10000
+_INSERT_CHUNK_SIZE = 1000
+# maximum number of part numbers whose status definition is memoized
+_MAX_RESOLVED_PARTNOS = 10000
+# number of comments shown per page on the details page
+COMMENTS_PAGE_SIZE = 50
+
+
+def init(app):
+    """
+    Compiles the item status map of the given app.
+    Raises ValueError if the map definition is invalid
+    """
+    app.item_status_map = StatusMap(app.config.get('LPM_ITEM_STATUS_MAP', dict()))
+
 
 class CommentForm(Form):
     message = TextAreaField(label='Message', validators=[InputRequired()])
@@ -57,50 +86,126 @@ class ProjectForm(Form):
     project = StringField(label='Project', validators=[InputRequired()])
 
 
+class BulkStatusForm(Form):
+    serials = TextAreaField(label='Serial Numbers')
+    partno = StringField(label='Part Number')
+    current_status = StringField(label='Current Status')
+    status = StringField(label='New Status', validators=[InputRequired()])
+    project = StringField(label='Project')
+    comment = TextAreaField(label='Comment')
+
+
 @bp.route('/')
 @login_required
 def overview():
     """
-    Shows the overview page with all items of the database
+    Shows the overview page. The table data is loaded page by page through overview_data()
+    """
+    return render_template('items/overview.html', show_all=request.args.get('show_all'))
+
+
+@bp.route('/data')
+@login_required
+def overview_data():
+    """
+    Server-side processing endpoint for the items overview table (DataTables protocol).
+    Paging, sorting and searching are done in the database, only the requested page is returned.
+    Accepted parameters:
+    'draw': request counter, returned unmodified
+    'start', 'length': offset and size of the requested page
+    'search[value]': case-sensitive prefix search on serial, part number, status and project
+                     (unlike the substring search of client-side DataTables)
+    'order[0][column]', 'order[0][dir]': sort column index and direction
+    'show_all': also include unavailable items
     """
-    filter = {'available': True}
-    if request.args.get('show_all'):
-        filter = None
-    objects = list(current_app.mongo.db.items.find(
+    draw = request.args.get('draw', 0, type=int)
+    start = max(request.args.get('start', 0, type=int), 0)
+    length = request.args.get('length', 10, type=int)
+    if length <= 0 or length > _MAX_PAGE_LENGTH:  # a zero limit would return all items
+        length = _MAX_PAGE_LENGTH
+
+    base_filter = {} if request.args.get('show_all') else {'available': True}
+    filter = dict(base_filter)
+    search = request.args.get('search[value]', '').strip()
+    if search:
+        # anchored, case-sensitive prefix expressions can be answered from an index
+        expression = {'$regex': '^' + re.escape(search)}
+        filter['$or'] = [{key: expression} for key in ('_id', 'partno', 'status', 'project')]
+
+    sort = list()
+    column = request.args.get('order[0][column]', type=int)
+    if column is not None and 0 <= column < len(_OVERVIEW_COLUMNS) and _OVERVIEW_COLUMNS[column]:
+        direction = DESCENDING if request.args.get('order[0][dir]') == 'desc' else ASCENDING
+        sort.append((_OVERVIEW_COLUMNS[column], direction))
+    if not sort or sort[0][0] != '_id':
+        sort.append(('_id', ASCENDING))  # stable page boundaries
+
+    collection = current_app.mongo.db.items
+    total = collection.count(base_filter)
+    filtered = collection.count(filter) if search else total
+    objects = list(collection.find(
             filter=filter,
-            projection=['partno', 'project', 'status']
+            projection=['partno', 'project', 'status', 'available'],
+            sort=sort,
+            skip=start,
+            limit=length
     ))
-    component_records = current_app.mongo.db.components.find(projection=['name'])
-    names = dict((record['_id'], record['name']) for record in component_records)
+
+    base_numbers = dict()
     for obj in objects:
-        partno = PartNumber(obj['partno'])
-        obj['_partname'] = names.get(partno.base_number, '<unknown>')
-    return render_template('items/overview.html', data=objects, show_all=request.args.get('show_all'))
+        try:
+            base_numbers[obj['_id']] = PartNumber(obj.get('partno')).base_number
+        except ValueError:
+            base_numbers[obj['_id']] = None
+    names = get_names(base_numbers.values())
+    data = list()
+    for obj in objects:
+        data.append(dict(
+                _id=obj['_id'],
+                _partname=names.get(base_numbers[obj['_id']], '<unknown>'),
+                _url=url_for('items.details', serial=obj['_id']),
+                partno=obj.get('partno', ''),
+                project=obj.get('project', ''),
+                status=obj.get('status', ''),
+                available=obj.get('available', False),
+        ))
+    return jsonify(draw=draw, recordsTotal=total, recordsFiltered=filtered, data=data)
 
 
 @bp.route('/<serial>/')
 @login_required
 def details(serial):
-    obj = current_app.mongo.db.items.find_one_or_404(serial)
+    """
+    Shows the item details with one page of comments, starting with the latest comments.
+    The page is selected with the 'page' parameter
+    """
+    page = max(request.args.get('page', 0, type=int), 0)
+    if is_conditional():
+        stamp = current_app.mongo.db.items.find_one_or_404(serial, projection=['partno', '_version'])
+        response = not_modified(_details_etag(stamp, page))
+        if response is not None:
+            return response
+    obj = current_app.mongo.db.items.find_one_or_404(serial, projection={'comments': False})
+    comments = get_comments(serial, skip=page*COMMENTS_PAGE_SIZE, limit=COMMENTS_PAGE_SIZE, latest_first=True)
+    pages = (count_comments(serial) + COMMENTS_PAGE_SIZE - 1) // COMMENTS_PAGE_SIZE
     try:
         pn = PartNumber(obj.get('partno'))
     except ValueError:
         flash('An error occurred while parsing the part number', 'error')
         return redirect(url_for('items.overview'))
 
-    component = current_app.mongo.db.components.find_one(pn.base_number)
-    if component:
-        obj['_partname'] = component['name']
-    else:
-        obj['_partname'] = 'n/a'
+    obj['_partname'] = get_name(pn.base_number) or 'n/a'
 
     # First try the full part number, then only the base number. Use default.html as fallback
     mapping = current_app.config.get('LPM_ITEM_VIEW_MAP', dict())
     filename = mapping.get(pn.id) or mapping.get(pn.base_number) or 'default.html'
     try:
-        return render_template('items/' + filename, item=obj, error=None)
+        page_data = render_template('items/' + filename, item=obj, comments=comments, page=page, pages=pages,
+                                    error=None)
     except Exception as e:
-        return render_template('items/details.html', item=obj, error=str(e))
+        page_data = render_template('items/details.html', item=obj, comments=comments, page=page, pages=pages,
+                                    error=str(e))
+    return cache_headers(make_response(page_data), _details_etag(obj, page))
 
 
 @bp.route('/<serial>/add-comment', methods=['GET', 'POST'])
@@ -109,13 +214,10 @@ def add_comment(serial):
     current_app.mongo.db.items.find_one_or_404(serial)
     form = CommentForm(request.form)
     if request.method == 'POST' and form.validate_on_submit():
-        result = current_app.mongo.db.items.update_one(
-                filter={'_id': serial},
-                update={'$push': {'comments': create_comment(form.message.data)}}
-        )
-        if result.modified_count == 1:
+        try:
+            add_comments(serial, [create_comment(form.message.data)])
             flash('comment successfully added', 'success')
-        else:
+        except Exception:
             flash('comment adding failed, please contact the administrator', 'error')
         return redirect(url_for('items.details', serial=serial))
     extract_errors(form)
@@ -147,6 +249,41 @@ def change_status(serial, status=''):
     return render_template('items/status_form.html', serial=serial, item=item, form=form)
 
 
+@bp.route('/change-status', methods=['GET', 'POST'])
+@login_required
+def bulk_change_status():
+    """
+    Changes the status of several items at once.
+    The items are either given as a list of serial numbers or selected by part number and/or current status.
+    """
+    form = BulkStatusForm(request.form)
+    results = None
+    if request.method == 'POST' and form.validate_on_submit():
+        serials = form.serials.data.split()
+        filter = {'available': True}
+        if not serials:
+            if form.partno.data:
+                filter['partno'] = form.partno.data
+            if form.current_status.data:
+                filter['status'] = form.current_status.data
+            if len(filter) == 1:
+                flash('either serial numbers or a part number or current status filter are required', 'error')
+                return render_template('items/bulk_status_form.html', form=form, results=None)
+        try:
+            if len(filter) > 1:
+                serials = select_serials(filter)
+            results = do_bulk_update_status(serials, form.status.data, form.project.data, form.comment.data)
+            failed = sum(1 for message in results.values() if message)
+            if failed:
+                flash('%d of %d status changes failed' % (failed, len(results)), 'error')
+            else:
+                flash('%d status changes successful' % len(results), 'success')
+        except Exception as e:
+            flash(e, 'error')
+    extract_errors(form)
+    return render_template('items/bulk_status_form.html', form=form, results=results)
+
+
 @bp.route('/<serial>/set-project', methods=['GET', 'POST'])
 @login_required
 def set_project(serial):
@@ -161,12 +298,10 @@ def set_project(serial):
         comment = create_comment("[Auto] changed project association to '%s'" % project)
         result = current_app.mongo.db.items.update_one(
                 filter={'_id': serial},
-                update={
-                    '$set': {'project': project},
-                    '$push': {'comments': comment}
-                }
+                update=versioned({'$set': {'project': project}})
         )
-        if result.modified_count == 1:
+        if result.matched_count == 1:
+            add_comments(serial, [comment])
             flash('project successfully set', 'success')
         else:
             flash('failed to set the project, please contact the administrator', 'error')
@@ -186,7 +321,7 @@ def import_items():
         if request.files.get('file'):  # a file was uploaded
             try:
                 save_to_tmp(form)
-                success, headers, values = _import_file(extract_filepath(form))
+                success, headers, values = import_cached(form, _import_file)
                 return render_template('items/validate_form.html',
                                        title='Verify Item Data',
                                        form=form,
@@ -196,15 +331,11 @@ def import_items():
                 flash(e, 'error')
 
         elif form.tmpname.data:
-            # re-run the data import and insert items into the database
-            success, headers, values = _import_file(extract_filepath(form))
+            # insert the validated items into the database in a background job
+            success, headers, values = import_cached(form, _import_file)
             if success:
-                try:
-                    _store_items(values)
-                    flash('item import successful', 'success')
-                    return redirect(url_for('items.overview'))
-                except Exception as e:
-                    flash(e, 'error')
+                job_id = submit_job('Item Import', _import_job, values, next_url=url_for('items.overview'))
+                return redirect(url_for('jobs.details', id=job_id))
             return render_template('items/validate_form.html',
                                    title='Verify Item Data',
                                    form=form,
@@ -264,27 +395,200 @@ def create_comment(comment, date=None):
     return {'user': current_user.id, 'date': date, 'message': comment}
 
 
-def do_update_status(item, status, project=None, comment=None, now=datetime.now()):
-    setdata = {}
-    comments = []
+def prepare_status_update(item, status, project=None, comment=None, now=None):
+    """
+    Validates the status transition of the given item (requires the 'partno' and 'status' keys).
+    Returns the tuple (setdata, comments) with the data to set and the comments to add.
+    Raises ValueError if the transition is not valid
+    """
     _check_status(item.get('partno'), item.get('status'), status)
-    setdata['status'] = status
-    setdata['available'] = not _is_unavailable(item.get('partno'), status)
+    setdata = {
+        'status': status,
+        'available': not _is_unavailable(item.get('partno'), status)
+    }
     if project:
         setdata['project'] = project
-    comments.append(create_comment("[Auto] changed status to '%s'" % status, now))
+    if now is None:
+        now = datetime.now()
+    comments = [create_comment("[Auto] changed status to '%s'" % status, now)]
     if comment:
         comments.append(create_comment(comment, now))
+    return setdata, comments
 
+
+def do_update_status(item, status, project=None, comment=None, now=None):
+    setdata, comments = prepare_status_update(item, status, project, comment, now)
     result = current_app.mongo.db.items.update_one(
         filter={'_id': item.get('_id')},
-        update={
-            '$set': setdata,
-            '$push': {'comments': {'$each': comments}}
-        }
+        update=versioned({'$set': setdata})
     )
-    if result.modified_count != 1:
+    if result.matched_count != 1:
         raise RuntimeError('status update failed, please contact the administrator')
+    add_comments(item.get('_id'), comments)
+
+
+def do_bulk_update_status(serials, status, project=None, comment=None):
+    """
+    Changes the status of all given items. All transitions are validated before any item is modified,
+    the valid changes are then applied with a single bulk write (see apply_updates()).
+    An item is only modified if its status was not changed in the meantime.
+    Returns an ordered dict mapping each serial number to None if successful or to the error message otherwise.
+    """
+    serials = list(OrderedDict.fromkeys(str(serial) for serial in serials))  # remove duplicates
+    items = dict()
+    for idx in range(0, len(serials), IN_QUERY_CHUNK_SIZE):
+        records = current_app.mongo.db.items.find(
+                {'_id': {'$in': serials[idx:idx+IN_QUERY_CHUNK_SIZE]}},
+                projection=['partno', 'status']
+        )
+        items.update((record['_id'], record) for record in records)
+
+    now = datetime.now()
+    results = OrderedDict()
+    updates = list()
+    comments = dict()
+    for serial in serials:
+        item = items.get(serial)
+        try:
+            if item is None:
+                raise ValueError("unknown serial number '%s'" % serial)
+            setdata, comments[serial] = prepare_status_update(item, status, project, comment, now)
+            updates.append(({'_id': serial, 'status': item.get('status')}, versioned({'$set': setdata})))
+            results[serial] = None
+        except Exception as e:
+            results[serial] = str(e)
+
+    for (filter, update), message in zip(updates, apply_updates(updates)):
+        results[filter['_id']] = message
+    add_bulk_comments((serial, comments[serial]) for serial, message in results.items() if message is None)
+    return results
+
+
+def select_serials(filter):
+    """
+    Returns the sorted serial numbers of the items that match the given filter.
+    Raises ValueError if the filter selects more than MAX_FILTER_SERIALS items
+    """
+    records = current_app.mongo.db.items.find(filter, projection=['_id'], sort=[('_id', ASCENDING)],
+                                              limit=MAX_FILTER_SERIALS+1)
+    serials = [record['_id'] for record in records]
+    if len(serials) > MAX_FILTER_SERIALS:
+        raise ValueError('the filter selects more than %d items' % MAX_FILTER_SERIALS)
+    return serials
+
+
+def apply_updates(updates):
+    """
+    Applies the given (filter, update) tuples to the items with a single unordered bulk write. Each filter
+    contains the serial number ('_id') and the conditions under which the item may be modified.
+    Returns a list with the result of each update: None if it was applied, the error message otherwise.
+
+    The bulk write only reports the total number of matched items. Thus each update also sets a write token
+    that is unique to this call ('_write'). If not all updates matched, the items are read once more:
+    items with the token were updated, items without the token were modified concurrently.
+    """
+    results = [None] * len(updates)
+    if not updates:
+        return results
+    token = ObjectId()
+    requests = [UpdateOne(filter, dict(update, **{'$set': dict(update.get('$set', dict()), _write=token)}))
+                for filter, update in updates]
+    try:
+        matched = current_app.mongo.db.items.bulk_write(requests, ordered=False).matched_count
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', list()):
+            results[error['index']] = error.get('errmsg', 'unknown error')
+        matched = e.details.get('nMatched', 0)
+    if matched + sum(1 for result in results if result is not None) == len(updates):
+        return results
+
+    serials = [filter['_id'] for filter, update in updates]
+    written = dict()
+    for idx in range(0, len(serials), IN_QUERY_CHUNK_SIZE):
+        records = current_app.mongo.db.items.find({'_id': {'$in': serials[idx:idx+IN_QUERY_CHUNK_SIZE]}},
+                                                  projection=['_write'])
+        written.update((record['_id'], record.get('_write')) for record in records)
+    for idx, serial in enumerate(serials):
+        if results[idx] is not None or written.get(serial) == token:
+            continue
+        if serial in written:
+            results[idx] = 'the item was modified concurrently'
+        else:
+            results[idx] = 'the item does not exist anymore'
+    return results
+
+
+def add_comments(serial, comments):
+    """
+    Stores the given comments (see create_comment()) for the item with the given serial number.
+    The comments are part of the item's representations, thus the item version is incremented afterwards.
+    This also applies if the item itself was just modified: a representation that was requested in between
+    would otherwise be cached without the comments.
+    """
+    if not comments:
+        return
+    documents = [dict(comment, serial=serial) for comment in comments]
+    result = current_app.mongo.db.item_comments.insert_many(documents)
+    if len(result.inserted_ids) != len(documents):
+        raise RuntimeError('comment adding failed, please contact the administrator')
+    current_app.mongo.db.items.update_one({'_id': serial}, versioned({}))
+
+
+def migrate_comments(db):
+    """
+    Moves the comments arrays of the item documents in the given database to the item_comments collection.
+    The migration can be re-run if interrupted. However, comments of an item that was being migrated at
+    the time of interruption may be duplicated.
+    Returns the number of migrated items
+    """
+    apply_indexes(db, ['item_comments'])
+    count = 0
+    for item in db.items.find({'comments': {'$exists': True}}, projection=['comments']):
+        documents = [dict(comment, serial=item['_id']) for comment in item.get('comments') or list()]
+        for idx in range(0, len(documents), _INSERT_CHUNK_SIZE):
+            db.item_comments.insert_many(documents[idx:idx+_INSERT_CHUNK_SIZE])
+        db.items.update_one({'_id': item['_id']}, {'$unset': {'comments': ''}})
+        count += 1
+    return count
+
+
+def add_bulk_comments(entries):
+    """
+    Stores the comments of several items with as few database operations as possible.
+    The entries parameter is an iterable of (serial, list of comments) tuples.
+    The versions of the items are incremented afterwards (see add_comments()).
+    """
+    documents = [dict(comment, serial=serial) for serial, comments in entries for comment in comments]
+    for idx in range(0, len(documents), _INSERT_CHUNK_SIZE):
+        current_app.mongo.db.item_comments.insert_many(documents[idx:idx+_INSERT_CHUNK_SIZE])
+    serials = list(OrderedDict.fromkeys(document['serial'] for document in documents))
+    for idx in range(0, len(serials), IN_QUERY_CHUNK_SIZE):
+        current_app.mongo.db.items.update_many({'_id': {'$in': serials[idx:idx+IN_QUERY_CHUNK_SIZE]}}, versioned({}))
+
+
+def get_comments(serial, skip=0, limit=0, after=None, latest_first=False):
+    """
+    Returns the comments of the given item in the order they were added (or reversed if latest_first is set).
+    The result can be paged with skip/limit or by passing the ID of the last comment of the previous page as 'after'.
+    A limit of 0 returns all remaining comments.
+    """
+    filter = {'serial': serial}
+    if after is not None:
+        filter['_id'] = {'$lt' if latest_first else '$gt': after}
+    return list(current_app.mongo.db.item_comments.find(
+            filter=filter,
+            projection={'serial': False},
+            sort=[('_id', DESCENDING if latest_first else ASCENDING)],
+            skip=skip,
+            limit=limit
+    ))
+
+
+def count_comments(serial):
+    """
+    Returns the number of comments of the given item
+    """
+    return current_app.mongo.db.item_comments.count({'serial': serial})
 
 
 def _import_file(filepath):
@@ -306,10 +610,26 @@ def _import_file(filepath):
         raise ValueError("reserved column name: 'comments'")
     if 'available' in headers:
         raise ValueError("reserved column name: 'available'")
+
+    # resolve the part numbers and serials of all rows up front instead of querying row by row
+    base_numbers = set()
+    serials = set()
+    for item in data:
+        try:
+            base_numbers.add(PartNumber(item.get('partno')).base_number)
+        except Exception:
+            pass  # reported below
+        if item.get('serial'):
+            serials.add(str(item.get('serial')))
+    known_partnos = find_existing(base_numbers)
+    existing_serials = _find_existing_serials(serials)
+
+    rows = dict()  # serial -> first row, to detect duplicates within the file
     for idx, item in enumerate(data):
         try:
             pn = PartNumber(item.get('partno'))
-            ensure_exists(pn.base_number)
+            if pn.base_number not in known_partnos:
+                raise ValueError('unknown part number %s' % pn.base_number)
             if pn.revision is None:
                 raise ValueError('part number requires a revision')
             serial = item.get('serial')
@@ -317,8 +637,11 @@ def _import_file(filepath):
                 raise ValueError('serial number is missing')
             # transform the serial to a string AFTER checking it exists. Otherwise the string would read 'None'
             serial = str(serial)
-            if current_app.mongo.db.items.find_one(serial):
+            if serial in existing_serials:
                 raise ValueError("serial number '%s' exists already" % serial)
+            if serial in rows:
+                raise ValueError("serial number '%s' already used in row %d" % (serial, rows[serial]))
+            rows[serial] = idx+2
 
             reqs = get_requirements(pn)
             process_requirements(item, reqs)
@@ -328,16 +651,52 @@ def _import_file(filepath):
     return success, headers, data
 
 
+def _import_job(data):
+    """
+    Background job that stores the validated import data, the result of every row is stored in the job
+    """
+    failed = _store_items(data)
+    for idx, item in enumerate(data):
+        serial = item['_id']
+        if serial in failed:
+            report_row(idx+2, 'failed', serial=serial, message=failed[serial])
+        else:
+            report_row(idx+2, 'applied', serial=serial)
+    for serial, message in sorted(failed.items()):
+        flash("item '%s' could not be stored (%s)" % (serial, message), 'error')
+    if not failed:
+        flash('item import successful', 'success')
+
+
+def _find_existing_serials(serials):
+    """
+    Returns the subset of the given serial numbers that already exist in the database
+    """
+    serials = list(serials)
+    existing = set()
+    for idx in range(0, len(serials), IN_QUERY_CHUNK_SIZE):
+        records = current_app.mongo.db.items.find(
+                {'_id': {'$in': serials[idx:idx+IN_QUERY_CHUNK_SIZE]}},
+                projection=['_id']
+        )
+        existing.update(record['_id'] for record in records)
+    return existing
+
+
 def _store_items(data):
     """
     Saves the provided items in the database.
     Applied transformations:
     The 'serial' key is transformed to the '_id' key
-    A 'comment' key is pushed to the comments array
+    A 'comment' key is added to the item comments
+    The items are inserted in unordered chunks, i.e. a failing item does not prevent the others from being stored.
+    Only the stored items are added to the stock.
+    Returns a dict with the serial numbers of the items that could not be stored and the corresponding error message
     """
-    quantities = defaultdict(int)  # for the stock update
     now = datetime.now()
-    for idx, item in enumerate(data):
+    documents = list()
+    comments = list()
+    for item in data:
         assert 'serial' in item
         assert 'partno' in item
         item['_id'] = item.pop('serial')
@@ -348,46 +707,145 @@ def _store_items(data):
         else:
             item['status'] = ''
             item['available'] = True
-        comments = [create_comment('[Auto] created', now)]
+        comments.append(dict(create_comment('[Auto] created', now), serial=item['_id']))
         comment = item.pop('comment', None)
         if comment:
-            comments.append(create_comment(comment, now))
-        item['comments'] = comments
-        current_app.mongo.db.items.insert(item)
+            comments.append(dict(create_comment(comment, now), serial=item['_id']))
+        documents.append(new_version(item))
+
+    failed = dict()
+    for idx in range(0, len(documents), _INSERT_CHUNK_SIZE):
+        report_progress(idx, len(documents))
+        chunk = documents[idx:idx+_INSERT_CHUNK_SIZE]
+        try:
+            current_app.mongo.db.items.insert_many(chunk, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', list()):
+                failed[chunk[error['index']]['_id']] = error.get('errmsg', 'unknown error')
 
-        # count the number of occurrences per model number
+    comments = [comment for comment in comments if comment['serial'] not in failed]
+    for idx in range(0, len(comments), _INSERT_CHUNK_SIZE):
+        current_app.mongo.db.item_comments.insert_many(comments[idx:idx+_INSERT_CHUNK_SIZE])
+
+    quantities = defaultdict(int)  # for the stock update
+    batches = defaultdict(int)
+    for item in documents:
+        if item['_id'] in failed:
+            continue
+        # count the number of occurrences per model number and batch
         partno = PartNumber(item.get('partno'))
         quantities[partno.base_number] += 1
-
-        # update the batch information if present
         batch = item.get('batch')
         if batch:
-            update_batch(partno.base_number, batch, 1)
+            batches[(partno.base_number, batch)] += 1
 
     # add the items to the stock as well
+    update_batches(batches)
     for partno, value in quantities.items():
         update_counts(partno, value, None, 'items added')
+    report_progress(len(documents), len(documents))
+    return failed
+
+
+def _details_etag(item, page):
+    """
+    Returns the entity tag of the details page, which also depends on the user (roles),
+    the comments page and the component name
+    """
+    try:
+        name = get_name(PartNumber(item.get('partno')).base_number)
+    except ValueError:
+        name = None
+    return document_etag(item, current_user.id, page, name)
 
 
 def _check_status(partno, current_status, new_status):
-    pn = PartNumber(partno)
-    partmap = current_app.config.get('LPM_ITEM_STATUS_MAP', dict())
-    map = partmap.get(pn.id) or partmap.get(pn.base_number) or partmap.get('default') or dict()
-    if new_status not in map:
-        raise ValueError("unknown status: '%s'" % new_status)
-    definition = map.get(new_status)
-    origins = definition.get('origins')
-    if current_status not in origins:
-        raise ValueError("Invalid status transition: from '%s' to '%s'" % (current_status, new_status))
-    role = definition.get('role')
+    role = current_app.item_status_map.check_transition(partno, current_status, new_status)
     if role and not current_user.has_role(role):
         raise ValueError("insufficient permissions to do the status transition from '%s' to '%s'"
                          % (current_status, new_status))
 
 
 def _is_unavailable(partno, status):
-    pn = PartNumber(partno)
-    partmap = current_app.config.get('LPM_ITEM_STATUS_MAP', dict())
-    map = partmap.get(pn.id) or partmap.get(pn.base_number) or partmap.get('default') or dict()
-    definition = map.get(status)
-    return definition.get('unavailable', False)
+    return current_app.item_status_map.is_unavailable(partno, status)
+
+
+class StatusMap:
+    """
+    Compiled representation of the LPM_ITEM_STATUS_MAP configuration entry.
+    The status definitions are validated once and transformed into lookup tables indexed by the
+    (current status, new status) pair. The definition applying to a part number (full part number,
+    base number or 'default') is resolved once per part number.
+    """
+
+    def __init__(self, definitions):
+        self._tables = dict()
+        for key, statuses in definitions.items():
+            table = StatusMap._compile(key, statuses)
+            if statuses:  # empty entries fall back to the next definition
+                self._tables[key] = table
+        self._resolved = dict()
+        self._empty = StatusMap._compile('', dict())
+
+    def check_transition(self, partno, current_status, new_status):
+        """
+        Ensures the status transition is valid for the given part number, raises ValueError otherwise.
+        Returns the role required for the transition (None if no role is required)
+        """
+        transitions, unavailable = self._resolve(partno)
+        if new_status not in unavailable:
+            raise ValueError("unknown status: '%s'" % new_status)
+        if (current_status, new_status) not in transitions:
+            raise ValueError("Invalid status transition: from '%s' to '%s'" % (current_status, new_status))
+        return transitions[(current_status, new_status)]
+
+    def is_unavailable(self, partno, status):
+        """
+        Returns whether items with the given part number and status are unavailable.
+        Raises ValueError if the status is not known
+        """
+        unavailable = self._resolve(partno)[1]
+        if status not in unavailable:
+            raise ValueError("unknown status: '%s'" % status)
+        return unavailable[status]
+
+    def _resolve(self, partno):
+        table = self._resolved.get(partno)
+        if table is None:
+            # First try the full part number, then only the base number. Use the default entry as fallback
+            pn = PartNumber(partno)
+            table = self._tables.get(pn.id) or self._tables.get(pn.base_number) or \
+                self._tables.get('default') or self._empty
+            if len(self._resolved) >= _MAX_RESOLVED_PARTNOS:
+                self._resolved.clear()  # the part numbers may come from external requests
+            self._resolved[partno] = table
+        return table
+
+    @staticmethod
+    def _compile(key, statuses):
+        """
+        Returns the tuple (transitions, unavailable) for the given status definitions, where transitions maps
+        (current status, new status) pairs to the required role and unavailable maps the status to the flag.
+        Raises ValueError if the definitions are invalid
+        """
+        if not isinstance(statuses, dict):
+            raise ValueError("LPM_ITEM_STATUS_MAP: entry '%s' must be a dict" % key)
+        transitions = dict()
+        unavailable = dict()
+        for status, definition in statuses.items():
+            if not isinstance(definition, dict):
+                raise ValueError("LPM_ITEM_STATUS_MAP: status '%s' of '%s' must be a dict" % (status, key))
+            origins = definition.get('origins')
+            if not isinstance(origins, (list, tuple, set, frozenset)):
+                raise ValueError("LPM_ITEM_STATUS_MAP: status '%s' of '%s' requires a list of origins" % (status, key))
+            for origin in origins:
+                if origin != '' and origin not in statuses:
+                    raise ValueError("LPM_ITEM_STATUS_MAP: unknown origin '%s' for status '%s' of '%s'"
+                                     % (origin, status, key))
+            role = definition.get('role')
+            if role is not None and not isinstance(role, str):
+                raise ValueError("LPM_ITEM_STATUS_MAP: invalid role for status '%s' of '%s'" % (status, key))
+            for origin in origins:
+                transitions[(origin, status)] = role
+            unavailable[status] = bool(definition.get('unavailable', False))
+        return transitions, unavailable
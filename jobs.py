@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Background job module for lpm
+
+Long-running operations (e.g. file imports) are executed in a worker pool instead of within the HTTP request.
+The browser is redirected to the job page, which polls the job status until the job is finished.
+
+A job consists of:
+- an ID
+- a title
+- the user who started the job
+- a state ('pending', 'running', 'finished' or 'failed')
+- the owning process (host:pid and a random suffix) and the time of its last heartbeat
+- the progress (number of processed and total entries)
+- a list of result messages
+- a URL to continue to once the job is finished
+
+The job functions run with a request context that is derived from the request that started the job (without the
+request body and cookies) and with the user who started the job. Messages flashed within the job are stored as the
+job results. The progress can be reported with report_progress(), the result of every processed row with
+report_row(). The rows are stored in the separate job_rows collection, since their number is unbounded. They are
+buffered and written in chunks together with the progress, thus a job that fails partway still records which rows
+were applied (except for the rows of the last fraction of a second if its process dies).
+
+While a process has pending or running jobs, it periodically updates their heartbeat. Jobs whose heartbeat is
+older than _HEARTBEAT_TIMEOUT (e.g. since their process died or restarted) are orphaned and marked as failed,
+both upon startup and whenever such a job is read.
+
+The number of worker threads is defined with the LPM_JOB_WORKERS configuration entry. If set to 0,
+jobs are executed synchronously within the request that starts them.
+
+The rules of access are as follows:
+- users may only view their own jobs
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+import os
+import socket
+import threading
+import time
+from io import BytesIO
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, current_app, render_template, request, abort, flash, get_flashed_messages, g, \
+    jsonify
+from flask.ext.login import login_required, login_user, current_user
+from flask.ext.pymongo import ObjectId
+
+bp = Blueprint('jobs', __name__)
+
+# minimum interval between two progress updates in the database (seconds)
+_PROGRESS_INTERVAL = 0.5
+# maximum number of buffered rows and maximum number of rows returned per request
+_ROWS_CHUNK_SIZE = 1000
+
+# interval between two heartbeats of the active jobs and the time after which a job is orphaned (seconds)
+_HEARTBEAT_INTERVAL = 10
+_HEARTBEAT_TIMEOUT = 60
+
+# job IDs of the pending and running jobs of this process
+_active = set()
+_lock = threading.Lock()
+_heartbeat_thread = None
+_owners = dict()
+
+
+def init(app):
+    """
+    Creates the worker pool for the given app
+    """
+    workers = app.config.get('LPM_JOB_WORKERS', 2)
+    app.job_executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+    with app.app_context():
+        for job_id in fail_orphaned(app.mongo.db):
+            app.logger.warning('marked orphaned job %s as failed' % job_id)
+
+
+@bp.route('/<id>')
+@login_required
+def details(id):
+    """
+    Shows the job progress and, once finished, the job results
+    """
+    job = _load_job(id)
+    return render_template('jobs/details.html', job=job)
+
+
+@bp.route('/<id>/status')
+@login_required
+def status(id):
+    """
+    Returns the job state and progress in JSON format.
+    The result messages and rows are only returned once the job is finished.
+    """
+    job = _load_job(id)
+    return jsonify(state=job['state'],
+                   done=job.get('done', 0),
+                   total=job.get('total', 0),
+                   messages=job.get('messages', list()))
+
+
+@bp.route('/<id>/rows')
+@login_required
+def rows(id):
+    """
+    Returns the per-row results of the job in JSON format, ordered by row number.
+    The 'skip' and 'limit' query parameters select the page (at most 1000 rows), the total number of rows
+    is returned as well.
+    """
+    job = _load_job(id)
+    skip = max(request.args.get('skip', 0, type=int), 0)
+    limit = request.args.get('limit', _ROWS_CHUNK_SIZE, type=int)
+    if limit <= 0 or limit > _ROWS_CHUNK_SIZE:
+        limit = _ROWS_CHUNK_SIZE
+    filter = {'job': job['_id']}
+    records = current_app.mongo.db.job_rows.find(filter, projection={'_id': False, 'job': False},
+                                                 sort=[('row', 1)], skip=skip, limit=limit)
+    return jsonify(total=current_app.mongo.db.job_rows.count(filter), rows=list(records))
+
+
+def submit(title, func, *args, next_url=None):
+    """
+    Creates a new job that executes func(*args) and returns the job ID.
+    Must be called within a request of a logged in user.
+    """
+    app = current_app._get_current_object()
+    user = current_user._get_current_object()
+    now = datetime.now()
+    job_id = app.mongo.db.jobs.insert_one({
+        'title': title,
+        'user': user.id,
+        'state': 'pending',
+        'owner': _owner(),
+        'created': now,
+        'heartbeat': now,
+        'done': 0,
+        'total': 0,
+        'messages': list(),
+        'next': next_url,
+    }).inserted_id
+    environ = _job_environ()
+    _start_heartbeat(app, job_id)
+    if app.job_executor is None:
+        _run(app, environ, user, job_id, func, args)
+    else:
+        app.job_executor.submit(_run, app, environ, user, job_id, func, args)
+    return job_id
+
+
+def report_progress(done, total):
+    """
+    Updates the progress of the current job. The database is only updated periodically.
+    Does nothing if not called from within a job.
+    """
+    job_id = g.get('job_id')
+    if job_id is None:
+        return
+    now = time.time()
+    if done < total and now - g.get('job_progress_time', 0) < _PROGRESS_INTERVAL:
+        return
+    g.job_progress_time = now
+    _flush_rows()
+    _update(job_id, {'done': done, 'total': total})
+
+
+def report_row(row, state, **details):
+    """
+    Records the result of the given row (e.g. 'applied' or 'failed') and optional details for the current job.
+    The rows are written with the next progress update, at the end of the job or once the buffer is full.
+    Does nothing if not called from within a job.
+    """
+    job_id = g.get('job_id')
+    if job_id is None:
+        return
+    g.job_rows.append(dict(details, job=job_id, row=row, state=state))
+    if len(g.job_rows) >= _ROWS_CHUNK_SIZE:
+        _flush_rows()
+
+
+def fail_orphaned(db):
+    """
+    Marks the pending and running jobs without a recent heartbeat as failed and returns their IDs
+    """
+    now = datetime.now()
+    filter = {'state': {'$in': ['pending', 'running']},
+              'heartbeat': {'$lt': now - timedelta(seconds=_HEARTBEAT_TIMEOUT)}}
+    job_ids = [job['_id'] for job in db.jobs.find(filter, projection=['_id'])]
+    for job_id in job_ids:
+        # the filter is repeated in case the job was updated in the meantime
+        db.jobs.update_one(dict(filter, _id=job_id), {
+            '$set': {'state': 'failed', 'finished': now},
+            '$push': {'messages': dict(category='error', message='the job was aborted (no heartbeat)')},
+        })
+    return job_ids
+
+
+def _run(app, environ, user, job_id, func, args):
+    # a new application context ensures that g is not shared with the request that started the job
+    with app.app_context(), app.request_context(environ):
+        login_user(user)
+        g.job_id = job_id
+        g.job_rows = list()
+        _update(job_id, {'state': 'running', 'started': datetime.now()})
+        state = 'finished'
+        try:
+            func(*args)
+        except Exception as e:
+            flash(str(e), 'error')
+            state = 'failed'
+        messages = [dict(category=category, message=str(message))
+                    for category, message in get_flashed_messages(with_categories=True)]
+        try:
+            _flush_rows()
+            _update(job_id, {'state': state, 'finished': datetime.now(), 'messages': messages})
+        finally:
+            with _lock:
+                _active.discard(job_id)
+
+
+def _update(job_id, data):
+    current_app.mongo.db.jobs.update_one({'_id': job_id}, {'$set': data})
+
+
+def _flush_rows():
+    if g.job_rows:
+        current_app.mongo.db.job_rows.insert_many(g.job_rows)
+        g.job_rows = list()
+
+
+def _job_environ():
+    """
+    Returns a copy of the WSGI environment of the current request for the request context of a job.
+    The body and the cookies are left out, thus the job neither reads the request data nor the browser's
+    session (e.g. its pending flash messages)
+    """
+    environ = dict((key, value) for key, value in request.environ.items()
+                   if not key.startswith('werkzeug.') and key not in ('HTTP_COOKIE', 'CONTENT_TYPE'))
+    environ.update({'wsgi.input': BytesIO(), 'CONTENT_LENGTH': '0', 'REQUEST_METHOD': 'GET'})
+    return environ
+
+
+def _owner():
+    """
+    Returns the ID of the current process: host:pid and a random suffix, since PIDs are reused upon restart
+    """
+    pid = os.getpid()
+    with _lock:
+        if pid not in _owners:
+            _owners[pid] = '%s:%d:%s' % (socket.gethostname(), pid, ObjectId())
+        return _owners[pid]
+
+
+def _start_heartbeat(app, job_id):
+    """
+    Registers the given job as active and starts the heartbeat thread of this process if not running
+    """
+    global _heartbeat_thread
+    with _lock:
+        _active.add(job_id)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat, args=(app,), name='lpm-job-heartbeat')
+            _heartbeat_thread.daemon = True
+            _heartbeat_thread.start()
+
+
+def _heartbeat(app):
+    # the thread terminates once this process has no active jobs left
+    global _heartbeat_thread
+    while True:
+        time.sleep(_HEARTBEAT_INTERVAL)
+        with _lock:
+            job_ids = list(_active)
+            if not job_ids:
+                _heartbeat_thread = None
+                return
+        try:
+            with app.app_context():
+                app.mongo.db.jobs.update_many({'_id': {'$in': job_ids}}, {'$set': {'heartbeat': datetime.now()}})
+        except Exception as e:
+            app.logger.warning('failed to update the job heartbeat: %s' % e)
+
+
+def _load_job(id):
+    """
+    Loads the job with the given ID. Aborts with 404 if the job does not exist or belongs to another user
+    """
+    try:
+        id = ObjectId(id)
+    except Exception:
+        abort(404)
+    job = current_app.mongo.db.jobs.find_one_or_404(id)
+    if job.get('user') != current_user.id:
+        abort(404)
+    if job['state'] in ('pending', 'running') and fail_orphaned(current_app.mongo.db):
+        job = current_app.mongo.db.jobs.find_one_or_404(id)
+    return job
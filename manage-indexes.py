@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""
+Creates the database indexes declared in lpm/indexes.py and reports any remaining drift.
+With --check, only the drift is reported and no indexes are created.
+Usage: manage-indexes.py [--check] <database name> [<MongoDB URI>]
+"""
+import sys
+import os
+from pymongo import MongoClient
+
+# ensure lpm is found and can be directly imported from this file
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lpm import indexes
+
+args = sys.argv[1:]
+check_only = '--check' in args
+if check_only:
+    args.remove('--check')
+if len(args) < 1:
+    print(__doc__.strip())
+    sys.exit(1)
+
+client = MongoClient(args[1] if len(args) > 1 else None)
+db = client[args[0]]
+drift = indexes.check(db) if check_only else indexes.apply(db)
+for collection, name, problem in drift:
+    print("%s: %s index '%s'" % (collection, problem, name))
+if not drift:
+    print('all indexes are up to date')
+sys.exit(1 if drift else 0)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics module for lpm
+
+Records per endpoint (blueprint.view) request counts, status codes, latency histograms, payload sizes and the number
+of requests in flight. The metrics are exposed on /metrics in the Prometheus text exposition format.
+/ready is a readiness check that measures the MongoDB ping latency.
+
+Each process keeps its metrics in memory and periodically stores a snapshot in the metrics collection.
+The /metrics endpoint returns the samples of all processes with an additional instance label (host:pid), such
+that the values are complete in multi-process deployments regardless of the process that handles the scrape.
+The values are not summed up, since the sums would drop whenever a process terminates; use sum() or rate() in
+the Prometheus queries instead. Gauges of other processes are only returned if their snapshot is at most two
+flush intervals old. Snapshots of terminated processes expire through a TTL index (see the indexes module).
+
+Configuration entries:
+- LPM_METRICS: enables the request metrics (default True)
+- LPM_METRICS_FLUSH_INTERVAL: seconds between two snapshots of a process (default 10)
+- LPM_READY_MAX_PING: maximum MongoDB ping latency in ms for the readiness check (default 1000)
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from collections import defaultdict
+from flask import Blueprint, current_app, request, g, jsonify
+
+bp = Blueprint('metrics', __name__)
+
+# snapshots older than this are ignored by /metrics (seconds)
+SNAPSHOT_MAX_AGE = 300
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# (name, type, help text); histograms are exposed with the _bucket, _sum and _count suffixes
+_METRICS = [
+    ('lpm_http_requests_total', 'counter', 'Number of handled HTTP requests'),
+    ('lpm_http_requests_in_flight', 'gauge', 'Number of HTTP requests currently being handled'),
+    ('lpm_http_request_duration_seconds', 'histogram', 'HTTP request latency'),
+    ('lpm_http_request_size_bytes', 'histogram', 'HTTP request body size'),
+    ('lpm_http_response_size_bytes', 'histogram', 'HTTP response body size'),
+]
+
+
+def init(app):
+    """
+    Registers the request hooks for the given app
+    """
+    if not app.config.get('LPM_METRICS', True):
+        app.metrics = None
+        return
+    app.metrics = Registry()
+    flush_interval = app.config.get('LPM_METRICS_FLUSH_INTERVAL', 10)
+
+    @app.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+        app.metrics.add('lpm_http_requests_in_flight', (), 1)
+
+    @app.after_request
+    def record_request(response):
+        if g.get('metrics_start') is not None:
+            _record(app.metrics, g.metrics_start, response.status_code, response.calculate_content_length())
+            g.metrics_start = None
+        return response
+
+    @app.teardown_request
+    def finish_request(exception):
+        if g.get('metrics_start') is not None:  # not recorded due to an unhandled exception
+            _record(app.metrics, g.metrics_start, 500, None)
+            g.metrics_start = None
+        if app.metrics.due(flush_interval):
+            try:
+                store_snapshot(app.mongo.db, app.metrics)
+            except Exception as e:
+                app.logger.warning('failed to store the metrics snapshot: %s' % e)
+
+
+@bp.route('/metrics')
+def metrics():
+    """
+    Returns the metrics of all processes in the Prometheus text exposition format
+    """
+    if current_app.metrics is None:
+        return 'metrics are disabled\n', 404, {'Content-Type': 'text/plain'}
+    db = current_app.mongo.db
+    gauges = set(metric for metric, kind, description in _METRICS if kind == 'gauge')
+    samples = dict()
+    try:
+        store_snapshot(db, current_app.metrics)
+        now = datetime.utcnow()
+        limit = now - timedelta(seconds=SNAPSHOT_MAX_AGE)
+        gauge_limit = now - timedelta(seconds=2 * current_app.config.get('LPM_METRICS_FLUSH_INTERVAL', 10))
+        for snapshot in db.metrics.find({'updated': {'$gte': limit}}, projection=['updated', 'samples']):
+            instance = (('instance', snapshot['_id']),)
+            fresh = snapshot['_id'] == _instance() or snapshot['updated'] >= gauge_limit
+            for name, labels, value in snapshot.get('samples', list()):
+                if name in gauges and not fresh:
+                    continue
+                samples[(name, instance + tuple(tuple(label) for label in labels))] = value
+    except Exception as e:
+        # the metrics are even more important if the database has problems
+        current_app.logger.warning('failed to collect the metrics snapshots: %s' % e)
+        instance = (('instance', _instance()),)
+        samples = dict(((name, instance + labels), value)
+                       for (name, labels), value in current_app.metrics.samples().items())
+    return current_app.response_class(expose(samples), mimetype='text/plain; version=0.0.4')
+
+
+@bp.route('/ready')
+def ready():
+    """
+    Readiness check: Returns status 200 if MongoDB answers a ping within LPM_READY_MAX_PING ms, 503 otherwise.
+    The JSON reply contains the 'ok' flag, the ping latency in ms ('mongo_ping_ms') and an error message if any.
+    """
+    max_ping = current_app.config.get('LPM_READY_MAX_PING', 1000)
+    start = time.perf_counter()
+    try:
+        current_app.mongo.db.command('ping')
+    except Exception as e:
+        return jsonify(ok=False, mongo_ping_ms=None, message=str(e)), 503
+    latency = (time.perf_counter() - start) * 1000.0
+    if latency > max_ping:
+        return jsonify(ok=False, mongo_ping_ms=latency, message='MongoDB ping too slow'), 503
+    return jsonify(ok=True, mongo_ping_ms=latency, message='')
+
+
+class Registry:
+    """
+    Thread-safe in-memory store of the metric samples of one process.
+    A sample is identified by the metric name and a tuple of (label, value) pairs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(float)
+        self._last_flush = time.time()
+
+    def add(self, name, labels, value):
+        with self._lock:
+            self._samples[(name, labels)] += value
+
+    def observe(self, name, labels, value, buckets):
+        """
+        Adds the given value to the histogram with the given name (cumulative buckets as in Prometheus)
+        """
+        with self._lock:
+            for bound in buckets:
+                # all buckets are created, even if empty
+                key = (name + '_bucket', labels + (('le', _format_value(bound)),))
+                self._samples[key] += 1 if value <= bound else 0
+            self._samples[(name + '_bucket', labels + (('le', '+Inf'),))] += 1
+            self._samples[(name + '_sum', labels)] += value
+            self._samples[(name + '_count', labels)] += 1
+
+    def samples(self):
+        with self._lock:
+            return dict(self._samples)
+
+    def due(self, interval):
+        """
+        Returns True (once) if the last snapshot is older than the given interval in seconds
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._last_flush < interval:
+                return False
+            self._last_flush = now
+            return True
+
+
+def store_snapshot(db, registry):
+    """
+    Stores the samples of the given registry as the snapshot of the current process
+    """
+    samples = [[name, [list(label) for label in labels], value]
+               for (name, labels), value in sorted(registry.samples().items())]
+    db.metrics.update_one(
+            filter={'_id': _instance()},
+            update={'$set': {'updated': datetime.utcnow(), 'samples': samples}},
+            upsert=True
+    )
+
+
+def expose(samples):
+    """
+    Returns the given samples ({(name, labels): value}) in the Prometheus text exposition format
+    """
+    lines = list()
+    for metric, kind, description in _METRICS:
+        names = (metric + '_bucket', metric + '_sum', metric + '_count') if kind == 'histogram' else (metric,)
+        entries = sorted(((key, value) for key, value in samples.items() if key[0] in names), key=_sort_key)
+        if kind != 'gauge' and not entries:
+            continue
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        if not entries:
+            lines.append('%s 0' % metric)
+        for (name, labels), value in entries:
+            if labels:
+                name += '{%s}' % ','.join('%s="%s"' % (label, _escape(str(v))) for label, v in labels)
+            lines.append('%s %s' % (name, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _instance():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _record(registry, start, status, response_size):
+    endpoint = request.endpoint or '<unmatched>'
+    labels = (('endpoint', endpoint),)
+    registry.add('lpm_http_requests_in_flight', (), -1)
+    registry.add('lpm_http_requests_total', labels + (('method', request.method), ('status', str(status))), 1)
+    registry.observe('lpm_http_request_duration_seconds', labels, time.perf_counter() - start, _LATENCY_BUCKETS)
+    if request.content_length is not None:
+        registry.observe('lpm_http_request_size_bytes', labels, request.content_length, _SIZE_BUCKETS)
+    if response_size is not None:
+        registry.observe('lpm_http_response_size_bytes', labels, response_size, _SIZE_BUCKETS)
+
+
+def _sort_key(entry):
+    # histogram buckets are sorted by their numerical upper bound
+    (name, labels), value = entry
+    return name, [(label, float(v) if label == 'le' else v) for label, v in labels]
+
+
+def _format_value(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
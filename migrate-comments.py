@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+"""
+Moves the item comments from the item documents to the item_comments collection.
+Usage: migrate-comments.py <database name> [<MongoDB URI>]
+"""
+import sys
+import os
+from pymongo import MongoClient
+
+# ensure lpm is found and can be directly imported from this file
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lpm.items import migrate_comments
+
+if len(sys.argv) < 2:
+    print(__doc__.strip())
+    sys.exit(1)
+
+client = MongoClient(sys.argv[2] if len(sys.argv) > 2 else None)
+count = migrate_comments(client[sys.argv[1]])
+print('migrated the comments of %d items' % count)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Database profiling module for lpm
+
+A pymongo command listener records the number and duration of the MongoDB commands issued per request,
+grouped by collection and command name. The totals are returned in the Server-Timing response header,
+and requests exceeding the configured thresholds are logged as warnings.
+The statistics are aggregated per endpoint and can be inspected on the debug page.
+
+Configuration entries:
+- LPM_DB_PROFILING: enables the profiling (default True)
+- LPM_SLOW_REQUEST_COMMANDS: maximum number of commands per request before a warning is logged (default 100)
+- LPM_SLOW_REQUEST_TIME: maximum database time per request in ms before a warning is logged (default 1000)
+
+Commands issued while streaming a response are not counted, since the response is already sent.
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+import threading
+from collections import defaultdict, Counter
+from flask import g, request, has_app_context
+from pymongo import monitoring
+
+# pymongo listeners are registered for the whole process and must be registered before the client is created
+_listener_registered = False
+
+
+def init(app):
+    """
+    Registers the command listener and the request hooks for the given app.
+    Must be called before the MongoDB client is created
+    """
+    global _listener_registered
+    if not app.config.get('LPM_DB_PROFILING', True):
+        return
+    if not _listener_registered:
+        monitoring.register(CommandListener())
+        _listener_registered = True
+    app.db_profile = EndpointStats()
+    max_commands = app.config.get('LPM_SLOW_REQUEST_COMMANDS', 100)
+    max_time = app.config.get('LPM_SLOW_REQUEST_TIME', 1000)
+
+    @app.before_request
+    def start_profiling():
+        g.db_stats = RequestStats()
+
+    @app.after_request
+    def finish_profiling(response):
+        stats = g.get('db_stats')
+        if stats is None:
+            return response
+        g.db_stats = None
+        response.headers.add('Server-Timing', 'db;dur=%.1f;desc="%d MongoDB commands"'
+                             % (stats.duration, stats.count))
+        app.db_profile.record(request.endpoint or '<unmatched>', stats)
+        if stats.count > max_commands or stats.duration > max_time:
+            app.logger.warning('%s %s: %d MongoDB commands in %.1f ms (%s)' % (
+                request.method, request.path, stats.count, stats.duration,
+                ', '.join('%s: %d' % entry for entry in stats.commands.most_common(5))))
+        return response
+
+
+class CommandListener(monitoring.CommandListener):
+    """
+    Adds the commands to the statistics of the current request, if any.
+    The events of a command are published in the thread that executes it.
+    """
+
+    def started(self, event):
+        stats = _current_stats()
+        if stats is not None:
+            stats.pending[event.request_id] = _command_key(event)
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    @staticmethod
+    def _finished(event):
+        stats = _current_stats()
+        if stats is not None:
+            key = stats.pending.pop(event.request_id, event.command_name)
+            stats.add(key, event.duration_micros / 1000.0)
+
+
+class RequestStats:
+    """
+    The database statistics of a single request. The durations are in ms.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.commands = Counter()
+        self.pending = dict()
+
+    def add(self, key, duration):
+        self.count += 1
+        self.duration += duration
+        self.commands[key] += 1
+
+
+class EndpointStats:
+    """
+    Thread-safe aggregation of the request statistics per endpoint
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = defaultdict(lambda: dict(requests=0, count=0, duration=0.0, max_count=0, max_duration=0.0,
+                                              commands=Counter()))
+
+    def record(self, endpoint, stats):
+        with self._lock:
+            entry = self._data[endpoint]
+            entry['requests'] += 1
+            entry['count'] += stats.count
+            entry['duration'] += stats.duration
+            entry['max_count'] = max(entry['max_count'], stats.count)
+            entry['max_duration'] = max(entry['max_duration'], stats.duration)
+            entry['commands'].update(stats.commands)
+
+    def top(self, key='duration', limit=20):
+        """
+        Returns the endpoints with the highest totals of the given key ('count' or 'duration'),
+        including the per request averages and the most frequent commands
+        """
+        with self._lock:
+            entries = [dict(entry, endpoint=endpoint, commands=entry['commands'].most_common(5))
+                       for endpoint, entry in self._data.items()]
+        for entry in entries:
+            entry['avg_count'] = entry['count'] / entry['requests']
+            entry['avg_duration'] = entry['duration'] / entry['requests']
+        entries.sort(key=lambda entry: entry[key], reverse=True)
+        return entries[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _current_stats():
+    if not has_app_context():
+        return None
+    return g.get('db_stats')
+
+
+def _command_key(event):
+    """
+    Returns the 'collection.command' key of the given command event
+    """
+    collection = event.command.get(event.command_name)
+    if not isinstance(collection, str):
+        collection = event.command.get('collection')  # getMore
+    if isinstance(collection, str):
+        return '%s.%s' % (collection, event.command_name)
+    return event.command_name
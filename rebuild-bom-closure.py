@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+"""
+Recomputes the materialized BOM closure (the bom_closure collection) from the stored BOM rules.
+This is required once for databases that contain BOM rules created before the closure was introduced.
+Usage: rebuild-bom-closure.py <database name> [<MongoDB URI>]
+"""
+import sys
+import os
+from pymongo import MongoClient
+
+# ensure lpm is found and can be directly imported from this file
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lpm import indexes
+from lpm.stock import rebuild_bom_closure
+
+if len(sys.argv) < 2:
+    print(__doc__.strip())
+    sys.exit(1)
+
+client = MongoClient(sys.argv[2] if len(sys.argv) > 2 else None)
+db = client[sys.argv[1]]
+indexes.apply(db, ['bom_closure'])
+rebuild_bom_closure(db)
+print('%d closure entries created' % db.bom_closure.count())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Generates the synthetic benchmark dataset, runs the end-to-end benchmarks and writes the results as JSON.
+If a baseline result file is given, the results are compared and the exit status is 1 if a benchmark regressed.
+"""
+import sys
+import os
+import argparse
+
+# ensure lpm is found and can be directly imported from this file
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from benchmarks import create_app, write_results, load_results, compare, dataset, flows
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('--db', default='lpm_benchmark', help='benchmark database name')
+parser.add_argument('--components', type=int, default=1000, help='number of components')
+parser.add_argument('--items', type=int, default=10000, help='number of items')
+parser.add_argument('--depth', type=int, default=3, help='number of BOM levels below the top assemblies')
+parser.add_argument('--fanout', type=int, default=4, help='number of BOM children per assembly')
+parser.add_argument('--history', type=int, default=50, help='number of stock history entries per component')
+parser.add_argument('--fields', type=int, default=5, help='number of custom fields per item')
+parser.add_argument('--seed', type=int, default=0, help='random seed of the dataset')
+parser.add_argument('--import-rows', type=int, default=1000, help='number of items per import file')
+parser.add_argument('--repeat', type=int, default=5, help='number of timed runs per benchmark')
+parser.add_argument('--skip-generate', action='store_true', help='reuse the existing dataset')
+parser.add_argument('--output', default='benchmark-results.json', help='result file')
+parser.add_argument('--baseline', help='result file to compare against')
+parser.add_argument('--tolerance', type=float, default=0.2, help='accepted slowdown (fraction) against the baseline')
+args = parser.parse_args()
+
+params = dataset.Parameters(components=args.components, items=args.items, depth=args.depth, fanout=args.fanout,
+                            history=args.history, fields=args.fields, seed=args.seed)
+app = create_app(args.db)
+if not args.skip_generate:
+    with app.app_context():
+        dataset.generate(app.mongo.db, params)
+
+results = flows.run(app, params, repeat=args.repeat, import_rows=args.import_rows)
+parameters = dict(params.as_dict(), import_rows=args.import_rows, repeat=args.repeat)
+write_results(args.output, parameters, results)
+for name, stats in results.items():
+    print('%-30s median %9.2f ms  min %9.2f ms' % (name, stats['median'] * 1000, stats['min'] * 1000))
+
+if args.baseline:
+    regressions = 0
+    for name, reference, value, ratio, regressed in compare(results, load_results(args.baseline)['results'],
+                                                            args.tolerance):
+        print('%-30s %6.2fx%s' % (name, ratio, '  REGRESSION' if regressed else ''))
+        regressions += regressed
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Runs the micro-benchmarks of the per-row helper functions and writes the results as JSON.
+If a baseline result file is given, the exit status is 1 if a helper regressed beyond the tolerance,
+i.e. if its calls per second dropped or its peak allocation per call grew by more than the tolerance.
+"""
+import sys
+import os
+import argparse
+
+# ensure lpm is found and can be directly imported from this file
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from benchmarks import create_app, write_results, load_results, compare, micro
+
+# allocation differences below this size (bytes) are never considered regressions
+_MIN_ALLOC_DIFFERENCE = 1024
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('names', nargs='*', help='the benchmarks to run (default: all)')
+parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per benchmark')
+parser.add_argument('--min-time', type=float, default=0.2, help='minimum duration of a timed run (seconds)')
+parser.add_argument('--xls-rows', default='1000,10000,100000', help='comma-separated row counts of the workbooks')
+parser.add_argument('--output', default='microbenchmark-results.json', help='result file')
+parser.add_argument('--baseline', help='result file to compare against')
+parser.add_argument('--tolerance', type=float, default=0.1, help='accepted regression (fraction)')
+parser.add_argument('--override', action='append', default=list(), metavar='NAME=TOLERANCE',
+                    help='benchmark-specific tolerance, may be given multiple times')
+args = parser.parse_args()
+
+xls_rows = [int(rows) for rows in args.xls_rows.split(',') if rows]
+# the micro-benchmarks do not access the database
+app = create_app(LPM_CREATE_INDEXES=False, LPM_METRICS=False, LPM_DB_PROFILING=False)
+results = micro.run(app, repeat=args.repeat, min_time=args.min_time, xls_rows=xls_rows, names=args.names or None)
+write_results(args.output, dict(repeat=args.repeat, min_time=args.min_time, xls_rows=xls_rows), results)
+for name, stats in results.items():
+    print('%-30s %14.1f ops/s %12d bytes/call' % (name, stats['ops_per_sec'], stats['alloc_peak_bytes']))
+
+if args.baseline:
+    tolerances = dict(override.split('=', 1) for override in args.override)
+    baseline = load_results(args.baseline)['results']
+    regressions = 0
+    for name in results.keys():
+        if name not in baseline:
+            continue
+        tolerance = float(tolerances.get(name, args.tolerance))
+        single = {name: results[name]}
+        name, _, _, speed, slower = compare(single, baseline, tolerance, 'ops_per_sec', higher_is_better=True)[0]
+        reference, value, memory, larger = compare(single, baseline, tolerance, 'alloc_peak_bytes')[0][1:]
+        larger = larger and value - reference > _MIN_ALLOC_DIFFERENCE
+        print('%-30s speed %6.2fx  memory %6.2fx%s' % (name, speed, memory, '  REGRESSION' if slower or larger else ''))
+        regressions += slower or larger
+    sys.exit(1 if regressions else 0)
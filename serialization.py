@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization module for lpm
+
+Converts database documents into JSON (MongoDB extended JSON), BSON or MessagePack.
+
+The JSON output is identical to bson.json_util.dumps(). However, instead of converting the whole document tree
+into JSON-compatible objects before encoding it, BSON types are converted by the encoder as they occur.
+Plain types (strings, numbers, lists, dicts) therefore never pass through Python code, which makes
+the serialization of large documents and result lists considerably faster.
+
+MessagePack support requires the optional msgpack package. BSON types are then encoded with
+their extended JSON representation.
+
+:copyright: (c) 2016 Hannes Friederich.
+:license: BSD, see LICENSE for more details.
+"""
+
+import json
+import math
+import calendar
+from datetime import datetime
+from flask import current_app, request
+from bson import BSON, ObjectId, json_util
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+BSON_MIMETYPE = 'application/bson'
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+
+_EPOCH = datetime(1970, 1, 1)
+# the extended JSON representation of dates depends on the pymongo version
+_DATE_TYPE = type(json_util.default(_EPOCH)['$date'])
+_NONFINITE = {'nan': 'NaN', 'inf': 'Infinity', '-inf': '-Infinity'}
+
+
+def _encode_datetime(obj):
+    """
+    Fast version of json_util.default() for the naive UTC datetimes returned by pymongo
+    """
+    if obj.tzinfo is not None or obj < _EPOCH:
+        return json_util.default(obj)
+    millis = obj.microsecond // 1000
+    if _DATE_TYPE is str:
+        return {'$date': '%04d-%02d-%02dT%02d:%02d:%02d%sZ' % (
+            obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second, '.%03d' % millis if millis else '')}
+    if _DATE_TYPE is int:
+        return {'$date': calendar.timegm(obj.utctimetuple()) * 1000 + millis}
+    return json_util.default(obj)
+
+
+def _default(obj):
+    """
+    Converts a single BSON object that is not natively supported by the encoder
+    """
+    if isinstance(obj, ObjectId):  # by far the most frequent case
+        return {'$oid': str(obj)}
+    if isinstance(obj, datetime):
+        return _encode_datetime(obj)
+    try:
+        return json_util.default(obj)
+    except TypeError:
+        # json_util.dumps() converts all other mappings and iterables as well
+        if hasattr(obj, 'items'):
+            return dict(obj.items())
+        if hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes)):
+            return list(obj)
+        raise
+
+
+def _encode_nonfinite(obj):
+    """
+    Returns a copy of the given document tree with NaN and infinite floats replaced by their extended JSON
+    representation, which json.dumps() would otherwise encode as the invalid JSON tokens NaN and Infinity
+    """
+    if isinstance(obj, float) and not math.isfinite(obj):
+        return {'$numberDouble': _NONFINITE[str(obj)]}
+    if isinstance(obj, dict):  # the key order of SON objects is preserved
+        return dict((key, _encode_nonfinite(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_encode_nonfinite(value) for value in obj]
+    return obj
+
+
+def dumps(obj, indent=None):
+    """
+    Returns the extended JSON representation of the given object.
+    Non-finite floats are rare, thus the document tree is only converted if the encoder rejects it
+    """
+    try:
+        return json.dumps(obj, default=_default, indent=indent, allow_nan=False)
+    except ValueError:
+        return json.dumps(_encode_nonfinite(obj), default=lambda value: _encode_nonfinite(_default(value)),
+                          indent=indent, allow_nan=False)
+
+
+def _dumps_bson(obj):
+    return BSON.encode(obj)
+
+
+def _dumps_msgpack(obj):
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+_ENCODERS = [(JSON_MIMETYPE, dumps), (BSON_MIMETYPE, _dumps_bson)]
+if msgpack is not None:
+    _ENCODERS.append((MSGPACK_MIMETYPE, _dumps_msgpack))
+
+
+def negotiate():
+    """
+    Returns the response mimetype according to the client's Accept header.
+    JSON is returned unless the client prefers BSON or MessagePack (if available).
+    """
+    return request.accept_mimetypes.best_match([mimetype for mimetype, _ in _ENCODERS], default=JSON_MIMETYPE)
+
+
+def response(obj):
+    """
+    Returns a response with the given object, encoded in the format requested by the client (see negotiate()).
+    BSON responses require a mapping at the top level.
+    """
+    mimetype = negotiate()
+    encode = dict(_ENCODERS).get(mimetype, dumps)
+    rv = current_app.response_class(encode(obj), mimetype=mimetype)
+    rv.vary.add('Accept')
+    return rv
@@ -7,6 +7,9 @@ lpm considers revisions to be compatible and thus interchangeable.
 
 The database stores the current count and optionally a BOM for a component.
 When the count is updated the BOM rules are considered and the counts of child parts updated accordingly.
+The transitive BOM closure (every ancestor/descendant pair with the cumulative quantity and the minimum number of
+BOM levels between them) is materialized in the bom_closure collection, which answers explosion and where-used
+questions with a single indexed query.
 
 The rules of access are as follows:
 - anyone may view the stock
@@ -21,19 +24,39 @@ Note: There count is not validated, i.e. may become negative.
 :license: BSD, see LICENSE for more details.
 """
 
+import threading
 from datetime import datetime
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from flask import Blueprint, current_app, request, redirect, render_template, url_for, flash
 from flask.ext.login import login_required, current_user
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from bson import ObjectId
 from flask_wtf import Form
 from wtforms import IntegerField, StringField
 from wtforms.validators import InputRequired
 from lpm.login import role_required
-from lpm.utils import extract_errors
-from lpm.components import ensure_exists
-from lpm.xls_files import FileForm, read_xls, save_to_tmp, extract_filepath
+from lpm.jobs import submit as submit_job, report_progress, report_row
+from lpm.utils import extract_errors, versioned
+from lpm.components import ensure_exists, find_existing, get_names
+from lpm.buildable import buildable_quantities
+from lpm.xls_files import FileForm, read_xls, save_to_tmp, import_cached
 
 bp = Blueprint('stock', __name__)
 
+# maximum number of closure entries per bulk write
+_CLOSURE_CHUNK_SIZE = 5000
+_DUPLICATE_KEY_ERROR = 11000
+_CLOSURE_PROJECTION = {'_id': False, 'generation': False}
+
+
+def init(app):
+    """
+    Creates the process-wide BOM graph cache for the given app
+    """
+    app.bom_cache = BomCache()
+
 
 class AddSingleForm(Form):
     quantity = IntegerField(label='Added Quantity', validators=[InputRequired()])
@@ -52,10 +75,12 @@ def overview():
     Shows the overview page containing all components
     """
     objects = list(current_app.mongo.db.stock.find())
-    component_records = current_app.mongo.db.components.find(projection=['name'])
-    names = dict((record['_id'], record['name']) for record in component_records)
+    names = get_names(obj['_id'] for obj in objects)
+    buildable = buildable_quantities(current_app.bom_cache.get(),
+                                     dict((obj['_id'], obj.get('quantity')) for obj in objects))
     for obj in objects:
         obj['name'] = names.get(obj['_id'])
+        obj['buildable'] = buildable.get(obj['_id'])
     return render_template('stock/overview.html', data=objects)
 
 
@@ -63,12 +88,16 @@ def overview():
 @login_required
 def details(partno):
     obj = current_app.mongo.db.stock.find_one_or_404(partno)
-    component_records = current_app.mongo.db.components.find(projection=['name'])
-    names = dict((record['_id'], record['name']) for record in component_records)
-    obj['name'] = names[partno]
-    obj['history'] = list(current_app.mongo.db.stock_history.find({'partno': partno}))
+    used_in = where_used(partno)
+    names = get_names([partno] + [entry.get('partno') for entry in obj.get('bom', list())]
+                      + [entry.get('ancestor') for entry in used_in])
+    obj['name'] = names.get(partno)
+    obj['history'] = list(current_app.mongo.db.stock_history.find({'partno': partno}, sort=[('date', ASCENDING)]))
     for entry in obj.get('bom', list()):
         entry['name'] = names.get(entry.get('partno'))
+    for entry in used_in:
+        entry['name'] = names.get(entry.get('ancestor'))
+    obj['used_in'] = used_in
     batches = list(current_app.mongo.db.stock_batches.find({'partno': partno}))
     return render_template('stock/details.html', data=obj, batches=batches)
 
@@ -87,7 +116,7 @@ def add():
         if request.files.get('file'):
             try:
                 save_to_tmp(form)
-                success, headers, values = _import_file(extract_filepath(form))
+                success, headers, values = import_cached(form, _import_file)
                 # Also add the current quantity to the review list
                 for item in values:
                     current_quantity = 0
@@ -108,19 +137,10 @@ def add():
                 flash(e, 'error')
 
         elif form.tmpname.data:
-            success, headers, values = _import_file(extract_filepath(form))
+            success, headers, values = import_cached(form, _import_file)
             if success:
-                try:
-                    for v in values:
-                        partno = v.get('partno')
-                        quantity = v.get('quantity')
-                        batchname = v.get('batch')
-                        comment = v.get('comment', 'added to stock')
-                        update_counts(partno, quantity, batchname, comment)
-                    flash('stock import successful', 'success')
-                    return redirect(url_for('stock.overview'))
-                except Exception as e:
-                    flash(e, 'error')
+                job_id = submit_job('Stock Addition', _add_job, values, next_url=url_for('stock.overview'))
+                return redirect(url_for('jobs.details', id=job_id))
             return render_template('stock/validate_form.html',
                                    form=form,
                                    headers=headers,
@@ -147,7 +167,7 @@ def correct():
         if request.files.get('file'):
             try:
                 save_to_tmp(form)
-                success, headers, values = _import_file(extract_filepath(form))
+                success, headers, values = import_cached(form, _import_file)
                 for item in values:
                     current_quantity = 0
                     obj = current_app.mongo.db.stock.find_one(item.get('partno'))
@@ -166,18 +186,10 @@ def correct():
                 flash(e, 'error')
 
         elif form.tmpname.data:
-            success, headers, values = _import_file(extract_filepath(form))
+            success, headers, values = import_cached(form, _import_file)
             if success:
-                try:
-                    for v in values:
-                        partno = v.get('partno')
-                        quantity = v.get('quantity')
-                        comment = v.get('comment', 'manual correction')
-                        correct_counts(partno, quantity, comment)
-                    flash('stock correction successful', 'success')
-                    return redirect(url_for('stock.overview'))
-                except Exception as e:
-                    flash(e, 'error')
+                job_id = submit_job('Stock Correction', _correct_job, values, next_url=url_for('stock.overview'))
+                return redirect(url_for('jobs.details', id=job_id))
             return render_template('stock/validate_form.html',
                                    form=form,
                                    headers=headers,
@@ -203,7 +215,7 @@ def update_bom():
         if request.files.get('file'):  # a file was uploaded
             try:
                 save_to_tmp(form)
-                success, headers, values = _import_file(extract_filepath(form))
+                success, headers, values = import_cached(form, _import_file)
                 target_partno = 'unknown'
                 if len(values) > 0:
                     target_partno = values.pop(0).get('partno')
@@ -217,17 +229,14 @@ def update_bom():
                 flash(e, 'error')
 
         elif form.tmpname.data:
-            success, headers, values = _import_file(extract_filepath(form))
+            success, headers, values = import_cached(form, _import_file)
             target_partno = 'unknown'
             if len(values) > 0:
                 target_partno = values.pop(0).get('partno')
             if success:
-                try:
-                    set_bom(target_partno, values)
-                    flash('BOM update successful', 'success')
-                    return redirect(url_for('stock.overview'))
-                except Exception as e:
-                    flash(e, 'error')
+                job_id = submit_job('BOM Update for ' + target_partno, _bom_job, target_partno, values,
+                                    next_url=url_for('stock.overview'))
+                return redirect(url_for('jobs.details', id=job_id))
             return render_template('stock/validate_form.html',
                                    form=form,
                                    headers=headers,
@@ -289,14 +298,15 @@ def update_counts(partno, quantity, batchname, message):
     Updates the given stock entry, creating it if necessary.
     Raises an exception if the part number is not valid or if there is a database problem
     """
-    _check_bom(partno)  # validation
-    _do_update_counts(partno, quantity, batchname, message)
+    ensure_exists(partno)
+    # the BOM rules were validated when they were stored
+    _do_update_counts(partno, quantity, batchname, message, current_app.bom_cache.get())
 
 
 def correct_counts(partno, quantity, message):
     result = current_app.mongo.db.stock.update_one(
             filter={'_id': partno},
-            update={'$set': {'quantity': quantity}},
+            update=versioned({'$set': {'quantity': quantity}}),
             upsert=True,
     )
     if result.modified_count == 0 and result.upserted_id is None:
@@ -333,6 +343,37 @@ def update_batch(partno, batchname, quantity):
         raise RuntimeError('no stock batch object modified nor created')
 
 
+def update_batches(quantities):
+    """
+    Updates several stock batch items with a single database operation, creating them if necessary.
+    The quantities parameter maps (partno, batchname) tuples to the quantity to add.
+    Raises an exception if a part number is not valid or if there is a database problem
+    """
+    if any(quantity < 0 for quantity in quantities.values()):
+        raise ValueError('A batch cannot have negative quantities')
+    partnos = set(partno for partno, batchname in quantities.keys())
+    unknown = partnos - find_existing(partnos)
+    if unknown:
+        raise ValueError('unknown part number %s' % sorted(unknown)[0])
+    requests = list()
+    for (partno, batchname), quantity in quantities.items():
+        if quantity == 0 or not batchname:
+            continue  # nothing to do
+        requests.append(UpdateOne(
+                filter={
+                    'partno': partno,
+                    'name': batchname
+                },
+                update={'$inc': {'quantity': quantity}},
+                upsert=True
+        ))
+    if not requests:
+        return
+    result = current_app.mongo.db.stock_batches.bulk_write(requests, ordered=False)
+    if result.modified_count + result.upserted_count != len(requests):
+        raise RuntimeError('not all stock batch objects modified or created')
+
+
 def set_bom(partno, data):
     """
     Updates the BOM data for the given part number
@@ -343,69 +384,341 @@ def set_bom(partno, data):
         p = item.get('partno')
         ensure_exists(p)
         bomdata.append(dict(partno=p, quantity=int(item['quantity'])))
-    result = current_app.mongo.db.stock.update_one(
+    current_app.bom_cache.get().with_bom(partno, bomdata).check_acyclic()
+    previous = current_app.mongo.db.stock.find_one_and_update(
             filter={'_id': partno},
-            update={'$set': {'bom': bomdata}},
+            update=versioned({'$set': {'bom': bomdata}}),
+            projection=['bom'],
             upsert=True)
-    if result.modified_count == 0 and result.upserted_id is None:
-        raise RuntimeError('no BOM object modified nor created')
+    invalidate_bom_graph(current_app.mongo.db)
+    # a concurrent BOM update may have closed a loop in the meantime, check the stored graph again
+    graph = current_app.bom_cache.get()
+    try:
+        graph.check_acyclic()
+    except RuntimeError:
+        if previous is not None and previous.get('bom') is not None:
+            update = {'$set': {'bom': previous['bom']}}
+        else:
+            update = {'$unset': {'bom': True}}
+        current_app.mongo.db.stock.update_one({'_id': partno}, versioned(update))
+        invalidate_bom_graph(current_app.mongo.db)
+        raise
+    update_bom_closure(current_app.mongo.db, partno, graph)
+
+
+def explode_bom(partno):
+    """
+    Returns the closure entries of all (direct and indirect) BOM children of the given part number,
+    the 'quantity' of each entry is the number of parts consumed by one unit of the given part number
+    """
+    return list(current_app.mongo.db.bom_closure.find({'ancestor': partno}, projection=_CLOSURE_PROJECTION,
+                                                      sort=[('depth', ASCENDING), ('descendant', ASCENDING)]))
+
+
+def where_used(partno):
+    """
+    Returns the closure entries of all assemblies that (directly or indirectly) contain the given part number,
+    the 'quantity' of each entry is the number of parts consumed by one unit of the assembly
+    """
+    return list(current_app.mongo.db.bom_closure.find({'descendant': partno}, projection=_CLOSURE_PROJECTION,
+                                                      sort=[('depth', ASCENDING), ('ancestor', ASCENDING)]))
+
+
+def update_bom_closure(db, partno, graph=None):
+    """
+    Updates the materialized BOM closure after the BOM of the given part number changed.
+    Only the closure of the part number and its ancestors (whose set does not change) is recomputed.
+    The graph must be loaded after the BOM change and must not contain loops. If the BOMs changed again
+    while the closure was stored, the closure is computed once more from the current graph.
+    """
+    while True:
+        if graph is None:
+            graph = BomGraph.load(db)
+        parents = dict()
+        for parent, bom in graph.children.items():
+            for child, quantity in bom:
+                parents.setdefault(child, set()).add(parent)
+        ancestors = {partno}
+        pending = [partno]
+        while pending:
+            for parent in parents.get(pending.pop(), set()):
+                if parent not in ancestors:
+                    ancestors.add(parent)
+                    pending.append(parent)
+        _store_closure(db, graph, list(ancestors), {'ancestor': {'$in': list(ancestors)}})
+        if _bom_version(db) == graph.version:
+            return
+        graph = None
+
+
+def rebuild_bom_closure(db):
+    """
+    Recomputes the complete materialized BOM closure from the stored BOM rules
+    """
+    while True:
+        graph = BomGraph.load(db)
+        _store_closure(db, graph, list(graph.children.keys()), dict())
+        if _bom_version(db) == graph.version:
+            return
+
+
+def _store_closure(db, graph, ancestors, scope):
+    """
+    Upserts the closure entries of the given ancestors, then removes the outdated entries within the given scope
+    (a filter). Readers thus never see an incomplete closure.
+    Every call writes a new generation (an ObjectId, thus increasing over time). Entries of a newer generation
+    are never overwritten and only entries of older generations are removed, such that concurrent updates of
+    shared ancestors do not remove each other's entries. The caller must check that the graph is still current.
+    """
+    generation = ObjectId()
+    requests = list()
+    closure = dict()
+    for ancestor in ancestors:
+        for descendant, (quantity, depth) in _descendants(graph, ancestor, closure).items():
+            requests.append(UpdateOne(
+                    filter={'ancestor': ancestor, 'descendant': descendant,
+                            'generation': {'$not': {'$gt': generation}}},
+                    update={'$set': {'quantity': quantity, 'depth': depth, 'generation': generation}},
+                    upsert=True
+            ))
+    for idx in range(0, len(requests), _CLOSURE_CHUNK_SIZE):
+        chunk = requests[idx:idx+_CLOSURE_CHUNK_SIZE]
+        for attempt in range(2):
+            try:
+                db.bom_closure.bulk_write(chunk, ordered=False)
+                break
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', list())
+                if any(error.get('code') != _DUPLICATE_KEY_ERROR for error in errors):
+                    raise
+                # the entry either exists with a newer generation (which is kept) or was inserted by a
+                # concurrent upsert, in which case the retry updates it
+                chunk = [chunk[error['index']] for error in errors]
+    db.bom_closure.delete_many(dict(scope, generation={'$lt': generation}))
+
+
+def invalidate_bom_graph(db):
+    """
+    Marks the cached BOM graphs of all processes as outdated, must be called after every BOM change
+    """
+    db.unique_numbers.update_one({'_id': 'bom'}, {'$inc': {'seq': 1}}, upsert=True)
+
+
+class BomGraph:
+    """
+    Immutable snapshot of all BOM rules: maps part numbers to their list of (child part number, quantity) tuples.
+    The order property lists all part numbers with a BOM and their children such that every assembly comes before
+    its children, it raises RuntimeError if the graph contains a loop (see check_acyclic()).
+    """
+
+    def __init__(self, children, version=None):
+        self.version = version
+        self.children = children
+        self._order = None
+
+    @classmethod
+    def load(cls, db):
+        # read the version first, a concurrent BOM change then leads to a reload on the next access
+        version = _bom_version(db)
+        children = dict()
+        for obj in db.stock.find({'bom.0': {'$exists': True}}, projection=['bom']):
+            children[obj['_id']] = [(entry.get('partno'), entry.get('quantity')) for entry in obj['bom']]
+        return cls(children, version)
+
+    @property
+    def order(self):
+        if self._order is None:
+            self._order = BomGraph._topological_order(self.children)
+        return self._order
+
+    def bom(self, partno):
+        return self.children.get(partno, list())
+
+    def check_acyclic(self):
+        """
+        Raises RuntimeError if the graph contains a loop
+        """
+        self.order
+
+    def with_bom(self, partno, bomdata):
+        """
+        Returns the graph that results from setting the given BOM data
+        """
+        children = dict(self.children)
+        children[partno] = [(entry.get('partno'), entry.get('quantity')) for entry in bomdata]
+        return BomGraph(children)
+
+    @staticmethod
+    def _topological_order(children):
+        indegree = dict()
+        for partno, bom in children.items():
+            indegree.setdefault(partno, 0)
+            for child, quantity in bom:
+                indegree[child] = indegree.get(child, 0) + 1
+        queue = deque(partno for partno, degree in indegree.items() if degree == 0)
+        order = list()
+        while queue:
+            partno = queue.popleft()
+            order.append(partno)
+            for child, quantity in children.get(partno, list()):
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    queue.append(child)
+        if len(order) != len(indegree):
+            raise RuntimeError('Infinite loop detected')
+        return order
+
 
+class BomCache:
+    """
+    Thread-safe cache for the BOM graph. Every access compares the cached version with the BOM version
+    stored in the database (a single query) and reloads the graph if another BOM has been stored since.
+    """
+
+    def __init__(self):
+        self._graph = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        db = current_app.mongo.db
+        version = _bom_version(db)
+        graph = self._graph
+        if graph is not None and graph.version == version:
+            return graph
+        with self._lock:
+            # another thread may have loaded the graph while this one was waiting for the lock
+            graph = self._graph
+            if graph is None or graph.version != version:
+                graph = BomGraph.load(db)
+                self._graph = graph
+        return graph
+
+    def clear(self):
+        with self._lock:
+            self._graph = None
 
-def _do_update_counts(partno, quantity, batchname, message):
+
+def _bom_version(db):
+    obj = db.unique_numbers.find_one('bom')
+    return obj.get('seq') if obj else 0
+
+
+def _do_update_counts(partno, quantity, batchname, message, graph):
     if quantity == 0:
         return  # nothing to do
 
-    # update the current component including batch and history before following the BOM rules.
-    # in case there is a database problem the highest-level stock entry will most likely be correct.
-    result = current_app.mongo.db.stock.update_one(
-            filter={'_id': partno},
-            update={'$inc': {'quantity': quantity}},
-            upsert=True
-    )
-    if result.modified_count == 0 and result.upserted_id is None:
-        raise RuntimeError('database update problem: %s' % str(result))
+    # compute the stock deltas first and apply them with a single bulk write.
+    # the current component is updated first (ordered write), thus in case there is a database problem
+    # the highest-level stock entry will most likely be correct.
+    deltas = _explode(graph, partno, quantity)
+    requests = [UpdateOne(filter={'_id': pn}, update=versioned({'$inc': {'quantity': delta}}), upsert=True)
+                for pn, delta in deltas.items()]
+    result = current_app.mongo.db.stock.bulk_write(requests)
+    if result.modified_count + result.upserted_count != len(requests):
+        raise RuntimeError('database update problem: %s' % str(result.bulk_api_result))
     if quantity > 0:
         update_batch(partno, batchname, quantity)
-    result = current_app.mongo.db.stock_history.insert_one({
-        'date': datetime.now(),
-        'partno': partno,
-        'delta': quantity,
-        'message': message
-    })
-    if result.inserted_id is None:
+    now = datetime.now()
+    history = [{
+        'date': now,
+        'partno': pn,
+        'delta': delta,
+        'message': message if pn == partno else '(BOM rule)'
+    } for pn, delta in deltas.items()]
+    result = current_app.mongo.db.stock_history.insert_many(history)
+    if len(result.inserted_ids) != len(history):
         raise RuntimeError('no stock history object created')
 
-    # only run the BOM rules if something is added to the stock
+
+def _explode(graph, partno, quantity):
+    """
+    Returns the stock deltas (an ordered dict partno -> delta, starting with the given part number) for adding
+    the given quantity to the stock. Only additions follow the BOM rules, which consume the direct BOM children.
+    Several BOM entries of the same child are merged, children with a zero net delta are omitted.
+    """
+    deltas = OrderedDict([(partno, quantity)])
     if quantity <= 0:
-        return
-    bom = current_app.mongo.db.stock.find_one(partno).get('bom', list())
-    for item in bom:
-        _do_update_counts(item.get('partno'), quantity*item.get('quantity')*-1, None, '(BOM rule)')
+        return deltas
+    for pn, factor in graph.bom(partno):
+        deltas[pn] = deltas.get(pn, 0) - quantity*factor
+    for pn in [pn for pn, delta in deltas.items() if delta == 0 and pn != partno]:
+        del deltas[pn]
+    return deltas
 
 
-def _check_bom(partno, tree=set()):
+def _descendants(graph, partno, closure):
     """
-    Recursively checks that the BOM tree is valid.
-    The tree parameter tracks the parents of the current node, use an empty set for the top-level component
+    Returns a dict that maps all descendants of the given part number to a (cumulative quantity, minimum depth) tuple.
+    The quantities of several BOM paths to the same descendant are summed up. The closure dict memoizes the
+    results per part number, the graph must be acyclic
     """
-    ensure_exists(partno)
+    if partno in closure:
+        return closure[partno]
+    result = dict()
+    for child, quantity in graph.bom(partno):
+        entries = [(child, quantity, 1)]
+        entries.extend((pn, quantity*q, depth+1) for pn, (q, depth) in _descendants(graph, child, closure).items())
+        for pn, q, depth in entries:
+            if pn in result:
+                result[pn] = (result[pn][0] + q, min(result[pn][1], depth))
+            else:
+                result[pn] = (q, depth)
+    closure[partno] = result
+    return result
 
-    # obtain the BOM
-    obj = current_app.mongo.db.stock.find_one(partno)
-    if not obj:
-        return
-    bom = obj.get('bom', list())
-    if len(bom) == 0:
-        return
 
-    # recursively check the BOM
-    tree.add(partno)
-    for entry in bom:
-        pn = entry.get('partno')
-        if pn in tree:
-            raise RuntimeError('Infinite loop detected')
-        _check_bom(pn, tree)
-    tree.remove(partno)
+def _add_job(data):
+    """
+    Background job for add()
+    The result of every row is stored in the job, the job stops at the first failed row.
+    """
+    for idx, v in enumerate(data):
+        partno = v.get('partno')
+        quantity = v.get('quantity')
+        batchname = v.get('batch')
+        comment = v.get('comment', 'added to stock')
+        with _job_row(idx, len(data), partno):
+            update_counts(partno, quantity, batchname, comment)
+        report_row(idx+2, 'applied', partno=partno, quantity=quantity)
+        report_progress(idx+1, len(data))
+    flash('stock import successful', 'success')
+
+
+def _correct_job(data):
+    """
+    Background job for correct()
+    The result of every row is stored in the job, the job stops at the first failed row.
+    """
+    for idx, v in enumerate(data):
+        partno = v.get('partno')
+        quantity = v.get('quantity')
+        comment = v.get('comment', 'manual correction')
+        with _job_row(idx, len(data), partno):
+            correct_counts(partno, quantity, comment)
+        report_row(idx+2, 'applied', partno=partno, quantity=quantity)
+        report_progress(idx+1, len(data))
+    flash('stock correction successful', 'success')
+
+
+@contextmanager
+def _job_row(idx, total, partno):
+    """
+    Records a failure of the given data row (row numbers as in the imported file) in the current job
+    """
+    try:
+        yield
+    except Exception as e:
+        report_row(idx+2, 'failed', partno=partno, message=str(e))
+        flash('%d of %d rows were applied before row %d failed' % (idx, total, idx+2), 'message')
+        raise
+
+
+def _bom_job(partno, data):
+    """
+    Background job for update_bom()
+    """
+    set_bom(partno, data)
+    flash('BOM update successful', 'success')
 
 
 def _import_file(filepath):
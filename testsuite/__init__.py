@@ -4,6 +4,7 @@ import base64
 import dateutil.parser
 from flask import Flask
 import lpm
+from lpm import indexes, stock
 
 
 class TestCase(unittest.TestCase):
@@ -92,6 +93,7 @@ class TestCase(unittest.TestCase):
                     'TE0001a': {'key1', 'key2'},
                     'default': set(),
                 },
+                LPM_JOB_WORKERS=0,
         )
         lpm.init(self.app)
         self.client = self.app.test_client()
@@ -105,14 +107,13 @@ class TestCase(unittest.TestCase):
     def logout(self):
         return self.client.get('/logout', follow_redirects=True)
 
-    def open_with_auth(self, url, method='GET', data=None, username='admin', **kwargs):
+    def open_with_auth(self, url, method='GET', data=None, username='admin', headers=None, **kwargs):
         """
         Helper function that requests a page with basic authorization header
         """
         value = (username + ':1234').encode('utf-8')
-        headers = {
-            'Authorization': b'Basic ' + base64.b64encode(value)
-        }
+        headers = dict(headers or dict())
+        headers['Authorization'] = b'Basic ' + base64.b64encode(value)
         return self.client.open(url, method=method, headers=headers, data=data, **kwargs)
 
 
@@ -137,6 +138,12 @@ class DataBaseTestCase(TestCase):
             db.stock_history.drop()
             db.items.drop()
             db.unique_numbers.drop()
+            db.jobs.drop()
+            db.job_rows.drop()
+            db.item_comments.drop()
+            db.metrics.drop()
+            db.bom_closure.drop()
+            indexes.apply(db)
 
             db.components.insert([
                 {
@@ -274,6 +281,7 @@ class DataBaseTestCase(TestCase):
                     ]
                 },
             ])
+            stock.rebuild_bom_closure(db)
             db.stock_batches.insert([
                 {
                     'partno': 'TE0001',
@@ -286,6 +294,5 @@ class DataBaseTestCase(TestCase):
                 'partno': 'TE0001a',
                 'available': True,
                 'status': '',
-                'comments': []
             })
 
@@ -0,0 +1,41 @@
+from testsuite import DataBaseTestCase
+from benchmarks import dataset, compare, measure, micro
+
+
+class BenchmarksTest(DataBaseTestCase):
+
+    def test_dataset(self):
+        params = dataset.Parameters(components=50, items=200, depth=2, fanout=3, history=4, fields=2, seed=1)
+        levels = dataset.bom_levels(params)
+        self.assertEqual(3, len(levels))
+        self.assertEqual(50, sum(len(level) for level in levels))
+        with self.app.app_context():
+            db = self.app.mongo.db
+            dataset.generate(db, params)
+            self.assertEqual(50, db.components.count())
+            self.assertEqual(200, db.items.count())
+            self.assertEqual(200, db.stock_history.count())
+            top = db.stock.find_one(levels[0][0])
+            self.assertEqual(3, len(top.get('bom')))
+            self.assertTrue(all(entry['partno'] in levels[1] for entry in top.get('bom')))
+            self.assertIsNone(db.stock.find_one(levels[-1][0]).get('bom'))
+            first = list(db.items.find(sort=[('_id', 1)]))
+            # the generator is deterministic
+            dataset.generate(db, params)
+            self.assertEqual(first, list(db.items.find(sort=[('_id', 1)])))
+
+    def test_compare(self):
+        self.assertEqual(3, measure(lambda: None, repeat=3)['runs'])
+        results = {'a': {'median': 1.5}, 'b': {'median': 1.0}, 'c': {'median': 1.0}}
+        baseline = {'a': {'median': 1.0}, 'b': {'median': 1.0}}
+        self.assertEqual([('a', 1.0, 1.5, 1.5, True), ('b', 1.0, 1.0, 1.0, False)],
+                         compare(results, baseline, 0.2))
+        self.assertEqual([('a', 1.0, 1.5, 1.5, False)], compare(results, baseline, 0.2, higher_is_better=True)[:1])
+
+    def test_micro(self):
+        names = ['PartNumber.parse', 'items.process_requirements', 'xls_files.read_xls.10']
+        results = micro.run(self.app, repeat=1, min_time=0.001, xls_rows=(10,), names=names)
+        self.assertEqual(names, list(results.keys()))
+        for stats in results.values():
+            self.assertGreater(stats['ops_per_sec'], 0)
+            self.assertGreater(stats['alloc_peak_bytes'], 0)
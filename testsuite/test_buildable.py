@@ -0,0 +1,69 @@
+import random
+from testsuite import DataBaseTestCase
+from lpm import buildable
+from lpm.stock import BomGraph
+
+
+class BuildableTest(DataBaseTestCase):
+
+    def test_buildable_quantities(self):
+        graph = BomGraph({
+            'TE0002': [('TE0001', 2), ('TE0003', 1)],
+            'TE0003': [('TE0001', 1)],
+            'TE0004': [('TE0002', 3), ('TE0005', 0)],  # zero quantities are ignored
+        })
+        quantities = dict(TE0001=100, TE0002=35, TE0003=-20)
+        # every TE0002 requires 3 TE0001 (TE0003 is not in stock), TE0004 uses the TE0002 in stock first
+        expected = dict(TE0002=33, TE0003=100, TE0004=22)
+        self.assertEqual(expected, buildable.buildable_quantities(graph, quantities))
+        self.assertEqual(expected, buildable._Plan(graph).evaluate(quantities))
+        self.assertEqual(dict(), buildable.buildable_quantities(BomGraph(dict()), quantities))
+        quantities['TE0003'] = 20
+        self.assertEqual(40, buildable.buildable_quantities(graph, quantities)['TE0002'])
+        with self.assertRaises(RuntimeError):
+            buildable.buildable_quantities(BomGraph({'TE0001': [('TE0002', 1)], 'TE0002': [('TE0001', 1)]}), dict())
+
+    def test_generated_graph(self):
+        # multi-level BOM with shared parts (every assembly uses 4 random parts of the next level)
+        rnd = random.Random(0)
+        levels = [['GA%04d' % (level*100 + idx) for idx in range(100)] for level in range(6)]
+        children = dict()
+        quantities = dict()
+        for level, parts in zip(levels, levels[1:] + [list()]):
+            for partno in level:
+                quantities[partno] = rnd.choice([0, 0, rnd.randint(0, 50)]) if parts else rnd.randint(0, 1000)
+                if parts:
+                    children[partno] = [(child, rnd.randint(1, 4)) for child in rnd.sample(parts, 4)]
+        graph = BomGraph(children)
+        result = buildable.buildable_quantities(graph, quantities)
+        self.assertEqual(500, len(result))
+        for partno in rnd.sample(sorted(result), 25):
+            self.assertEqual(_reference(graph, quantities, partno), result[partno])
+
+        # only the assemblies that contain changed parts are calculated again
+        for partno in rnd.sample(sorted(quantities), 10):
+            quantities[partno] = rnd.randint(0, 100)
+        self.assertEqual(buildable._Plan(graph).evaluate(quantities), buildable.buildable_quantities(graph, quantities))
+
+    def test_overview(self):
+        self.login('viewer')
+        rv = self.client.get('/stock/')
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(b'Buildable', rv.data)
+
+
+def _reference(graph, quantities, partno):
+    """
+    Straightforward calculation of the buildable quantity: nets the requirements of n units through the whole
+    BOM graph for n = 0, 1, ... until a plain part runs out of stock
+    """
+    count = 0
+    while True:
+        required = {partno: count + 1}
+        for pn in graph.order:
+            missing = required.get(pn, 0) if pn == partno else max(required.get(pn, 0) - quantities.get(pn, 0), 0)
+            for child, quantity in graph.bom(pn):
+                required[child] = required.get(child, 0) + missing * quantity
+        if any(required.get(pn, 0) > quantities.get(pn, 0) for pn in graph.order if not graph.bom(pn)):
+            return count
+        count += 1
@@ -2,6 +2,7 @@ import os
 import shutil
 from io import BytesIO
 from werkzeug.exceptions import NotFound, HTTPException
+from pymongo.collection import Collection
 from testsuite import DataBaseTestCase
 from lpm import components
 
@@ -15,28 +16,32 @@ class ComponentTest(DataBaseTestCase):
         self.assertIsNone(pn.revision)
         self.assertIsNone(pn.revision_number)
         self.assertEqual('AB0032', str(pn))
-        pn.set_num_revisions(5)
-        self.assertEqual('AB0032e', pn.id)
-        self.assertEqual('AB0032', pn.base_number)
-        self.assertEqual('e', pn.revision)
-        self.assertEqual(4, pn.revision_number)
-        self.assertEqual('AB0032e', str(pn))
-        self.assertFalse(pn.is_outdated())
+        view = pn.with_num_revisions(5)
+        self.assertEqual('AB0032e', view.id)
+        self.assertEqual('AB0032', view.base_number)
+        self.assertEqual('e', view.revision)
+        self.assertEqual(4, view.revision_number)
+        self.assertEqual('AB0032e', str(view))
+        self.assertFalse(view.is_outdated())
+        self.assertEqual('AB0032', pn.id)  # the parsed part number is not modified
+        self.assertIs(pn, components.PartNumber('AB0032'))  # parsed part numbers are shared
+        with self.assertRaises(AttributeError):
+            pn._rev = 'a'
         pn = components.PartNumber('AB0032c')
         self.assertEqual('AB0032c', pn.id)
         self.assertEqual('AB0032', pn.base_number)
         self.assertEqual('c', pn.revision)
         self.assertEqual(2, pn.revision_number)  # revision is zero-based
         self.assertEqual('AB0032c', str(pn))
-        pn.set_num_revisions(6)
-        self.assertEqual('AB0032c', pn.id)
-        self.assertEqual('AB0032', pn.base_number)
-        self.assertEqual('c', pn.revision)
-        self.assertEqual(2, pn.revision_number)  # revision is zero-based
-        self.assertEqual('AB0032c', str(pn))
-        self.assertEqual('AB0032a', pn.revision_id(0))
-        self.assertEqual('AB0032d', pn.revision_id(3))
-        self.assertTrue(pn.is_outdated())
+        view = pn.with_num_revisions(6)
+        self.assertEqual('AB0032c', view.id)
+        self.assertEqual('AB0032', view.base_number)
+        self.assertEqual('c', view.revision)
+        self.assertEqual(2, view.revision_number)  # revision is zero-based
+        self.assertEqual('AB0032c', str(view))
+        self.assertEqual('AB0032a', view.revision_id(0))
+        self.assertEqual('AB0032d', view.revision_id(3))
+        self.assertTrue(view.is_outdated())
 
         with self.assertRaises(ValueError):
             components.PartNumber('AB032a')  # number too short
@@ -54,6 +59,43 @@ class ComponentTest(DataBaseTestCase):
             self.assertEqual('LP0001', components._create_new_partno())
             self.assertEqual('LP0002', components._create_new_partno())
 
+    def test_name_cache(self):
+        with self.app.app_context():
+            names = components.get_names(['TE0001', 'TE0002', 'TE0012'])
+            self.assertEqual({'TE0001': 'Test Item 1', 'TE0002': 'Test Item 2'}, names)
+            # cached entries are not re-read from the database
+            self.app.mongo.db.components.update_one({'_id': 'TE0001'}, {'$set': {'name': 'changed'}})
+            self.assertEqual('Test Item 1', components.get_name('TE0001'))
+            self.app.component_names.invalidate('TE0001')
+            self.assertEqual('changed', components.get_name('TE0001'))
+            self.assertIsNone(components.get_name('TE0012'))
+
+            # least recently used entries are evicted first
+            cache = components.NameCache(2)
+            cache.get_names(['TE0001', 'TE0002'])
+            cache.get_names(['TE0001'])
+            cache.get_names(['TE0003'])
+            self.app.mongo.db.components.update_many({}, {'$set': {'name': 'renamed'}})
+            self.assertEqual({'TE0001': 'changed', 'TE0002': 'renamed', 'TE0003': 'Test Item 3'},
+                             cache.get_names(['TE0001', 'TE0002', 'TE0003']))
+
+            # names loaded while an entry is invalidated are not cached
+            cache = components.NameCache(2)
+            find = Collection.find
+
+            def concurrent_find(collection, *args, **kwargs):
+                cursor = find(collection, *args, **kwargs)
+                cache.invalidate('TE0001')  # e.g. a rename in another thread
+                return cursor
+
+            Collection.find = concurrent_find
+            try:
+                self.assertEqual({'TE0001': 'renamed'}, cache.get_names(['TE0001']))
+            finally:
+                Collection.find = find
+            self.app.mongo.db.components.update_one({'_id': 'TE0001'}, {'$set': {'name': 'changed again'}})
+            self.assertEqual({'TE0001': 'changed again'}, cache.get_names(['TE0001']))
+
     def test_load_active(self):
         with self.app.test_request_context():
             with self.assertRaises(NotFound):
@@ -113,6 +155,31 @@ class ComponentTest(DataBaseTestCase):
         self.assertNotIn(b'not yet been released', rv.data)
         self.assertIn(b'obsolete', rv.data)
 
+    def test_details_conditional(self):
+        self.login('worker')
+        rv = self.client.get('/components/TE0001')
+        self.assertEqual(200, rv.status_code)
+        etag = rv.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        rv = self.client.get('/components/TE0001', headers={'If-None-Match': etag})
+        self.assertEqual(304, rv.status_code)
+        rv = self.client.get('/components/TE0001b', headers={'If-None-Match': etag})
+        self.assertEqual(200, rv.status_code)
+        self.logout()
+        # the page depends on the user
+        self.login('admin')
+        rv = self.client.get('/components/TE0001', headers={'If-None-Match': etag})
+        self.assertEqual(200, rv.status_code)
+        rv = self.client.post('/components/TE0001/release')
+        self.assertEqual(302, rv.status_code)
+        self.logout()
+        self.login('worker')
+        rv = self.client.get('/components/TE0001', headers={'If-None-Match': etag})
+        self.assertEqual(200, rv.status_code)
+        self.assertNotIn(b'not yet been released', rv.data)
+        self.logout()
+
+
     def test_details_files(self):
         if not os.path.exists('/tmp/TE0001a'):
             os.makedirs('/tmp/TE0001a')
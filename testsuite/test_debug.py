@@ -29,6 +29,52 @@ class DebugTest(DataBaseTestCase):
 
         with self.app.app_context():
             dbobj = self.app.mongo.db.items.find_one('LP0001')
+            self.assertEqual(1, dbobj.pop('_version'))  # the edit creates a new version
+            self.assertIsNotNone(dbobj.pop('_modified'))
             self.assertEqual(obj, dbobj)
 
+        # a stale form (based on the previous version) is rejected
+        rv = self.client.post('/debug/items/LP0001', data=dict(document=objstr))
+        self.assertIn(b'the document was modified in the meantime', rv.data)
+        with self.app.app_context():
+            self.assertEqual(1, self.app.mongo.db.items.find_one('LP0001').get('_version'))
 
+    def test_debug_stock(self):
+        self.login('admin')
+        obj = {'_id': 'TE0001', 'quantity': 100, 'bom': [{'partno': 'TE0002', 'quantity': 1}]}
+        rv = self.client.post('/debug/stock/TE0001', data=dict(document=dumps(obj)))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(b'Infinite loop detected', rv.data)
+        obj = {'_id': 'TE0003', 'quantity': 20, 'bom': [{'partno': 'TE0001', 'quantity': 4}]}
+        rv = self.client.post('/debug/stock/TE0003', data=dict(document=dumps(obj)))
+        self.assertIn(b'data successfully updated', rv.data)
+        with self.app.app_context():
+            self.assertIsNone(self.app.mongo.db.stock.find_one('TE0001').get('bom'))
+            entry = self.app.mongo.db.bom_closure.find_one({'ancestor': 'TE0002', 'descendant': 'TE0001'})
+            self.assertEqual(6, entry.get('quantity'))
+
+    def test_profile(self):
+        self.login('viewer')
+        rv = self.client.get('/items/LP0001/')
+        self.assertEqual(200, rv.status_code)
+        self.assertIn('db;dur=', rv.headers.get('Server-Timing'))
+        rv = self.client.get('/debug/profile')
+        self.assertEqual(302, rv.status_code)
+        self.logout()
+        self.login('admin')
+        rv = self.client.get('/debug/profile?sort=count')
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(b'items.details', rv.data)
+        self.assertIn(b'items.find', rv.data)
+        entry = [entry for entry in self.app.db_profile.top() if entry['endpoint'] == 'items.details'][0]
+        self.assertEqual(1, entry['requests'])
+        self.assertGreater(entry['count'], 0)
+        # unknown paths share a single entry
+        self.client.get('/unknown/1')
+        self.client.get('/unknown/2')
+        endpoints = [entry['endpoint'] for entry in self.app.db_profile.top()]
+        self.assertIn('<unmatched>', endpoints)
+        self.assertNotIn('/unknown/1', endpoints)
+        rv = self.client.post('/debug/profile', follow_redirects=True)
+        self.assertEqual(200, rv.status_code)
+        self.assertNotIn(b'items.details', rv.data)
@@ -1,5 +1,8 @@
+from bson import BSON
 from bson.json_util import loads, dumps
+from flask.ext.login import login_user, logout_user
 from testsuite import DataBaseTestCase
+from lpm import items, auth, ext
 
 
 class ExtApiTest(DataBaseTestCase):
@@ -29,6 +32,32 @@ class ExtApiTest(DataBaseTestCase):
         self.assertFalse(data.get('ok'))
         self.assertIn('missing filter', data.get('message'))
 
+    def test_item_filter_paging(self):
+        with self.app.app_context():
+            self.app.mongo.db.items.insert([
+                {'_id': serial, 'partno': 'TE0001a', 'available': True, 'status': ''}
+                for serial in ['LP0004', 'LP0002', 'LP0003']
+            ])
+        rv = self.open_with_auth('/ext/items', username='viewer', method='POST',
+                                 data=dict(filter='{"partno": "TE0001a"}', limit='3'))
+        data = loads(rv.data.decode('utf-8'))
+        self.assertTrue(data.get('ok'))
+        self.assertEqual(['LP0001', 'LP0002', 'LP0003'], data.get('serials'))
+        self.assertEqual('LP0003', data.get('next'))
+        rv = self.open_with_auth('/ext/items', username='viewer', method='POST',
+                                 data=dict(filter='{"partno": "TE0001a"}', limit='3', after='LP0003'))
+        data = loads(rv.data.decode('utf-8'))
+        self.assertEqual(['LP0004'], data.get('serials'))
+        self.assertIsNone(data.get('next'))
+        rv = self.open_with_auth('/ext/items', username='viewer', method='POST',
+                                 data=dict(filter='{"partno": "TE0001a"}', after='LP0001', format='ndjson'))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('application/x-ndjson', rv.mimetype)
+        self.assertEqual(b'"LP0002"\n"LP0003"\n"LP0004"\n', rv.data)
+        rv = self.open_with_auth('/ext/items', username='viewer', method='POST',
+                                 data=dict(filter='{"partno": "TE0001a"}', limit='2', format='ndjson'))
+        self.assertEqual(b'"LP0001"\n"LP0002"\n', rv.data)
+
     def test_item_info(self):
         # insufficient privileges -> redirect to login
         rv = self.open_with_auth('/ext/items/LP0001', username='worker')
@@ -42,9 +71,193 @@ class ExtApiTest(DataBaseTestCase):
             'partno': 'TE0001a',
             'available': True,
             'status': '',
-            'comments': []
         }
         self.assertEqual(refobj, obj)
+        rv = self.open_with_auth('/ext/items/LP0001', headers={'Accept': 'application/bson'})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('application/bson', rv.mimetype)
+        self.assertEqual(refobj, BSON(rv.data).decode())
+
+    def test_item_info_conditional(self):
+        rv = self.open_with_auth('/ext/items/LP0001')
+        self.assertEqual(200, rv.status_code)
+        etag = rv.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        rv = self.open_with_auth('/ext/items/LP0001', headers={'If-None-Match': etag})
+        self.assertEqual(304, rv.status_code)
+        self.assertEqual(b'', rv.data)
+        # the representation depends on the requested format
+        rv = self.open_with_auth('/ext/items/LP0001', headers={'If-None-Match': etag, 'Accept': 'application/bson'})
+        self.assertEqual(200, rv.status_code)
+        # any modification changes the version
+        rv = self.open_with_auth('/ext/items/update/LP0001', method='POST', data=dict(comment='some comment'))
+        self.assertTrue(loads(rv.data.decode('utf-8')).get('ok'))
+        rv = self.open_with_auth('/ext/items/LP0001', headers={'If-None-Match': etag})
+        self.assertEqual(200, rv.status_code)
+        self.assertNotEqual(etag, rv.headers.get('ETag'))
+        self.assertEqual(2, loads(rv.data.decode('utf-8')).get('_version'))  # the update and the comment
+        last_modified = rv.headers.get('Last-Modified')
+        self.assertIsNotNone(last_modified)
+        rv = self.open_with_auth('/ext/items/LP0001', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(304, rv.status_code)
+        rv = self.open_with_auth('/ext/items/LP0001', headers={'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+        self.assertEqual(200, rv.status_code)
+
+    def test_update_status(self):
+        rv = self.open_with_auth('/ext/items/update-status', username='admin', method='POST',
+                                 data=dict(serials='["LP0001", "LP0002"]', status='obsolete', comment='gone'))
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data.decode('utf-8'))
+        self.assertFalse(data.get('ok'))
+        self.assertEqual({'LP0001': None, 'LP0002': "unknown serial number 'LP0002'"}, data.get('results'))
+        with self.app.app_context():
+            obj = self.app.mongo.db.items.find_one('LP0001')
+            self.assertEqual('obsolete', obj.get('status'))
+            self.assertFalse(obj.get('available'))
+            comments = items.get_comments('LP0001')
+            self.assertEqual('gone', comments[-1].get('message'))
+        rv = self.open_with_auth('/ext/items/update-status', username='admin', method='POST',
+                                 data=dict(filter='{"partno": "TE0001a"}', status='obsolete'))
+        data = loads(rv.data.decode('utf-8'))
+        self.assertFalse(data.get('ok'))
+        self.assertEqual({'LP0001': "Invalid status transition: from 'obsolete' to 'obsolete'"}, data.get('results'))
+        rv = self.open_with_auth('/ext/items/update-status', username='admin', method='POST',
+                                 data=dict(status='obsolete'))
+        data = loads(rv.data.decode('utf-8'))
+        self.assertFalse(data.get('ok'))
+        self.assertEqual('missing serials or filter', data.get('message'))
+
+    def test_item_multi_info(self):
+        with self.app.app_context():
+            self.app.mongo.db.items.insert({'_id': 'LP0002', 'partno': 'TE0002a', 'available': False,
+                                            'status': 'shipped'})
+        rv = self.open_with_auth('/ext/items/get', username='viewer', method='POST',
+                                 data=dict(serials='["LP0002", "LP0009", "LP0001"]'))
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data.decode('utf-8'))
+        self.assertTrue(data.get('ok'))
+        self.assertEqual(['LP0002', 'LP0001'], [item.get('_id') for item in data.get('items')])
+        self.assertEqual({'_id': 'LP0001', 'partno': 'TE0001a', 'available': True, 'status': ''},
+                         data.get('items')[1])
+        self.assertEqual(['LP0009'], data.get('missing'))
+        rv = self.open_with_auth('/ext/items/get', username='viewer', method='POST',
+                                 data=dict(serials='["LP0001", "LP0002"]', fields='["status"]', format='ndjson'))
+        self.assertEqual(200, rv.status_code)
+        lines = sorted(rv.data.decode('utf-8').splitlines())
+        self.assertEqual([{'_id': 'LP0001', 'status': ''}, {'_id': 'LP0002', 'status': 'shipped'}],
+                         [loads(line) for line in lines])
+        rv = self.open_with_auth('/ext/items/get', username='viewer', method='POST',
+                                 data=dict(serials='"LP0001"'))
+        data = loads(rv.data.decode('utf-8'))
+        self.assertFalse(data.get('ok'))
+        self.assertEqual('serials must be a list', data.get('message'))
+
+    def test_bulk_update(self):
+        with self.app.app_context():
+            self.app.mongo.db.items.insert({'_id': 'LP0002', 'partno': 'TE0002a', 'available': True, 'status': '',
+                                            'key4': 1})
+        updates = dumps([
+            {'serial': 'LP0001', 'set': {'key1': 'A'}, 'push': {'key3': 5}, 'status': 'obsolete', 'comment': 'c1'},
+            {'serial': 'LP0002', 'status': 'reserved', 'update': {'key4': 2}},
+            {'serial': 'LP0003', 'comment': 'c3'},
+        ])
+        rv = self.open_with_auth('/ext/items/bulk-update', username='admin', method='POST',
+                                 data=dict(updates=updates))
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data.decode('utf-8'))
+        self.assertFalse(data.get('ok'))
+        self.assertEqual({
+            'LP0001': None,
+            'LP0002': "No permission to update key 'key4'",
+            'LP0003': "unknown serial number 'LP0003'",
+        }, data.get('results'))
+        with self.app.app_context():
+            obj = self.app.mongo.db.items.find_one('LP0001')
+            self.assertEqual('obsolete', obj.get('status'))
+            self.assertFalse(obj.get('available'))
+            self.assertEqual('A', obj.get('key1'))
+            self.assertEqual([5], obj.get('key3'))
+            comments = items.get_comments('LP0001')
+            self.assertEqual(["[Auto] changed status to 'obsolete'", 'c1'], [c.get('message') for c in comments])
+            obj = self.app.mongo.db.items.find_one('LP0002')
+            self.assertEqual('', obj.get('status'))
+            self.assertEqual(1, obj.get('key4'))
+
+        updates = dumps([
+            {'serial': 'LP0001', 'set': {'key1': 'B'}},
+            {'serial': 'LP0002', 'status': 'reserved', 'comment': 'c2'},
+            {'serial': 'LP0002', 'comment': 'c2'},
+        ])
+        rv = self.open_with_auth('/ext/items/bulk-update', username='admin', method='POST',
+                                 data=dict(updates=updates))
+        data = loads(rv.data.decode('utf-8'))
+        self.assertEqual({
+            'LP0001': "operation would overwrite existing entry 'key1'",
+            'LP0002': 'multiple updates for the same serial number',
+        }, data.get('results'))
+        rv = self.open_with_auth('/ext/items/bulk-update', username='admin', method='POST',
+                                 data=dict(updates='[{"serial": "LP0002", "status": "reserved", "comment": "c2"}]'))
+        data = loads(rv.data.decode('utf-8'))
+        self.assertTrue(data.get('ok'))
+        with self.app.app_context():
+            obj = self.app.mongo.db.items.find_one('LP0002')
+            self.assertEqual('reserved', obj.get('status'))
+            comments = items.get_comments('LP0002')
+            self.assertEqual(["[Auto] changed status to 'reserved'", 'c2'], [c.get('message') for c in comments])
+
+        rv = self.open_with_auth('/ext/items/bulk-update', username='admin', method='POST',
+                                 data=dict(updates='[{"set": {"key1": "B"}}]'))
+        data = loads(rv.data.decode('utf-8'))
+        self.assertFalse(data.get('ok'))
+        self.assertEqual('updates must be a list of objects with a serial number', data.get('message'))
+
+    def test_bulk_update_deleted(self):
+        with self.app.app_context():
+            self.app.mongo.db.items.insert({'_id': 'LP0002', 'partno': 'TE0002a', 'available': True, 'status': ''})
+        apply_updates = ext.apply_updates
+
+        def delete_and_apply(updates):
+            self.app.mongo.db.items.delete_one({'_id': 'LP0002'})  # deleted after the validation
+            return apply_updates(updates)
+
+        ext.apply_updates = delete_and_apply
+        try:
+            updates = dumps([
+                {'serial': 'LP0001', 'push': {'key3': 5}},
+                {'serial': 'LP0002', 'set': {'key1': 'A'}, 'push': {'key3': 5}, 'comment': 'c2'},
+            ])
+            rv = self.open_with_auth('/ext/items/bulk-update', username='admin', method='POST',
+                                     data=dict(updates=updates))
+        finally:
+            ext.apply_updates = apply_updates
+        data = loads(rv.data.decode('utf-8'))
+        self.assertFalse(data.get('ok'))
+        self.assertEqual({'LP0001': None, 'LP0002': 'the item does not exist anymore'}, data.get('results'))
+        with self.app.app_context():
+            self.assertIsNone(self.app.mongo.db.items.find_one('LP0002'))  # no document is created
+            self.assertEqual(0, items.count_comments('LP0002'))
+            self.assertEqual([5], self.app.mongo.db.items.find_one('LP0001').get('key3'))
+
+    def test_item_comments(self):
+        with self.app.test_request_context():
+            login_user(auth.auth_user('viewer', '1234'))
+            items.add_comments('LP0001', [items.create_comment('comment %d' % idx) for idx in range(5)])
+            logout_user()
+        rv = self.open_with_auth('/ext/items/LP0002/comments', username='viewer')
+        self.assertEqual(404, rv.status_code)
+        rv = self.open_with_auth('/ext/items/LP0001/comments?limit=3', username='viewer')
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data.decode('utf-8'))
+        self.assertTrue(data.get('ok'))
+        comments = data.get('comments')
+        self.assertEqual(['comment 0', 'comment 1', 'comment 2'], [c.get('message') for c in comments])
+        rv = self.open_with_auth('/ext/items/LP0001/comments?limit=3&after=%s' % comments[-1].get('_id'),
+                                 username='viewer')
+        data = loads(rv.data.decode('utf-8'))
+        self.assertEqual(['comment 3', 'comment 4'], [c.get('message') for c in data.get('comments')])
+        rv = self.open_with_auth('/ext/items/LP0001/comments?limit=0', username='viewer')
+        data = loads(rv.data.decode('utf-8'))
+        self.assertFalse(data.get('ok'))
 
     def test_item_update(self):
         # insufficient privileges -> redirect to login
@@ -62,7 +275,7 @@ class ExtApiTest(DataBaseTestCase):
         self.assertTrue(data.get('ok'))
         with self.app.app_context():
             obj = self.app.mongo.db.items.find_one('LP0001')
-            comments = obj.get('comments')
+            comments = items.get_comments(obj['_id'])
             self.assertEqual(1, len(comments))
             comment = comments[0]
             self.assertEqual('some comment', comment.get('message'))
@@ -75,7 +288,7 @@ class ExtApiTest(DataBaseTestCase):
         self.assertTrue(data.get('ok'))
         with self.app.app_context():
             obj = self.app.mongo.db.items.find_one('LP0001')
-            comments = obj.get('comments')
+            comments = items.get_comments(obj['_id'])
             self.assertEqual(2, len(comments))
             comment = comments[0]
             self.assertEqual('some comment', comment.get('message'))
@@ -94,7 +307,7 @@ class ExtApiTest(DataBaseTestCase):
         self.assertTrue(data.get('ok'))
         with self.app.app_context():
             obj = self.app.mongo.db.items.find_one('LP0001')
-            comments = obj.get('comments')
+            comments = items.get_comments(obj['_id'])
             self.assertEqual(3, len(comments))
             comment = comments[0]
             self.assertEqual('some comment', comment.get('message'))
@@ -124,6 +337,22 @@ class ExtApiTest(DataBaseTestCase):
         data = loads(rv.data.decode('utf-8'))
         self.assertFalse(data.get('ok'))
         self.assertEqual("unknown status: 'test'", data.get('message'))
+        with self.app.app_context():
+            obj = self.app.mongo.db.items.find_one('LP0001')
+            self.assertIsNone(obj.get('key5'))
+            self.assertEqual('obsolete', obj.get('status'))
+            # the status changed between validation and update
+            with self.assertRaises(ValueError):
+                ext._raise_update_conflict({'_id': 'LP0001', 'status': ''})
+            with self.assertRaises(ValueError):
+                ext._raise_update_conflict({'_id': 'LP0001', 'key4': None})
 
-
-
+    def test_stock_buildable(self):
+        rv = self.open_with_auth('/ext/stock/buildable', username='viewer')
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data.decode('utf-8'))
+        self.assertTrue(data.get('ok'))
+        self.assertEqual(dict(TE0002=40, TE0003=100), data.get('buildable'))
+        rv = self.open_with_auth('/ext/stock/buildable?partno=TE0003&partno=TE0001', username='viewer')
+        data = loads(rv.data.decode('utf-8'))
+        self.assertEqual(dict(TE0003=100, TE0001=None), data.get('buildable'))
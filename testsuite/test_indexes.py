@@ -0,0 +1,38 @@
+from pymongo import ASCENDING
+from testsuite import DataBaseTestCase
+from lpm import indexes
+
+
+class IndexesTest(DataBaseTestCase):
+
+    def test_apply(self):
+        with self.app.app_context():
+            db = self.app.mongo.db
+            self.assertEqual([], indexes.check(db))
+            self.assertEqual([], indexes.apply(db))  # idempotent
+            self.assertIn('partno_1_name_1', db.stock_batches.index_information())
+
+            db.stock_history.drop_index('partno_1_date_1')
+            self.assertEqual([('stock_history', 'partno_1_date_1', 'missing')], indexes.check(db))
+            self.assertEqual([], indexes.apply(db, ['stock_history']))
+
+    def test_drift(self):
+        with self.app.app_context():
+            db = self.app.mongo.db
+            db.components.create_index([('name', ASCENDING)])
+            db.stock_batches.drop_index('partno_1_name_1')
+            db.stock_batches.create_index([('partno', ASCENDING), ('name', ASCENDING)])  # not unique
+            drift = indexes.apply(db)
+            self.assertEqual([
+                ('components', 'name_1', 'undeclared'),
+                ('stock_batches', 'partno_1_name_1', 'different'),
+            ], drift)
+            self.assertEqual(drift, indexes.check(db))
+
+    def test_unique_batches(self):
+        with self.app.app_context():
+            db = self.app.mongo.db
+            db.stock_batches.drop_index('partno_1_name_1')
+            db.stock_batches.insert_one({'partno': 'TE0001', 'name': 'batch1', 'quantity': 1})
+            # the index cannot be created as long as there are duplicates
+            self.assertEqual([('stock_batches', 'partno_1_name_1', 'missing')], indexes.apply(db, ['stock_batches']))
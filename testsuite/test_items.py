@@ -1,6 +1,8 @@
+import json
 from datetime import datetime
-from flask import get_flashed_messages
+from flask import Flask, get_flashed_messages
 from flask.ext.login import login_user, logout_user
+import lpm
 from testsuite import DataBaseTestCase
 from lpm import items, auth
 from lpm.components import PartNumber
@@ -8,6 +10,41 @@ from lpm.components import PartNumber
 
 class ItemsTest(DataBaseTestCase):
 
+    def test_overview_data(self):
+        with self.app.app_context():
+            self.app.mongo.db.items.insert([
+                {'_id': 'LP0002', 'partno': 'TE0002a', 'available': True, 'status': 'tested'},
+                {'_id': 'LP0003', 'partno': 'TE0002a', 'available': False, 'status': 'shipped'},
+            ])
+        self.login('viewer')
+        rv = self.client.get('/items/data?draw=3&start=0&length=10')
+        self.assertEqual(200, rv.status_code)
+        data = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual(3, data.get('draw'))
+        self.assertEqual(2, data.get('recordsTotal'))
+        self.assertEqual(2, data.get('recordsFiltered'))
+        self.assertEqual(['LP0001', 'LP0002'], [row['_id'] for row in data.get('data')])
+        self.assertEqual('Test Item 1', data['data'][0]['_partname'])
+        self.assertEqual('/items/LP0001/', data['data'][0]['_url'])
+        rv = self.client.get('/items/data?show_all=1&start=1&length=1&order[0][column]=0&order[0][dir]=desc')
+        data = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual(3, data.get('recordsTotal'))
+        self.assertEqual(['LP0002'], [row['_id'] for row in data.get('data')])
+        rv = self.client.get('/items/data?show_all=1&search[value]=TE0002')
+        data = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual(3, data.get('recordsTotal'))
+        self.assertEqual(2, data.get('recordsFiltered'))
+        self.assertEqual(['LP0002', 'LP0003'], [row['_id'] for row in data.get('data')])
+        max_page_length = items._MAX_PAGE_LENGTH
+        items._MAX_PAGE_LENGTH = 1
+        try:
+            for length in (0, -1, 2):  # the page size is always bounded
+                rv = self.client.get('/items/data?show_all=1&length=%d' % length)
+                self.assertEqual(1, len(json.loads(rv.data.decode('utf-8')).get('data')))
+        finally:
+            items._MAX_PAGE_LENGTH = max_page_length
+        self.logout()
+
     def test_create_comment(self):
         with self.app.test_request_context():
             usr = auth.auth_user('viewer', '1234')
@@ -55,7 +92,7 @@ class ItemsTest(DataBaseTestCase):
             self.assertFalse(obj.get('available'))
             self.assertEqual('b1', obj.get('batch'))
             self.assertEqual('some param', obj.get('param1'))
-            comments = obj.get('comments', list())
+            comments = items.get_comments(obj['_id'])
             self.assertEqual(1, len(comments))
             comment = comments[0]
             self.assertEqual('viewer', comment.get('user'))
@@ -67,7 +104,7 @@ class ItemsTest(DataBaseTestCase):
             self.assertEqual('', obj.get('status'))
             self.assertTrue(obj.get('available'))
             self.assertEqual('testdata', obj.get('param2'))
-            comments = obj.get('comments', list())
+            comments = items.get_comments(obj['_id'])
             self.assertEqual(2, len(comments))
             comment = comments[0]
             self.assertEqual('viewer', comment.get('user'))
@@ -80,7 +117,7 @@ class ItemsTest(DataBaseTestCase):
             self.assertEqual('TE0002a', obj.get('partno'))
             self.assertEqual('b1', obj.get('batch'))
             self.assertTrue(obj.get('available'))
-            comments = obj.get('comments', list())
+            comments = items.get_comments(obj['_id'])
             self.assertEqual(1, len(comments))
             comment = comments[0]
             self.assertEqual('viewer', comment.get('user'))
@@ -101,6 +138,28 @@ class ItemsTest(DataBaseTestCase):
             self.assertEqual(2, entries)  # one entry for the insertion, one for the stock removal
             logout_user()
 
+    def test_store_items_partial_failure(self):
+        with self.app.test_request_context():
+            usr = auth.auth_user('viewer', '1234')
+            login_user(usr)
+            importdata = [
+                {'serial': 'LPM0001', 'partno': 'TE0002a', 'batch': 'b1'},
+                {'serial': 'LP0001', 'partno': 'TE0002a', 'batch': 'b1'},  # exists already
+                {'serial': 'LPM0002', 'partno': 'TE0002a', 'batch': 'b1'},
+            ]
+            failed = items._store_items(importdata)
+            self.assertEqual(['LP0001'], list(failed.keys()))
+            self.assertIsNotNone(self.app.mongo.db.items.find_one('LPM0001'))
+            self.assertIsNotNone(self.app.mongo.db.items.find_one('LPM0002'))
+            obj = self.app.mongo.db.items.find_one('LP0001')
+            self.assertEqual('TE0001a', obj.get('partno'))  # unchanged
+            # only the stored items are added to the stock
+            obj = self.app.mongo.db.stock.find_one('TE0002')
+            self.assertEqual(37, obj.get('quantity'))
+            obj = self.app.mongo.db.stock_batches.find_one({'partno': 'TE0002', 'name': 'b1'})
+            self.assertEqual(2, obj.get('quantity'))
+            logout_user()
+
     def test_get_requiremets(self):
         with self.app.app_context():
             refreqs = dict(
@@ -255,6 +314,12 @@ class ItemsTest(DataBaseTestCase):
             ]
             self.assertEqual(refmsg, msg)
 
+    def test_duplicate_import(self):
+        with self.app.test_request_context():
+            success, headers, data = items._import_file('testsuite/files/duplicates.xlsx')
+            self.assertFalse(success)
+            self.assertEqual(["serial number 'LPM0001' already used in row 2 (row 4)"], get_flashed_messages())
+
     def test_import_file(self):
         self.login('viewer')
         rv = self.client.get('/items/import')
@@ -311,6 +376,81 @@ class ItemsTest(DataBaseTestCase):
             items._check_status('TE0001a', '', 'obsolete')
             logout_user()
 
+    def test_comments(self):
+        with self.app.test_request_context():
+            login_user(auth.auth_user('viewer', '1234'))
+            items.add_comments('LP0001', [items.create_comment('comment %d' % idx) for idx in range(5)])
+            self.assertEqual(5, items.count_comments('LP0001'))
+            comments = items.get_comments('LP0001', skip=1, limit=2)
+            self.assertEqual(['comment 1', 'comment 2'], [c.get('message') for c in comments])
+            comments = items.get_comments('LP0001', limit=2, latest_first=True)
+            self.assertEqual(['comment 4', 'comment 3'], [c.get('message') for c in comments])
+            comments = items.get_comments('LP0001', after=comments[-1].get('_id'), latest_first=True)
+            self.assertEqual(['comment 2', 'comment 1', 'comment 0'], [c.get('message') for c in comments])
+            logout_user()
+        self.login('viewer')
+        rv = self.client.get('/items/LP0001/')
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(b'comment 4', rv.data)
+
+    def test_migrate_comments(self):
+        with self.app.app_context():
+            date = datetime(2016, 3, 1)
+            self.app.mongo.db.items.insert({
+                '_id': 'LP0002',
+                'partno': 'TE0001a',
+                'comments': [
+                    {'user': 'admin', 'date': date, 'message': 'first'},
+                    {'user': 'admin', 'date': date, 'message': 'second'},
+                ]
+            })
+            self.assertEqual(1, items.migrate_comments(self.app.mongo.db))
+            obj = self.app.mongo.db.items.find_one('LP0002')
+            self.assertNotIn('comments', obj)
+            comments = items.get_comments('LP0002')
+            self.assertEqual(['first', 'second'], [c.get('message') for c in comments])
+            self.assertEqual(0, items.migrate_comments(self.app.mongo.db))
+
+    def test_status_map(self):
+        statusmap = items.StatusMap({
+            'TE0002': {
+                'tested': dict(origins=[''], role='item_admin'),
+                'shipped': dict(origins=['tested'], unavailable=True),
+            },
+            'TE0001a': {},  # empty entries fall back to the next definition
+            'default': {
+                'obsolete': dict(origins=[''], unavailable=True),
+            },
+        })
+        self.assertEqual('item_admin', statusmap.check_transition('TE0002b', '', 'tested'))
+        self.assertIsNone(statusmap.check_transition('TE0002b', 'tested', 'shipped'))
+        self.assertIsNone(statusmap.check_transition('TE0001a', '', 'obsolete'))
+        for idx in range(items._MAX_RESOLVED_PARTNOS + 1):
+            statusmap.is_unavailable('T%s%04d' % ('AB'[idx // 10000], idx % 10000), 'obsolete')
+        self.assertLessEqual(len(statusmap._resolved), items._MAX_RESOLVED_PARTNOS)
+        self.assertTrue(statusmap.is_unavailable('TE0002', 'shipped'))
+        self.assertFalse(statusmap.is_unavailable('TE0002', 'tested'))
+        with self.assertRaises(ValueError):
+            statusmap.is_unavailable('TE0002', 'obsolete')
+        with self.assertRaises(ValueError):
+            statusmap.check_transition('TE0002', '', 'shipped')
+
+        with self.assertRaises(ValueError):
+            items.StatusMap({'default': {'obsolete': dict(unavailable=True)}})  # missing origins
+        with self.assertRaises(ValueError):
+            items.StatusMap({'default': {'obsolete': dict(origins=['tested'])}})  # unknown origin
+        with self.assertRaises(ValueError):
+            items.StatusMap({'default': {'obsolete': dict(origins=[''], role=['item_admin'])}})
+        with self.assertRaises(ValueError):
+            items.StatusMap({'default': ['obsolete']})
+
+        # invalid definitions are rejected at startup
+        app = Flask('lpm_test')
+        app.config.update(self.app.config)
+        app.config['LPM_ITEM_STATUS_MAP'] = {'default': {'obsolete': dict(origins=['unknown'])}}
+        with self.assertRaises(ValueError):
+            lpm.init(app)
+
     def test_is_unavailable(self):
         with self.app.app_context():
             self.assertFalse(items._is_unavailable('TE0002a', 'tested'))
@@ -330,7 +470,7 @@ class ItemsTest(DataBaseTestCase):
         self.logout()
         with self.app.app_context():
             obj = self.app.mongo.db.items.find_one('LP0001')
-            comments = obj.get('comments')
+            comments = items.get_comments(obj['_id'])
             self.assertEqual(1, len(comments))
             comment = comments[0]
             self.assertEqual('testcomment', comment.get('message'))
@@ -338,6 +478,26 @@ class ItemsTest(DataBaseTestCase):
             self.assertTrue(obj.get('available'))
             self.assertEqual('', obj.get('status'))
 
+    def test_details_conditional(self):
+        self.login('viewer')
+        rv = self.client.get('/items/LP0001/')
+        self.assertEqual(200, rv.status_code)
+        etag = rv.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        rv = self.client.get('/items/LP0001/', headers={'If-None-Match': etag})
+        self.assertEqual(304, rv.status_code)
+        rv = self.client.get('/items/LP0001/?page=1', headers={'If-None-Match': etag})
+        self.assertEqual(200, rv.status_code)
+        # adding a comment changes the page
+        rv = self.client.post('/items/LP0001/add-comment', data=dict(message='testcomment'))
+        self.assertEqual(302, rv.status_code)
+        rv = self.client.get('/items/LP0001/', headers={'If-None-Match': etag})
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(b'testcomment', rv.data)
+        self.assertNotEqual(etag, rv.headers.get('ETag'))
+        self.logout()
+
+
     def test_change_status(self):
         self.login('viewer')
         rv = self.client.get('/items/LP0001/change-status/teststatus')
@@ -377,7 +537,7 @@ class ItemsTest(DataBaseTestCase):
             self.assertEqual('obsolete', obj.get('status'))
             self.assertFalse(obj.get('available'))
             self.assertEqual('someproject', obj.get('project'))
-            comments = obj.get('comments')
+            comments = items.get_comments(obj['_id'])
             self.assertEqual(2, len(comments))
             comment = comments[0]
             self.assertEqual("[Auto] changed status to 'obsolete'", comment.get('message'))
@@ -386,6 +546,77 @@ class ItemsTest(DataBaseTestCase):
             self.assertEqual('should now work', comment.get('message'))
             self.assertEqual('admin', comment.get('user'))
 
+    def test_bulk_update_status(self):
+        with self.app.test_request_context():
+            self.app.mongo.db.items.insert([
+                {'_id': 'LP0002', 'partno': 'TE0002a', 'available': True, 'status': ''},
+                {'_id': 'LP0003', 'partno': 'TE0002a', 'available': True, 'status': 'tested'},
+                {'_id': 'LP0004', 'partno': 'TE0002a', 'available': False, 'status': 'shipped'},
+            ])
+            login_user(auth.auth_user('viewer', '1234'))
+            results = items.do_bulk_update_status(['LP0002', 'LP0003', 'LP0004', 'LP0001', 'LP0009', 'LP0002'],
+                                                  'reserved', 'someproject', 'my comment')
+            self.assertEqual(['LP0002', 'LP0003', 'LP0004', 'LP0001', 'LP0009'], list(results.keys()))
+            self.assertIsNone(results['LP0002'])
+            self.assertIsNone(results['LP0003'])
+            self.assertEqual("Invalid status transition: from 'shipped' to 'reserved'", results['LP0004'])
+            self.assertEqual("unknown status: 'reserved'", results['LP0001'])
+            self.assertEqual("unknown serial number 'LP0009'", results['LP0009'])
+            for serial in ['LP0002', 'LP0003']:
+                obj = self.app.mongo.db.items.find_one(serial)
+                self.assertEqual('reserved', obj.get('status'))
+                self.assertEqual('someproject', obj.get('project'))
+                self.assertTrue(obj.get('available'))
+                comments = items.get_comments(serial)
+                self.assertEqual(["[Auto] changed status to 'reserved'", 'my comment'],
+                                 [c.get('message') for c in comments])
+            self.assertEqual('shipped', self.app.mongo.db.items.find_one('LP0004').get('status'))
+            self.assertEqual(0, items.count_comments('LP0004'))
+            logout_user()
+
+        self.login('viewer')
+        rv = self.client.post('/items/change-status', data=dict(partno='TE0002a', current_status='reserved',
+                                                                 status='shipped'))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(b'2 status changes successful', rv.data)
+        with self.app.app_context():
+            obj = self.app.mongo.db.items.find_one('LP0002')
+            self.assertEqual('shipped', obj.get('status'))
+            self.assertFalse(obj.get('available'))
+        rv = self.client.post('/items/change-status', data=dict(status='shipped'))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(b'are required', rv.data)
+        with self.app.app_context():
+            self.app.mongo.db.items.insert([
+                {'_id': 'LP0005', 'partno': 'TE0002b', 'available': True, 'status': ''},
+                {'_id': 'LP0006', 'partno': 'TE0002b', 'available': True, 'status': ''},
+            ])
+        max_filter_serials = items.MAX_FILTER_SERIALS
+        items.MAX_FILTER_SERIALS = 1
+        try:
+            rv = self.client.post('/items/change-status', data=dict(partno='TE0002b', status='tested'))
+            self.assertIn(b'the filter selects more than 1 items', rv.data)
+        finally:
+            items.MAX_FILTER_SERIALS = max_filter_serials
+
+    def test_apply_updates(self):
+        with self.app.test_request_context():
+            self.app.mongo.db.items.insert([
+                {'_id': 'LP0002', 'partno': 'TE0002a', 'available': True, 'status': 'reserved'},
+                {'_id': 'LP0003', 'partno': 'TE0002a', 'available': True, 'status': 'tested'},
+            ])
+            # LP0002 already has the target status (e.g. set by a concurrent writer), LP0009 was deleted
+            results = items.apply_updates([
+                ({'_id': 'LP0002', 'status': 'tested'}, {'$set': {'status': 'reserved'}}),
+                ({'_id': 'LP0003', 'status': 'tested'}, {'$set': {'status': 'reserved'}}),
+                ({'_id': 'LP0009', 'status': 'tested'}, {'$set': {'status': 'reserved'}}),
+            ])
+            self.assertEqual(['the item was modified concurrently', None, 'the item does not exist anymore'],
+                             results)
+            self.assertEqual('reserved', self.app.mongo.db.items.find_one('LP0003').get('status'))
+            self.assertIsNone(self.app.mongo.db.items.find_one('LP0009'))
+            self.assertEqual([], items.apply_updates([]))
+
     def test_set_project(self):
         self.login('viewer')
         rv = self.client.get('/items/LP0001/set-project')
@@ -398,7 +629,7 @@ class ItemsTest(DataBaseTestCase):
         with self.app.app_context():
             obj = self.app.mongo.db.items.find_one('LP0001')
             self.assertEqual('myproject', obj.get('project'))
-            comments = obj.get('comments')
+            comments = items.get_comments(obj['_id'])
             self.assertEqual(1, len(comments))
             comment = comments[0]
             self.assertEqual("[Auto] changed project association to 'myproject'", comment.get('message'))
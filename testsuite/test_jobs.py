@@ -0,0 +1,113 @@
+import json
+from datetime import datetime, timedelta
+from flask import flash, request, url_for
+from flask.ext.login import login_user, logout_user, current_user
+from testsuite import DataBaseTestCase
+from lpm import jobs, auth
+
+
+class JobsTest(DataBaseTestCase):
+
+    def test_submit(self):
+        def job(a, b):
+            jobs.report_progress(1, 2)
+            flash('%s/%s/%s' % (a, b, current_user.id), 'success')
+
+        def failing_job():
+            raise ValueError('job failed')
+
+        with self.app.test_request_context():
+            login_user(auth.auth_user('viewer', '1234'))
+            job_id = jobs.submit('Test Job', job, 1, 2, next_url='/next')
+            obj = self.app.mongo.db.jobs.find_one(job_id)
+            self.assertEqual('Test Job', obj.get('title'))
+            self.assertEqual('viewer', obj.get('user'))
+            self.assertEqual('finished', obj.get('state'))
+            self.assertEqual('/next', obj.get('next'))
+            self.assertEqual([{'category': 'success', 'message': '1/2/viewer'}], obj.get('messages'))
+            job_id = jobs.submit('Failing Job', failing_job)
+            obj = self.app.mongo.db.jobs.find_one(job_id)
+            self.assertEqual('failed', obj.get('state'))
+            self.assertEqual([{'category': 'error', 'message': 'job failed'}], obj.get('messages'))
+            jobs.report_progress(1, 2)  # no-op outside of jobs
+            logout_user()
+
+    def test_status(self):
+        with self.app.test_request_context():
+            login_user(auth.auth_user('viewer', '1234'))
+            job_id = jobs.submit('Test Job', lambda: flash('done', 'success'))
+            logout_user()
+        self.login('viewer')
+        rv = self.client.get('/jobs/%s' % job_id)
+        self.assertEqual(200, rv.status_code)
+        rv = self.client.get('/jobs/%s/status' % job_id)
+        self.assertEqual(200, rv.status_code)
+        data = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual('finished', data.get('state'))
+        self.assertEqual([{'category': 'success', 'message': 'done'}], data.get('messages'))
+        rv = self.client.get('/jobs/invalid/status')
+        self.assertEqual(404, rv.status_code)
+        self.logout()
+        self.login('admin')
+        rv = self.client.get('/jobs/%s/status' % job_id)
+        self.assertEqual(404, rv.status_code)  # jobs of other users are not visible
+
+    def test_rows(self):
+        def job():
+            for row in range(2, 1502):
+                jobs.report_row(row, 'applied', partno='TE0001')
+            raise ValueError('row 1502 failed')
+
+        with self.app.test_request_context('/stock/add', method='POST', data=dict(x='1'),
+                                           headers={'Cookie': 'session=abc'}):
+            login_user(auth.auth_user('viewer', '1234'))
+            job_id = jobs.submit('Row Job', job)
+            obj = self.app.mongo.db.jobs.find_one(job_id)
+            self.assertEqual('failed', obj.get('state'))
+            self.assertIsNone(obj.get('rows'))  # the rows are stored separately
+            self.assertEqual(1500, self.app.mongo.db.job_rows.count({'job': job_id}))
+            jobs.report_row(1, 'applied')  # no-op outside of jobs
+            logout_user()
+        self.login('viewer')
+        rv = self.client.get('/jobs/%s/rows?skip=1499' % job_id)
+        self.assertEqual(200, rv.status_code)
+        data = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual(1500, data.get('total'))
+        self.assertEqual([{'row': 1501, 'state': 'applied', 'partno': 'TE0001'}], data.get('rows'))
+        rv = self.client.get('/jobs/%s/rows?limit=0' % job_id)
+        self.assertEqual(1000, len(json.loads(rv.data.decode('utf-8')).get('rows')))
+
+    def test_environ(self):
+        def job():
+            self.assertEqual('GET', request.method)
+            self.assertEqual(b'', request.get_data())
+            self.assertNotIn('HTTP_COOKIE', request.environ)
+            flash(url_for('jobs.details', id='x', _external=True), 'success')
+
+        with self.app.test_request_context('/stock/add', method='POST', base_url='https://lpm.example.com',
+                                           data=dict(x='1')):
+            login_user(auth.auth_user('viewer', '1234'))
+            job_id = jobs.submit('Environ Job', job)
+            obj = self.app.mongo.db.jobs.find_one(job_id)
+            self.assertEqual([{'category': 'success', 'message': 'https://lpm.example.com/jobs/x'}],
+                             obj.get('messages'))
+            logout_user()
+
+    def test_orphaned(self):
+        with self.app.app_context():
+            job_id = self.app.mongo.db.jobs.insert_one({
+                'title': 'Orphaned Job',
+                'user': 'viewer',
+                'state': 'running',
+                'owner': 'other:1:0',
+                'created': datetime.now() - timedelta(hours=1),
+                'heartbeat': datetime.now() - timedelta(hours=1),
+                'messages': list(),
+            }).inserted_id
+        self.login('viewer')
+        rv = self.client.get('/jobs/%s/status' % job_id)
+        data = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual('failed', data.get('state'))
+        self.assertEqual('error', data.get('messages')[0].get('category'))
+        with self.app.app_context():
+            self.assertEqual([], jobs.fail_orphaned(self.app.mongo.db))
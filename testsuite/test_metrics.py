@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+from bson.json_util import loads
+from testsuite import DataBaseTestCase
+from lpm import metrics
+
+
+class MetricsTest(DataBaseTestCase):
+
+    def test_metrics(self):
+        self.login('viewer')
+        rv = self.client.get('/items/LP0001/')
+        self.assertEqual(200, rv.status_code)
+        rv = self.client.get('/items/LP0009/')
+        self.assertEqual(404, rv.status_code)
+        rv = self.client.get('/metrics')
+        self.assertEqual(200, rv.status_code)
+        self.assertTrue(rv.mimetype.startswith('text/plain'))
+        data = rv.data.decode('utf-8')
+        instance = 'instance="%s"' % metrics._instance()
+        self.assertIn('# TYPE lpm_http_requests_total counter', data)
+        self.assertIn('lpm_http_requests_total{%s,endpoint="items.details",method="GET",status="200"} 1'
+                      % instance, data)
+        self.assertIn('lpm_http_requests_total{%s,endpoint="items.details",method="GET",status="404"} 1'
+                      % instance, data)
+        self.assertIn('lpm_http_request_duration_seconds_bucket{%s,endpoint="items.details",le="+Inf"} 2'
+                      % instance, data)
+        self.assertIn('lpm_http_request_duration_seconds_count{%s,endpoint="items.details"} 2' % instance, data)
+        self.assertIn('lpm_http_requests_in_flight{%s} 1' % instance, data)  # the metrics request itself
+        with self.app.app_context():
+            self.assertEqual(1, self.app.mongo.db.metrics.count())
+
+        # the samples of other processes are not summed up, their gauges are only exposed if recent
+        with self.app.app_context():
+            self.app.mongo.db.metrics.insert_one({
+                '_id': 'other:1',
+                'updated': datetime.utcnow() - timedelta(seconds=60),
+                'samples': [['lpm_http_requests_in_flight', [], 3],
+                            ['lpm_http_requests_total', [['endpoint', 'items.details'], ['method', 'GET'],
+                                                         ['status', '200']], 5]],
+            })
+        data = self.client.get('/metrics').data.decode('utf-8')
+        self.assertIn('lpm_http_requests_total{instance="other:1",endpoint="items.details",method="GET",'
+                      'status="200"} 5', data)
+        self.assertIn('lpm_http_requests_total{%s,endpoint="items.details",method="GET",status="200"} 1'
+                      % instance, data)
+        self.assertNotIn('lpm_http_requests_in_flight{instance="other:1"}', data)
+
+    def test_registry(self):
+        registry = metrics.Registry()
+        registry.observe('lpm_http_response_size_bytes', (('endpoint', 'test'),), 5000, (1000, 10000))
+        registry.observe('lpm_http_response_size_bytes', (('endpoint', 'test'),), 50000, (1000, 10000))
+        self.assertEqual('\n'.join([
+            '# HELP lpm_http_requests_in_flight Number of HTTP requests currently being handled',
+            '# TYPE lpm_http_requests_in_flight gauge',
+            'lpm_http_requests_in_flight 0',
+            '# HELP lpm_http_response_size_bytes HTTP response body size',
+            '# TYPE lpm_http_response_size_bytes histogram',
+            'lpm_http_response_size_bytes_bucket{endpoint="test",le="1000"} 0',
+            'lpm_http_response_size_bytes_bucket{endpoint="test",le="10000"} 1',
+            'lpm_http_response_size_bytes_bucket{endpoint="test",le="+Inf"} 2',
+            'lpm_http_response_size_bytes_count{endpoint="test"} 2',
+            'lpm_http_response_size_bytes_sum{endpoint="test"} 55000',
+        ]) + '\n', metrics.expose(registry.samples()))
+
+    def test_ready(self):
+        rv = self.client.get('/ready')
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data.decode('utf-8'))
+        self.assertTrue(data.get('ok'))
+        self.assertGreaterEqual(data.get('mongo_ping_ms'), 0)
+        self.app.config['LPM_READY_MAX_PING'] = -1
+        rv = self.client.get('/ready')
+        self.assertEqual(503, rv.status_code)
+        self.assertFalse(loads(rv.data.decode('utf-8')).get('ok'))
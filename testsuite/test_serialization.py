@@ -0,0 +1,30 @@
+from datetime import datetime
+from bson import ObjectId, Binary
+from bson.son import SON
+from bson.json_util import dumps
+from testsuite import TestCase
+from lpm import serialization
+
+
+class SerializationTest(TestCase):
+
+    def test_dumps(self):
+        obj = {
+            '_id': ObjectId(),
+            'created': datetime(2016, 3, 4, 5, 6, 7, 891000),
+            'modified': datetime(2016, 3, 4, 5, 6, 7),
+            'old': datetime(1950, 1, 1),
+            'data': Binary(b'123'),
+            'son': SON([('b', 1), ('a', 2)]),
+            'list': [1, 2.5, None, True, 'ä', (3, 4)],
+        }
+        self.assertEqual(dumps(obj), serialization.dumps(obj))
+        self.assertEqual(dumps(obj, indent=2), serialization.dumps(obj, indent=2))
+        self.assertEqual(dumps([obj, obj]), serialization.dumps([obj, obj]))
+        with self.assertRaises(TypeError):
+            serialization.dumps(object())
+
+    def test_dumps_nonfinite(self):
+        obj = {'a': float('nan'), 'b': [1.5, float('inf'), (float('-inf'),)], 'son': SON([('b', float('nan'))])}
+        self.assertEqual(dumps(obj), serialization.dumps(obj))
+        self.assertEqual('{"$numberDouble": "-Infinity"}', serialization.dumps(float('-inf')))
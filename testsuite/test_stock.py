@@ -39,6 +39,21 @@ class StockTest(DataBaseTestCase):
             with self.assertRaises(ValueError):
                 stock.update_counts('TE0005', 10, '', '')  # component does not exist
 
+    def test_update_counts_merged(self):
+        with self.app.app_context():
+            db = self.app.mongo.db
+            stock.set_bom('TE0004', [{'partno': 'TE0001', 'quantity': 1}, {'partno': 'TE0001', 'quantity': 2}])
+            stock.update_counts('TE0004', 2, '', 'assembled')
+            self.assertEqual(94, db.stock.find_one('TE0001').get('quantity'))
+            history = list(db.stock_history.find({'partno': 'TE0001'}))
+            self.assertEqual(1, len(history))
+            self.assertEqual(-6, history[0].get('delta'))
+            self.assertEqual('(BOM rule)', history[0].get('message'))
+
+            stock.update_counts('TE0004', -1, '', 'removed')  # removals do not follow the BOM rules
+            self.assertEqual(1, db.stock.find_one('TE0004').get('quantity'))
+            self.assertEqual(94, db.stock.find_one('TE0001').get('quantity'))
+
     def test_correct_counts(self):
         with self.app.app_context():
             stock.correct_counts('TE0002', 5, 'my message')
@@ -82,6 +97,30 @@ class StockTest(DataBaseTestCase):
             })
             self.assertIsNone(obj)
 
+    def test_update_batches(self):
+        with self.app.app_context():
+            stock.update_batches({
+                ('TE0001', 'batch1'): 10,
+                ('TE0001', 'newbatch'): 15,
+                ('TE0002', 'newbatch'): 5,
+                ('TE0001', 'otherbatch'): 0,  # should be a no-op
+                ('TE0001', ''): 20,  # should be a no-op
+            })
+            obj = self.app.mongo.db.stock_batches.find_one({'partno': 'TE0001', 'name': 'batch1'})
+            self.assertEqual(20, obj.get('quantity'))
+            obj = self.app.mongo.db.stock_batches.find_one({'partno': 'TE0001', 'name': 'newbatch'})
+            self.assertEqual(15, obj.get('quantity'))
+            obj = self.app.mongo.db.stock_batches.find_one({'partno': 'TE0002', 'name': 'newbatch'})
+            self.assertEqual(5, obj.get('quantity'))
+            self.assertIsNone(self.app.mongo.db.stock_batches.find_one({'partno': 'TE0001', 'name': 'otherbatch'}))
+            self.assertIsNone(self.app.mongo.db.stock_batches.find_one({'partno': 'TE0001', 'name': ''}))
+            stock.update_batches(dict())  # nothing to do
+
+            with self.assertRaises(ValueError):
+                stock.update_batches({('TE0001', 'batch1'): -1})
+            with self.assertRaises(ValueError):
+                stock.update_batches({('TE0005', 'batch1'): 1})  # component does not exist
+
     def test_set_bom(self):
         with self.app.app_context():
             bomlist = [
@@ -114,13 +153,73 @@ class StockTest(DataBaseTestCase):
             self.assertIsNotNone(bom)
             self.assertEqual(bomlist, bom)
 
-    def test_check_bom(self):
+    def test_bom_loops(self):
         with self.app.app_context():
-            stock._check_bom('TE0002')  # all okay
+            db = self.app.mongo.db
+            with self.assertRaises(RuntimeError):
+                stock.set_bom('TE0001', [{'partno': 'TE0002', 'quantity': 1}])  # loop
+            self.assertIsNone(db.stock.find_one('TE0001').get('bom'))
+
+            # a loop closed by a concurrent update is detected after the write and the BOM is restored
+            self.app.bom_cache.get()
+            db.stock.update_one({'_id': 'TE0001'}, {'$set': {'bom': [{'partno': 'TE0004', 'quantity': 1}]}})
             with self.assertRaises(RuntimeError):
-                stock._check_bom('TE0002', {'TE0001'})
+                stock.set_bom('TE0004', [{'partno': 'TE0002', 'quantity': 1}])
+            self.assertIsNone(db.stock.find_one('TE0004').get('bom'))
+            with self.assertRaises(RuntimeError):
+                stock.set_bom('TE0004', [{'partno': 'TE0001', 'quantity': 2}])  # rejected before the write
+            self.assertIsNone(db.stock.find_one('TE0004').get('bom'))
+
+    def test_bom_cache(self):
+        with self.app.app_context():
+            graph = self.app.bom_cache.get()
+            self.assertIs(graph, self.app.bom_cache.get())
+            self.assertEqual([('TE0001', 1)], graph.bom('TE0003'))
+            self.assertLess(graph.order.index('TE0002'), graph.order.index('TE0003'))
+            self.assertLess(graph.order.index('TE0003'), graph.order.index('TE0001'))
+            stock.set_bom('TE0004', [{'partno': 'TE0002', 'quantity': 3}])
+            graph = self.app.bom_cache.get()
+            self.assertEqual([('TE0002', 3)], graph.bom('TE0004'))
+            self.assertEqual('TE0004', graph.order[0])
             with self.assertRaises(RuntimeError):
-                stock._check_bom('TE0003', {'TE0001'})
+                stock.BomGraph({'TE0001': [('TE0002', 1)], 'TE0002': [('TE0001', 1)]}).check_acyclic()
+
+    def test_bom_closure(self):
+        with self.app.app_context():
+            self.assertEqual([
+                dict(ancestor='TE0002', descendant='TE0001', quantity=3, depth=1),
+                dict(ancestor='TE0003', descendant='TE0001', quantity=1, depth=1),
+            ], stock.where_used('TE0001'))
+            stock.set_bom('TE0004', [{'partno': 'TE0002', 'quantity': 2}])
+            self.assertEqual([
+                dict(ancestor='TE0004', descendant='TE0002', quantity=2, depth=1),
+                dict(ancestor='TE0004', descendant='TE0001', quantity=6, depth=2),
+                dict(ancestor='TE0004', descendant='TE0003', quantity=2, depth=2),
+            ], stock.explode_bom('TE0004'))
+
+            # the ancestors are updated incrementally
+            stock.set_bom('TE0003', [{'partno': 'TE0001', 'quantity': 5}])
+            used_in = dict((entry['ancestor'], entry['quantity']) for entry in stock.where_used('TE0001'))
+            self.assertEqual(dict(TE0002=7, TE0003=5, TE0004=14), used_in)
+            sort = [('ancestor', 1), ('descendant', 1)]
+            projection = {'_id': False, 'generation': False}
+            closure = list(self.app.mongo.db.bom_closure.find(projection=projection, sort=sort))
+            stock.rebuild_bom_closure(self.app.mongo.db)
+            self.assertEqual(closure, list(self.app.mongo.db.bom_closure.find(projection=projection, sort=sort)))
+
+            # a closure computed from an outdated graph is computed again
+            graph = stock.BomGraph.load(self.app.mongo.db)
+            stock.set_bom('TE0003', [{'partno': 'TE0001', 'quantity': 4}])
+            stock.update_bom_closure(self.app.mongo.db, 'TE0003', graph)
+            closure = list(self.app.mongo.db.bom_closure.find(projection=projection, sort=sort))
+            self.assertIn(dict(ancestor='TE0003', descendant='TE0001', quantity=4, depth=1), closure)
+            stock.rebuild_bom_closure(self.app.mongo.db)
+            self.assertEqual(closure, list(self.app.mongo.db.bom_closure.find(projection=projection, sort=sort)))
+
+        self.login('viewer')
+        rv = self.client.get('/stock/TE0001')
+        self.assertIn(b'Used In', rv.data)
+        self.assertIn(b'TE0004', rv.data)
 
     def test_add_single(self):
         self.login('viewer')
@@ -1,4 +1,5 @@
 import os
+import shutil
 from io import BytesIO
 from flask import Flask, request
 from testsuite import TestCase
@@ -53,3 +54,42 @@ class XlsFilesTest(TestCase):
         ]
         self.assertEqual(['serial', 'partno'], headers)
         self.assertEqual(ref, data)
+
+    def test_import_cached(self):
+        shutil.copy('testsuite/files/good.xlsx', '/tmp/lpm_tmp_cachetest.xlsx')
+        calls = list()
+
+        def import_file(filepath):
+            calls.append(filepath)
+            headers, data = lpm.xls_files.read_xls(filepath)
+            return True, headers, data
+
+        with self.app.app_context():
+            form = lpm.xls_files.FileForm()
+            form.tmpname.data = 'lpm_tmp_cachetest.xlsx'
+            if os.path.exists('/tmp/lpm_tmp_cachetest.xlsx.result'):
+                os.remove('/tmp/lpm_tmp_cachetest.xlsx.result')
+            ref = lpm.xls_files.import_cached(form, import_file)
+            self.assertEqual(1, len(calls))
+            self.assertEqual(ref, lpm.xls_files.import_cached(form, import_file))
+            self.assertEqual(1, len(calls))  # stored result is used
+
+            # a modified stored result is discarded
+            with open('/tmp/lpm_tmp_cachetest.xlsx.result', 'r+b') as f:
+                f.seek(40)
+                f.write(b'x')
+            self.assertEqual(ref, lpm.xls_files.import_cached(form, import_file))
+            self.assertEqual(2, len(calls))
+            self.assertEqual(ref, lpm.xls_files.import_cached(form, import_file))
+            self.assertEqual(2, len(calls))
+
+            # a modified file is parsed again
+            shutil.copy('testsuite/files/nokey.xlsx', '/tmp/lpm_tmp_cachetest.xlsx')
+            success, headers, data = lpm.xls_files.import_cached(form, import_file)
+            self.assertEqual(3, len(calls))
+            self.assertEqual(['serial', 'partno'], headers)
+
+            # unsuccessful results are not stored
+            os.remove('/tmp/lpm_tmp_cachetest.xlsx.result')
+            lpm.xls_files.import_cached(form, lambda filepath: (False, [], []))
+            self.assertFalse(os.path.exists('/tmp/lpm_tmp_cachetest.xlsx.result'))
@@ -1,6 +1,8 @@
-from flask import flash, g
-from bson.json_util import dumps
+import hashlib
+from datetime import datetime, timezone
+from flask import flash, g, request, session, current_app
 from . import auth
+from .serialization import dumps
 
 
 def extract_errors(form):
@@ -12,6 +14,81 @@ def extract_errors(form):
             flash(key + ': ' + msg, 'error')
 
 
+def versioned(update):
+    """
+    Adds the version increment and the modification timestamp to the given update document.
+    All writes to items, components and stock objects must go through this function,
+    such that conditional requests (see not_modified()) notice every change.
+    """
+    update = dict(update)
+    update['$inc'] = dict(update.get('$inc', dict()), _version=1)
+    update['$set'] = dict(update.get('$set', dict()), _modified=datetime.utcnow())
+    return update
+
+
+def new_version(obj):
+    """
+    Adds the initial version and the modification timestamp to the given new database object
+    """
+    obj['_version'] = 1
+    obj['_modified'] = datetime.utcnow()
+    return obj
+
+
+def document_etag(obj, *variant):
+    """
+    Returns the entity tag for the given database object (which must contain the '_id' and '_version' keys).
+    The variant values identify further inputs of the representation, e.g. the user for rendered pages.
+    """
+    key = '%s:%s:%s' % (obj.get('_id'), obj.get('_version', 0), ':'.join(str(v) for v in variant))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def is_conditional():
+    """
+    Returns True if the current request contains any conditional GET headers
+    """
+    return bool(request.if_none_match) or request.if_modified_since is not None
+
+
+def not_modified(etag, last_modified=None):
+    """
+    Returns a '304 Not Modified' response if the client already has the current representation,
+    None otherwise. If-None-Match takes precedence over If-Modified-Since.
+    Pending flash messages must be shown, thus the full page is always returned in that case.
+    """
+    if '_flashes' in session:
+        return None
+    if request.if_none_match:
+        if not request.if_none_match.contains(etag):
+            return None
+    elif last_modified is None or request.if_modified_since is None:
+        return None
+    elif _http_date(last_modified) > _http_date(request.if_modified_since):
+        return None
+    response = current_app.response_class(status=304)
+    return cache_headers(response, etag, last_modified)
+
+
+def cache_headers(response, etag, last_modified=None):
+    """
+    Sets the validators for conditional requests at the given response
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # clients must revalidate the cached representation
+    response.cache_control.no_cache = True
+    return response
+
+
+def _http_date(date):
+    # HTTP dates have a resolution of one second, naive datetimes are UTC
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date.replace(microsecond=0)
+
+
 def init(app):
     """
     Registers useful template filters at the passed app
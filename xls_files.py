@@ -3,8 +3,11 @@
 Excel-file importing module for lpm
 
 A two-stage mechanism is used for importing files. In the first step the file is uploaded and stored in a temporary
-location. The file is then parsed and presented for validation. When the user accepts the validated data the file
-is re-read and imported to the database.
+location. The file is then parsed and presented for validation. When the user accepts the validated data it is
+imported to the database.
+The result of a successful validation is stored next to the temporary file, together with a hash of the file and a
+signature, such that the second stage does not need to parse and validate the file again. If the stored result is
+missing, outdated or does not match the file, the file is parsed again.
 This module only provides the low-level functionality for storing and parsing file data.
 
 Note: There is no protection against the temporary file being removed between upload and validation.
@@ -14,14 +17,22 @@ Note: There is no protection against the temporary file being removed between up
 """
 
 import os
+import hmac
+import time
+import hashlib
 import tempfile
+from bson import BSON
 from werkzeug import secure_filename
-from flask import request
+from flask import request, current_app
 from flask_wtf import Form
 from flask_wtf.file import FileField
 from wtforms import HiddenField
 from openpyxl import load_workbook
 
+# file suffix and signature length of the stored validation results
+_RESULT_SUFFIX = '.result'
+_SIGNATURE_LENGTH = hashlib.sha256().digest_size
+
 
 class FileForm(Form):
     """
@@ -89,4 +100,69 @@ def extract_filepath(form):
     """
     Returns the file path represented by the form
     """
-    return os.path.join('/tmp/', secure_filename(form.tmpname.data))
\ No newline at end of file
+    return os.path.join('/tmp/', secure_filename(form.tmpname.data))
+
+
+def import_cached(form, import_file):
+    """
+    Returns the result of import_file(filepath) for the file represented by the form.
+    import_file must return a tuple (success, headers, data). Successful results are stored and returned
+    again for subsequent calls as long as the file is unchanged and the stored result is not older than
+    LPM_IMPORT_CACHE_MAX_AGE seconds. The returned data is a fresh copy for every call.
+    """
+    filepath = extract_filepath(form)
+    result = _load_result(filepath)
+    if result is None:
+        result = import_file(filepath)
+        if result[0]:
+            _store_result(filepath, result)
+    return result
+
+
+def _load_result(filepath):
+    try:
+        with open(filepath + _RESULT_SUFFIX, 'rb') as f:
+            content = f.read()
+    except OSError:
+        return None
+    signature, payload = content[:_SIGNATURE_LENGTH], content[_SIGNATURE_LENGTH:]
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None  # tampered
+    try:
+        obj = BSON(payload).decode()
+        max_age = current_app.config.get('LPM_IMPORT_CACHE_MAX_AGE', 3600)
+        if time.time() - obj['created'] > max_age or obj['hash'] != _hash_file(filepath):
+            return None  # outdated
+        return True, obj['headers'], obj['data']
+    except Exception:
+        return None
+
+
+def _store_result(filepath, result):
+    success, headers, data = result
+    try:
+        payload = BSON.encode(dict(
+            created=time.time(),
+            hash=_hash_file(filepath),
+            headers=headers,
+            data=data,
+        ))
+    except Exception:
+        return  # not all values can be represented, the file will be parsed again
+    with open(filepath + _RESULT_SUFFIX, 'wb') as f:
+        f.write(_sign(payload) + payload)
+
+
+def _sign(payload):
+    key = current_app.config['SECRET_KEY']
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hmac.new(key, payload, hashlib.sha256).digest()
+
+
+def _hash_file(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()